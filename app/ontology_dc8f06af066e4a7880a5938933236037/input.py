@@ -14,6 +14,8 @@ from openfabric_pysdk.utility import SchemaUtil
 class InputClass:
     prompt: str = None
     attachments: List[str] = None
+    reuse_similar: bool = None
+    similarity_threshold: float = None
 
 
 ################################################################
@@ -22,6 +24,8 @@ class InputClass:
 class InputClassSchema(Schema):
     prompt = fields.String(allow_none=True)
     attachments = fields.List(fields.String(allow_none=True), allow_none=True)
+    reuse_similar = fields.Boolean(allow_none=True)
+    similarity_threshold = fields.Float(allow_none=True)
 
     @post_load
     def create(self, data, **kwargs):
@@ -0,0 +1,159 @@
+import logging
+import os
+import random
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from result_cache import RESULT_CACHE, result_key
+from schedulers import apply_scheduler
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+try:
+    from embedding_cache import PROMPT_EMBEDDINGS
+except ImportError:
+    PROMPT_EMBEDDINGS = None
+
+DEFAULT_STEPS = 20
+DEFAULT_GUIDANCE_SCALE = 7.5
+# Images per UNet call; classifier-free guidance doubles the effective batch
+MAX_BATCH_IMAGES = int(os.environ.get('SD_MAX_BATCH_IMAGES', '4'))
+
+class GenerationRequest:
+    __slots__ = ('prompt', 'negative_prompt', 'width', 'height', 'steps', 'guidance_scale',
+                 'num_images_per_prompt', 'scheduler', 'seed')
+
+    def __init__(self, prompt: str, negative_prompt: Optional[str] = None, width: int = 512,
+                 height: int = 512, steps: int = DEFAULT_STEPS,
+                 guidance_scale: float = DEFAULT_GUIDANCE_SCALE, num_images_per_prompt: int = 1,
+                 scheduler: Optional[str] = None, seed: Optional[int] = None):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.guidance_scale = guidance_scale
+        self.num_images_per_prompt = max(1, int(num_images_per_prompt))
+        self.scheduler = scheduler
+        # Random unless given, but always explicit so a generation can be reproduced and cached
+        self.seed = int(seed) if seed is not None else random.randrange(2 ** 32)
+
+    def batch_key(self) -> Tuple:
+        # Requests can share a UNet batch only if every latent has the same shape
+        # and the same scheduler runs the same timesteps with the same guidance
+        return (self.width, self.height, self.steps, self.guidance_scale, self.scheduler)
+
+    def image_seeds(self) -> List[int]:
+        return [self.seed + index for index in range(self.num_images_per_prompt)]
+
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'GenerationRequest':
+        return cls(**{name: data[name] for name in cls.__slots__ if data.get(name) is not None})
+
+    def __repr__(self) -> str:
+        return (f"GenerationRequest({self.prompt!r}, {self.width}x{self.height}, steps={self.steps}, "
+                f"images={self.num_images_per_prompt}, seed={self.seed})")
+
+def plan_batches(requests: Sequence[GenerationRequest], max_batch_images: int = MAX_BATCH_IMAGES) -> List[List[int]]:
+    groups: Dict[Tuple, List[int]] = {}
+    for index, request in enumerate(requests):
+        groups.setdefault(request.batch_key(), []).append(index)
+    batches = []
+    for indices in groups.values():
+        batch, images = [], 0
+        for index in indices:
+            count = requests[index].num_images_per_prompt
+            if batch and images + count > max_batch_images:
+                batches.append(batch)
+                batch, images = [], 0
+            # A request larger than the cap still runs, alone in its own batch
+            batch.append(index)
+            images += count
+        if batch:
+            batches.append(batch)
+    return batches
+
+def _run_batch(pipe, batch: Sequence[GenerationRequest], **pipe_kwargs) -> List:
+    first = batch[0]
+    apply_scheduler(pipe, first.scheduler)
+    counts = [request.num_images_per_prompt for request in batch]
+    prompts = [request.prompt for request in batch]
+    negatives = [request.negative_prompt or '' for request in batch]
+    if len(set(counts)) == 1:
+        images_per_prompt = counts[0]
+    else:
+        # Mixed counts: repeat each prompt so one call still covers the whole batch
+        prompts = [prompt for prompt, count in zip(prompts, counts) for _ in range(count)]
+        negatives = [negative for negative, count in zip(negatives, counts) for _ in range(count)]
+        images_per_prompt = 1
+    if PROMPT_EMBEDDINGS is not None and hasattr(pipe, 'encode_prompt') and 'prompt_embeds' not in pipe_kwargs:
+        # Repeated prompts skip the text encoder; unguided runs (LCM) never use the negatives
+        pipe_kwargs['prompt_embeds'] = PROMPT_EMBEDDINGS.embeddings(pipe, prompts)
+        if first.guidance_scale > 1:
+            pipe_kwargs['negative_prompt_embeds'] = PROMPT_EMBEDDINGS.embeddings(pipe, negatives)
+        prompts, negatives = None, []
+    if torch is not None and 'generator' not in pipe_kwargs:
+        # One CPU generator per image keeps results identical across batching and devices
+        pipe_kwargs['generator'] = [torch.Generator('cpu').manual_seed(seed)
+                                    for request in batch for seed in request.image_seeds()]
+    return pipe(
+        prompts,
+        negative_prompt=negatives if any(negatives) else None,
+        width=first.width,
+        height=first.height,
+        num_inference_steps=first.steps,
+        guidance_scale=first.guidance_scale,
+        num_images_per_prompt=images_per_prompt,
+        **pipe_kwargs
+    ).images
+
+def _result_keys(pipe, request: GenerationRequest) -> List[str]:
+    # Everything that changes the pixels: weights, scheduler, prompts, seed and sampling settings
+    model = getattr(pipe, 'name_or_path', None) or pipe.config.get('_name_or_path')
+    if getattr(pipe, 'unet', None) is not None:
+        model = f"{model}:{'int8' if getattr(pipe, 'quantized', False) else pipe.unet.dtype}"
+    # No scheduler means the one the pipeline was loaded with (apply_scheduler restores it),
+    # never whatever an earlier request left on the pipe
+    default_scheduler = getattr(pipe, 'default_scheduler_class', None) or type(pipe.scheduler)
+    scheduler = request.scheduler or f"default:{default_scheduler.__name__}"
+    return [result_key(model, scheduler, request.prompt, request.negative_prompt, seed, request.steps,
+                       request.guidance_scale, request.width, request.height)
+            for seed in request.image_seeds()]
+
+def generate_batch(pipe, requests: Sequence[GenerationRequest], max_batch_images: int = MAX_BATCH_IMAGES,
+                   result_cache=RESULT_CACHE, **pipe_kwargs) -> List[List]:
+    results: List[List] = [[] for _ in requests]
+    if result_cache is not None and ('generator' in pipe_kwargs or 'latents' in pipe_kwargs):
+        # Caller-controlled noise is not described by the request, so it cannot be cached
+        result_cache = None
+    for indices in plan_batches(requests, max_batch_images):
+        keys = {}
+        if result_cache is not None and result_cache.enabled:
+            for index in list(indices):
+                keys[index] = _result_keys(pipe, requests[index])
+                cached = [result_cache.get(key) for key in keys[index]]
+                if all(image is not None for image in cached):
+                    results[index] = cached
+                    indices.remove(index)
+            if not indices:
+                logging.info(f"Served {len(keys)} requests from the result cache")
+                continue
+        batch = [requests[index] for index in indices]
+        start_time = time.time()
+        images = _run_batch(pipe, batch, **pipe_kwargs)
+        # Diffusers returns images grouped per prompt, in prompt order
+        offset = 0
+        for index, request in zip(indices, batch):
+            results[index] = images[offset:offset + request.num_images_per_prompt]
+            offset += request.num_images_per_prompt
+            for key, image in zip(keys.get(index, []), results[index]):
+                result_cache.put(key, image)
+        logging.info(f"Generated {len(images)} images for {len(batch)} prompts in one batch "
+                     f"({time.time() - start_time:.2f}s)")
+    return results
@@ -0,0 +1,147 @@
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+import torch
+from diffusers import StableDiffusionPipeline
+
+try:
+    from diffusers.models.attention_processor import AttnProcessor2_0
+except ImportError:
+    AttnProcessor2_0 = None
+
+from quantization import load_quantized_components, quantize_pipeline
+
+# baseline mirrors the previous untuned CPU setup and exists for benchmarking
+# cpu-int8 is opt-in: dynamic int8 Linear layers in the text encoder and UNet, quantized from float32
+PROFILES = {
+    'baseline': {'dtype': 'float32', 'channels_last': False, 'sdpa': False, 'compile': False, 'quantize': False},
+    'cpu': {'dtype': 'auto', 'channels_last': True, 'sdpa': True, 'compile': False, 'quantize': False},
+    'cpu-fp32': {'dtype': 'float32', 'channels_last': True, 'sdpa': True, 'compile': False, 'quantize': False},
+    'cpu-compiled': {'dtype': 'auto', 'channels_last': True, 'sdpa': True, 'compile': True, 'quantize': False},
+    'cpu-int8': {'dtype': 'float32', 'channels_last': True, 'sdpa': True, 'compile': False, 'quantize': True},
+}
+
+DEFAULT_PROFILE = os.environ.get('SD_CPU_PROFILE', 'cpu')
+
+_threads_configured = False
+
+def bf16_supported() -> bool:
+    # Only native bf16 (AVX512-BF16 / AMX) is faster than float32; emulated bf16 is slower
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
+    except OSError:
+        return False
+
+def configure_threads(intra_op: Optional[int] = None, inter_op: Optional[int] = None):
+    global _threads_configured
+    if _threads_configured:
+        return
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    intra_op = intra_op or int(os.environ.get('SD_CPU_THREADS', cores))
+    # A single pipeline call is one long chain of ops; parallelism lives inside each op
+    inter_op = inter_op or int(os.environ.get('SD_CPU_INTEROP_THREADS', 1))
+    torch.set_num_threads(intra_op)
+    try:
+        torch.set_num_interop_threads(inter_op)
+    except RuntimeError:
+        # Can only be set before the first parallel region runs
+        logging.warning("Inter-op thread count already fixed for this process")
+    _threads_configured = True
+    logging.info(f"CPU inference using {intra_op} intra-op and {inter_op} inter-op threads")
+
+def profile_dtype(profile: str = DEFAULT_PROFILE) -> torch.dtype:
+    dtype = PROFILES[profile]['dtype']
+    if dtype == 'auto':
+        return torch.bfloat16 if bf16_supported() else torch.float32
+    return getattr(torch, dtype)
+
+def compile_unet(pipe) -> bool:
+    unet = pipe.unet
+    try:
+        compiled = torch.compile(unet)
+        # Compilation is lazy, so run one guided UNet step now; otherwise failures
+        # would only surface in the middle of the first generation
+        config = unet.config
+        sample = torch.randn(2, config.in_channels, config.sample_size, config.sample_size, dtype=unet.dtype)
+        context = torch.randn(2, pipe.tokenizer.model_max_length, config.cross_attention_dim, dtype=unet.dtype)
+        with torch.no_grad():
+            compiled(sample, 999, encoder_hidden_states=context)
+    except Exception as e:
+        logging.warning(f"torch.compile failed, running the UNet eagerly: {e}")
+        return False
+    pipe.unet = compiled
+    return True
+
+def apply_cpu_profile(pipe, profile: str = DEFAULT_PROFILE):
+    settings = PROFILES[profile]
+    configure_threads()
+    if settings['channels_last']:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+    if settings['sdpa']:
+        if AttnProcessor2_0 is not None and hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+            pipe.unet.set_attn_processor(AttnProcessor2_0())
+        else:
+            logging.warning("SDPA attention needs torch>=2.0, keeping default attention")
+    else:
+        pipe.enable_attention_slicing()
+    if settings['compile'] or os.environ.get('SD_TORCH_COMPILE') == '1':
+        compile_unet(pipe)
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+def load_cpu_pipeline(model_id: str, profile: str = DEFAULT_PROFILE, **kwargs) -> StableDiffusionPipeline:
+    dtype = profile_dtype(profile)
+    quantize = PROFILES[profile]['quantize']
+    if quantize:
+        # Components quantized by an earlier run replace their fp32 checkpoints
+        kwargs = {**load_quantized_components(model_id, model_cache_dir=kwargs.get('cache_dir')), **kwargs}
+    pipe = StableDiffusionPipeline.from_pretrained(
+        model_id,
+        torch_dtype=dtype,
+        safety_checker=None,
+        **kwargs
+    )
+    pipe = pipe.to("cpu")
+    if quantize:
+        quantize_pipeline(pipe, model_id)
+    logging.info(f"Loaded {model_id} with CPU profile '{profile}' ({'int8' if quantize else dtype})")
+    return apply_cpu_profile(pipe, profile)
+
+def benchmark_profiles(model_id: str, profiles: Sequence[str] = ('baseline', 'cpu'), steps: int = 10,
+                       prompt: str = "A lighthouse on a cliff at sunset", size: int = 512,
+                       **kwargs) -> List[Dict]:
+    results = []
+    for profile in profiles:
+        pipe = load_cpu_pipeline(model_id, profile, **kwargs)
+        with torch.inference_mode():
+            # Warm-up absorbs one-off costs: weight reordering, compilation, allocator growth
+            pipe(prompt, num_inference_steps=2, height=size, width=size)
+            start_time = time.time()
+            pipe(prompt, num_inference_steps=steps, height=size, width=size)
+            elapsed = time.time() - start_time
+        results.append({
+            'profile': profile,
+            'dtype': 'int8' if getattr(pipe, 'quantized', False) else str(pipe.unet.dtype).replace('torch.', ''),
+            'threads': torch.get_num_threads(),
+            'seconds_per_step': elapsed / steps,
+            'total_seconds': elapsed
+        })
+        del pipe
+    return results
+
+def main():
+    model_id = sys.argv[1] if len(sys.argv) > 1 else "runwayml/stable-diffusion-v1-5"
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print(f"⏱️ Benchmarking CPU profiles for {model_id} ({steps} steps)")
+    for result in benchmark_profiles(model_id, tuple(PROFILES), steps, cache_dir="model_cache"):
+        print(f"  {result['profile']:<14} {result['dtype']:<9} {result['seconds_per_step']:.2f} s/step "
+              f"({result['total_seconds']:.1f}s total, {result['threads']} threads)")
+
+if __name__ == "__main__":
+    main()
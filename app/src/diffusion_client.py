@@ -0,0 +1,105 @@
+import base64
+import io
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+import requests
+from PIL import Image
+
+from batch_generation import GenerationRequest
+from generation_queue import DONE, FAILED, GenerationJob
+
+DIFFUSION_SERVICE_URL = os.environ.get('DIFFUSION_SERVICE_URL')
+
+def decode_image(data: str) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(data)))
+
+class DiffusionClient:
+    def __init__(self, base_url: str = DIFFUSION_SERVICE_URL, model_id: Optional[str] = None, timeout: float = 10.0):
+        self.base_url = base_url.rstrip('/')
+        self.model_id = model_id
+        self.timeout = timeout
+        # Queue positions from the latest status of each job, saves a second round trip
+        self._positions: Dict[str, int] = {}
+
+    def is_available(self) -> bool:
+        try:
+            return requests.get(f"{self.base_url}/health", timeout=2).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def _payload(self, request: GenerationRequest) -> Dict:
+        return {'model': self.model_id, **request.to_dict()}
+
+    def submit(self, request: GenerationRequest, owner: Optional[str] = None) -> str:
+        # The first request for a model may wait for the service to load it
+        response = requests.post(f"{self.base_url}/generate", json=self._payload(request), timeout=600)
+        response.raise_for_status()
+        return response.json()['id']
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        response = requests.get(f"{self.base_url}/jobs/{job_id}", timeout=self.timeout)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        # Mirrors GenerationQueue.get so the UIs can poll either one
+        status = self.status(job_id)
+        if status is None:
+            return None
+        job = GenerationJob(job_id, GenerationRequest('', steps=status['total_steps']))
+        job.status = status['status']
+        job.step = status['step']
+        job.error = status.get('error')
+        job.images = [decode_image(image) for image in status.get('images', [])]
+        job.preview = decode_image(status['preview']) if status.get('preview') else None
+        self._positions[job_id] = status.get('position', 0)
+        if job.finished:
+            self._positions.pop(job_id, None)
+        return job
+
+    def release(self, job_id: str) -> bool:
+        # Lets the service free a collected job's images instead of waiting for pruning
+        try:
+            return requests.delete(f"{self.base_url}/jobs/{job_id}", timeout=self.timeout).status_code == 200
+        except requests.RequestException as e:
+            logging.warning(f"Could not release generation job {job_id}: {e}")
+            return False
+
+    def position(self, job_id: str) -> int:
+        if job_id in self._positions:
+            return self._positions[job_id]
+        status = self.status(job_id)
+        return status.get('position', 0) if status else 0
+
+    def stats(self) -> Dict:
+        try:
+            health = requests.get(f"{self.base_url}/health", timeout=self.timeout).json()
+        except requests.RequestException as e:
+            logging.warning(f"Diffusion service unreachable: {e}")
+            return {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        models = [model for model in health.get('models', []) if model['model'] == self.model_id]
+        return {key: sum(model.get(key, 0) for model in models) for key in ('queued', 'running', 'done', 'failed')}
+
+    def generate(self, request: GenerationRequest, poll_interval: float = 0.5, timeout: float = 900.0,
+                 on_progress=None) -> List[Image.Image]:
+        job_id = self.submit(request)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = self.get(job_id)
+            if job is None:
+                raise RuntimeError(f"Generation job {job_id} disappeared from the diffusion service")
+            if job.finished:
+                self.release(job_id)
+            if job.status == DONE:
+                return job.images
+            if job.status == FAILED:
+                raise RuntimeError(f"Generation failed: {job.error}")
+            if on_progress:
+                on_progress(job)
+            time.sleep(poll_interval)
+        raise TimeoutError(f"Generation job {job_id} did not finish within {timeout:.0f}s")
@@ -0,0 +1,268 @@
+import base64
+import gc
+import io
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+import torch
+from diffusers import StableDiffusionPipeline
+
+from batch_generation import GenerationRequest
+from cpu_inference import load_cpu_pipeline
+from embedding_cache import PROMPT_EMBEDDINGS
+from result_cache import RESULT_CACHE
+from generation_queue import DONE, GenerationQueue
+from quantization import component_bytes
+
+DEFAULT_MODEL_ID = "runwayml/stable-diffusion-v1-5"
+DEFAULT_HOST = os.environ.get('DIFFUSION_SERVICE_HOST', '127.0.0.1')
+DEFAULT_PORT = int(os.environ.get('DIFFUSION_SERVICE_PORT', '7861'))
+MEMORY_BUDGET_GB = float(os.environ.get('DIFFUSION_MEMORY_BUDGET_GB', '8'))
+# Used for models that have not been loaded yet; an fp32 SD 1.x pipeline is ~4GB
+DEFAULT_MODEL_BYTES = 4 * 1024 ** 3
+
+def encode_image(image) -> str:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def load_pipeline(model_id: str):
+    if not torch.cuda.is_available():
+        return load_cpu_pipeline(model_id, cache_dir="model_cache")
+    pipe = StableDiffusionPipeline.from_pretrained(
+        model_id,
+        torch_dtype=torch.float16,
+        safety_checker=None,
+        cache_dir="model_cache",
+    )
+    return pipe.to("cuda")
+
+def pipeline_bytes(pipe) -> int:
+    return component_bytes(pipe, [name for name, component in pipe.components.items()
+                                  if isinstance(component, torch.nn.Module)])
+
+class LoadedModel:
+    def __init__(self, model_id: str, pipe, size_bytes: int):
+        self.model_id = model_id
+        self.queue = GenerationQueue(pipe)
+        self.size_bytes = size_bytes
+        self.last_used = time.time()
+
+    @property
+    def busy(self) -> bool:
+        stats = self.queue.stats()
+        return bool(stats['queued'] or stats['running'])
+
+class ModelRegistry:
+    def __init__(self, memory_budget_bytes: int = int(MEMORY_BUDGET_GB * 1024 ** 3), loader=load_pipeline,
+                 default_model_bytes: int = DEFAULT_MODEL_BYTES):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loader = loader
+        self.default_model_bytes = default_model_bytes
+        self._models: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        # _lock guards the registry and is never held while a model loads; loads of
+        # the same model are serialized by its own lock
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+    def _loaded_bytes(self) -> int:
+        return sum(model.size_bytes for model in self._models.values())
+
+    def _evict_until(self, needed_bytes: int, keep: Optional[str] = None):
+        # Least recently used first; models with queued or running jobs are never evicted
+        for model_id in list(self._models):
+            if self._loaded_bytes() + needed_bytes <= self.memory_budget_bytes:
+                return
+            model = self._models[model_id]
+            if model_id == keep or model.busy:
+                continue
+            del self._models[model_id]
+            model.queue.close()
+            model.queue.pipe = None
+            gc.collect()
+            logging.info(f"Evicted {model_id} ({model.size_bytes / 1024 ** 3:.1f}GB) from the diffusion service")
+
+    def _load(self, model_id: str) -> LoadedModel:
+        with self._lock:
+            model = self._models.get(model_id)
+            if model is not None:
+                return model
+            load_lock = self._load_locks.setdefault(model_id, threading.Lock())
+        with load_lock:
+            with self._lock:
+                model = self._models.get(model_id)
+                if model is not None:
+                    return model
+                self._evict_until(self.default_model_bytes)
+            pipe = self.loader(model_id)
+            if hasattr(pipe, 'encode_prompt'):
+                PROMPT_EMBEDDINGS.unconditional(pipe)
+            model = LoadedModel(model_id, pipe, pipeline_bytes(pipe))
+            with self._lock:
+                self._models[model_id] = model
+                self._evict_until(0, keep=model_id)
+            logging.info(f"Loaded {model_id} ({model.size_bytes / 1024 ** 3:.1f}GB) into the diffusion service")
+            return model
+
+    def _touch(self, model: LoadedModel) -> bool:
+        # Caller holds _lock; False when the model was evicted after it was loaded
+        if self._models.get(model.model_id) is not model:
+            return False
+        self._models.move_to_end(model.model_id)
+        model.last_used = time.time()
+        return True
+
+    def get(self, model_id: str) -> LoadedModel:
+        while True:
+            model = self._load(model_id)
+            with self._lock:
+                if self._touch(model):
+                    return model
+
+    def submit(self, model_id: str, request: GenerationRequest) -> Tuple[GenerationQueue, str]:
+        # Queued under _lock, so the model counts as busy before any eviction can see it
+        while True:
+            model = self._load(model_id)
+            with self._lock:
+                if self._touch(model):
+                    return model.queue, model.queue.submit(request)
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'memory_budget_bytes': self.memory_budget_bytes,
+                'loaded_bytes': self._loaded_bytes(),
+                'prompt_embeddings': PROMPT_EMBEDDINGS.stats(),
+                'result_cache': RESULT_CACHE.stats(),
+                'models': [{'model': model.model_id, 'size_bytes': model.size_bytes, 'busy': model.busy,
+                            'idle_seconds': time.time() - model.last_used, **model.queue.stats()}
+                           for model in self._models.values()]
+            }
+
+class DiffusionService:
+    def __init__(self, registry: Optional[ModelRegistry] = None, max_jobs: int = 2000):
+        self.registry = registry or ModelRegistry()
+        self.max_jobs = max_jobs
+        self._jobs: "OrderedDict[str, Tuple[GenerationQueue, str]]" = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, model_id: str, request: GenerationRequest) -> str:
+        queue, local_id = self.registry.submit(model_id, request)
+        with self._lock:
+            job_id = f"{next(self._ids)}-{local_id}"
+            self._jobs[job_id] = (queue, local_id)
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return job_id
+
+    def job(self, job_id: str, include_preview: bool = True) -> Optional[Dict]:
+        with self._lock:
+            entry = self._jobs.get(job_id)
+        if entry is None:
+            return None
+        queue, local_id = entry
+        job = queue.get(local_id)
+        if job is None:
+            return None
+        result = job.as_dict()
+        result['id'] = job_id
+        result['position'] = queue.position(local_id)
+        if job.status == DONE:
+            result['images'] = [encode_image(image) for image in job.images]
+        elif include_preview and job.preview is not None:
+            result['preview'] = encode_image(job.preview)
+        return result
+
+    def release(self, job_id: str) -> bool:
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is None or not entry[0].release(entry[1]):
+                return False
+            del self._jobs[job_id]
+            return True
+
+    def wait(self, job_id: str, timeout: float = 600.0) -> Optional[Dict]:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            result = self.job(job_id, include_preview=False)
+            if result is None or result['status'] in ('done', 'failed'):
+                return result
+            time.sleep(0.2)
+        return self.job(job_id, include_preview=False)
+
+def make_handler(service: DiffusionService):
+    class DiffusionRequestHandler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: Dict):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok', **service.registry.status()})
+            elif self.path.startswith('/jobs/'):
+                result = service.job(self.path[len('/jobs/'):])
+                self._send(200 if result else 404, result or {'error': 'unknown job'})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_DELETE(self):
+            if not self.path.startswith('/jobs/'):
+                self._send(404, {'error': 'not found'})
+            elif service.release(self.path[len('/jobs/'):]):
+                self._send(200, {'released': True})
+            else:
+                self._send(409, {'error': 'unknown or unfinished job'})
+
+        def do_POST(self):
+            if self.path.split('?')[0] != '/generate':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                request = GenerationRequest.from_dict(body)
+                job_id = service.submit(body.get('model') or DEFAULT_MODEL_ID, request)
+            except (ValueError, TypeError, KeyError) as e:
+                self._send(400, {'error': str(e)})
+                return
+            except Exception as e:
+                logging.error(f"Error submitting generation: {e}")
+                self._send(500, {'error': str(e)})
+                return
+            if 'wait=1' in self.path:
+                result = service.wait(job_id)
+                # The images are in this response, so nothing is left to collect
+                service.release(job_id)
+                self._send(200, result)
+            else:
+                self._send(202, {'id': job_id})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return DiffusionRequestHandler
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    service = DiffusionService()
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logging.info(f"Diffusion service listening on http://{host}:{port} "
+                 f"(memory budget {service.registry.memory_budget_bytes / 1024 ** 3:.1f}GB)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve()
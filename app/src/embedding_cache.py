@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get('SD_EMBEDDING_CACHE_SIZE', '256'))
+# Optional; when set, embeddings survive restarts and are shared between processes
+EMBEDDING_CACHE_DIR = os.environ.get('SD_EMBEDDING_CACHE_DIR')
+
+def model_key(pipe) -> str:
+    # Dtype and quantization change the embeddings, and SD_EMBEDDING_CACHE_DIR may be shared between profiles
+    name = getattr(pipe, 'name_or_path', None) or pipe.config.get('_name_or_path') or type(pipe).__name__
+    return f"{name}:{'int8' if getattr(pipe, 'quantized', False) else pipe.text_encoder.dtype}"
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+class PromptEmbeddingCache:
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE, cache_dir: Optional[str] = EMBEDDING_CACHE_DIR):
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._entries: "OrderedDict[Tuple[str, str], torch.Tensor]" = OrderedDict()
+        # The unconditional ('') embedding is used by every guided generation, so it is pinned per model
+        self._unconditional: Dict[str, torch.Tensor] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0
+
+    def _disk_path(self, model_id: str, prompt: str) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / _digest(model_id) / f"{_digest(prompt)}.pt"
+
+    def _load(self, model_id: str, prompt: str) -> Optional[torch.Tensor]:
+        path = self._disk_path(model_id, prompt)
+        if path is None or not path.exists():
+            return None
+        try:
+            return torch.load(path, map_location='cpu', weights_only=True)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable prompt embedding {path}: {e}")
+            return None
+
+    def _save(self, model_id: str, prompt: str, embedding: torch.Tensor):
+        path = self._disk_path(model_id, prompt)
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename so a concurrent reader never sees a partial file
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            torch.save(embedding.detach().cpu(), tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.warning(f"Could not persist prompt embedding: {e}")
+
+    def _lookup(self, model_id: str, prompt: str) -> Optional[torch.Tensor]:
+        with self._lock:
+            if prompt == '' and model_id in self._unconditional:
+                self.hits += 1
+                return self._unconditional[model_id]
+            embedding = self._entries.get((model_id, prompt))
+            if embedding is not None:
+                self._entries.move_to_end((model_id, prompt))
+                self.hits += 1
+                return embedding
+        embedding = self._load(model_id, prompt)
+        if embedding is not None:
+            with self._lock:
+                self.disk_hits += 1
+            self._store(model_id, prompt, embedding)
+        return embedding
+
+    def _store(self, model_id: str, prompt: str, embedding: torch.Tensor):
+        with self._lock:
+            if prompt == '':
+                self._unconditional[model_id] = embedding
+                return
+            self._entries[(model_id, prompt)] = embedding
+            self._entries.move_to_end((model_id, prompt))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _encode(self, pipe, prompts: List[str]) -> torch.Tensor:
+        start_time = time.time()
+        with torch.no_grad():
+            embeddings, _ = pipe.encode_prompt(prompts, pipe.device, 1, False)
+        with self._lock:
+            self.misses += len(prompts)
+            self.encode_seconds += time.time() - start_time
+        return embeddings
+
+    def embeddings(self, pipe, prompts: Sequence[str]) -> torch.Tensor:
+        # One [len(prompts), tokens, dim] tensor; all cache misses share one text encoder call
+        model_id = model_key(pipe)
+        found = {prompt: self._lookup(model_id, prompt) for prompt in dict.fromkeys(prompts)}
+        missing = [prompt for prompt, embedding in found.items() if embedding is None]
+        if missing:
+            for prompt, embedding in zip(missing, self._encode(pipe, missing)):
+                # clone() so a cached row does not keep the whole batch tensor alive
+                embedding = embedding.clone()
+                found[prompt] = embedding
+                self._store(model_id, prompt, embedding)
+                self._save(model_id, prompt, embedding)
+        dtype = pipe.text_encoder.dtype
+        return torch.stack([found[prompt] for prompt in prompts]).to(device=pipe.device, dtype=dtype)
+
+    def unconditional(self, pipe) -> torch.Tensor:
+        return self.embeddings(pipe, [''])[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._unconditional.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'encode_seconds': self.encode_seconds
+            }
+
+PROMPT_EMBEDDINGS = PromptEmbeddingCache()
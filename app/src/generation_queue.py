@@ -0,0 +1,199 @@
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional
+
+from batch_generation import MAX_BATCH_IMAGES, GenerationRequest, generate_batch
+
+try:
+    from latent_preview import StepProgress, split_previews
+except ImportError:
+    StepProgress = None
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Finished jobs hold full-resolution images until released or pruned
+MAX_FINISHED_JOBS = 100
+MAX_FINISHED_AGE = 600.0
+
+class GenerationJob:
+    def __init__(self, job_id: str, request: GenerationRequest, owner: Optional[str] = None):
+        self.id = job_id
+        self.request = request
+        self.owner = owner
+        self.status = QUEUED
+        self.images: List = []
+        self.preview = None
+        self.error: Optional[str] = None
+        self.step = 0
+        self.total_steps = request.steps
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    @property
+    def progress(self) -> float:
+        if self.status == DONE:
+            return 1.0
+        return self.step / self.total_steps if self.total_steps else 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'step': self.step,
+            'total_steps': self.total_steps,
+            'progress': self.progress,
+            'error': self.error,
+            'wait_seconds': (self.started_at or time.time()) - self.submitted_at,
+            'run_seconds': (self.finished_at or time.time()) - self.started_at if self.started_at else 0.0
+        }
+
+class GenerationQueue:
+    def __init__(self, pipe, max_batch_images: int = MAX_BATCH_IMAGES, max_finished_jobs: int = MAX_FINISHED_JOBS,
+                 max_finished_age: float = MAX_FINISHED_AGE, run_batch: Optional[Callable] = None):
+        self.pipe = pipe
+        self.max_batch_images = max_batch_images
+        self.max_finished_jobs = max_finished_jobs
+        self.max_finished_age = max_finished_age
+        self._run_batch = run_batch or self._generate
+        self._pending: deque = deque()
+        self._jobs: "OrderedDict[str, GenerationJob]" = OrderedDict()
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+        # Only the worker drives the pipeline; the lock also covers callers that
+        # borrow it outside the queue
+        self.pipe_lock = threading.Lock()
+        self._stop = False
+        self._worker = threading.Thread(target=self._worker_loop, name="generation-worker", daemon=True)
+        self._worker.start()
+
+    def submit(self, request: GenerationRequest, owner: Optional[str] = None) -> str:
+        with self._condition:
+            job = GenerationJob(f"job-{next(self._ids)}", request, owner)
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._condition.notify()
+            self._prune()
+        logging.info(f"Queued generation {job.id} ({len(self._pending)} pending)")
+        return job.id
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def position(self, job_id: str) -> int:
+        # 0 once the job is running or finished, otherwise the number of jobs ahead of it
+        with self._condition:
+            for index, job in enumerate(self._pending):
+                if job.id == job_id:
+                    return index + 1
+            return 0
+
+    def cancel(self, job_id: str) -> bool:
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != QUEUED:
+                return False
+            self._pending.remove(job)
+            job.status = FAILED
+            job.error = 'cancelled'
+            job.finished_at = time.time()
+            return True
+
+    def release(self, job_id: str) -> bool:
+        # Called once the owner has collected a finished job, so its images can be freed
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or not job.finished:
+                return False
+            del self._jobs[job_id]
+            return True
+
+    def stats(self) -> Dict:
+        with self._condition:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in (QUEUED, RUNNING, DONE, FAILED)}
+
+    def _generate(self, requests: List[GenerationRequest], jobs: List[GenerationJob]) -> List[List]:
+        if StepProgress is None:
+            return generate_batch(self.pipe, requests, self.max_batch_images)
+        counts = [request.num_images_per_prompt for request in requests]
+        def on_step(step, total_steps, previews):
+            for job in jobs:
+                job.step = step
+            if previews:
+                for job, preview in zip(jobs, split_previews(previews, counts)):
+                    job.preview = preview
+        progress = StepProgress(requests[0].steps, on_step)
+        results = generate_batch(self.pipe, requests, self.max_batch_images, callback_on_step_end=progress)
+        stats = progress.stats()
+        logging.info(f"{stats['seconds_per_step']:.2f}s/step, {stats['previews']} previews at "
+                     f"{stats['preview_ms']:.1f}ms ({stats['preview_overhead']:.1%} overhead)")
+        return results
+
+    def _next_batch(self) -> List[GenerationJob]:
+        # Oldest job first, joined by any queued jobs that can share its UNet batch
+        first = self._pending.popleft()
+        batch = [first]
+        images = first.request.num_images_per_prompt
+        for job in list(self._pending):
+            count = job.request.num_images_per_prompt
+            if job.request.batch_key() == first.request.batch_key() and images + count <= self.max_batch_images:
+                self._pending.remove(job)
+                batch.append(job)
+                images += count
+        return batch
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stop:
+                    self._condition.wait()
+                if self._stop:
+                    return
+                batch = self._next_batch()
+                started_at = time.time()
+                for job in batch:
+                    job.status = RUNNING
+                    job.started_at = started_at
+            try:
+                with self.pipe_lock:
+                    results = self._run_batch([job.request for job in batch], batch)
+                for job, images in zip(batch, results):
+                    job.images = images
+                    job.status = DONE
+            except Exception as e:
+                logging.error(f"Generation batch of {len(batch)} jobs failed: {e}")
+                for job in batch:
+                    job.error = str(e)
+                    job.status = FAILED
+            finished_at = time.time()
+            with self._condition:
+                for job in batch:
+                    job.finished_at = finished_at
+                self._prune()
+
+    def _prune(self):
+        # Uncollected results go after max_finished_age, or sooner past max_finished_jobs
+        cutoff = time.time() - self.max_finished_age
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        excess = max(0, len(finished) - self.max_finished_jobs)
+        for index, job_id in enumerate(finished):
+            if index < excess or self._jobs[job_id].finished_at < cutoff:
+                del self._jobs[job_id]
+
+    def close(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        self._worker.join()
@@ -0,0 +1,79 @@
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import torch
+from PIL import Image
+
+# Least-squares fit from the 4 SD 1.x/2.x latent channels to RGB; a 64x64 preview
+# of a 512px image costs one tiny matmul instead of a full VAE decode
+LATENT_RGB_FACTORS = torch.tensor([
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+])
+
+PREVIEW_BUDGET = 0.03
+
+def latents_to_preview(latents: torch.Tensor) -> Image.Image:
+    rgb = torch.einsum('chw,cr->hwr', latents.detach().float().cpu(), LATENT_RGB_FACTORS)
+    pixels = ((rgb + 1.0) * 127.5).clamp(0, 255).to(torch.uint8).numpy()
+    return Image.fromarray(pixels)
+
+class StepProgress:
+    def __init__(self, total_steps: int, on_step: Callable[[int, int, Optional[List[Image.Image]]], None],
+                 preview_every: int = 5, preview_budget: float = PREVIEW_BUDGET):
+        self.total_steps = total_steps
+        self.on_step = on_step
+        self.preview_every = max(1, preview_every)
+        self.preview_budget = preview_budget
+        self.step_seconds = 0.0
+        self.preview_seconds = 0.0
+        self.previews = 0
+        self._last_step_at = None
+
+    def __call__(self, pipe, step: int, timestep, callback_kwargs: Dict) -> Dict:
+        # Signature of diffusers' callback_on_step_end; must return callback_kwargs
+        now = time.time()
+        if self._last_step_at is not None:
+            self.step_seconds += now - self._last_step_at
+        step += 1
+        previews = None
+        if step % self.preview_every == 0 and step < self.total_steps and 'latents' in callback_kwargs:
+            start_time = time.time()
+            previews = [latents_to_preview(latents) for latents in callback_kwargs['latents']]
+            self.preview_seconds += time.time() - start_time
+            self.previews += 1
+            self._adapt_interval()
+        self.on_step(step, self.total_steps, previews)
+        # Exclude our own preview and callback time from the measured step time
+        self._last_step_at = time.time()
+        return callback_kwargs
+
+    def _adapt_interval(self):
+        if self.overhead > self.preview_budget:
+            self.preview_every *= 2
+            logging.info(f"Latent previews cost {self.overhead:.1%} of step time, "
+                         f"now previewing every {self.preview_every} steps")
+
+    @property
+    def overhead(self) -> float:
+        return self.preview_seconds / self.step_seconds if self.step_seconds else 0.0
+
+    def stats(self) -> Dict:
+        steps = max(1, self.total_steps - 1)
+        return {
+            'seconds_per_step': self.step_seconds / steps,
+            'preview_ms': 1000 * self.preview_seconds / self.previews if self.previews else 0.0,
+            'previews': self.previews,
+            'preview_overhead': self.overhead
+        }
+
+def split_previews(previews: Sequence[Image.Image], counts: Sequence[int]) -> List[Image.Image]:
+    # First preview of each request in a batch, using the same ordering as generate_batch
+    firsts, offset = [], 0
+    for count in counts:
+        firsts.append(previews[offset] if offset < len(previews) else None)
+        offset += count
+    return firsts
@@ -1,85 +1,328 @@
 import logging
+import os
+import shutil
 import subprocess
 import json
-from typing import Optional
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
-class LocalLLM:
+import requests
+
+from prompt_budget import PromptBudget
+
+SYSTEM_PROMPT = """You are an expert at creating detailed, artistic descriptions for image generation. 
+            Take the user's simple idea and expand it into a rich, vivid description that includes:
+            - Visual details (colors, lighting, composition)
+            - Artistic style suggestions
+            - Atmospheric elements
+            - Technical details for high-quality image generation
+            Keep the enhanced description under {word_limit} words but make it highly detailed and artistic."""
+PROMPT_PREFIX = "{system_prompt}\\n\\nUser request: "
+PROMPT_SUFFIX = "\\n\\nEnhanced description:"
+
+BACKEND_PRIORITY = ['server', 'deepseek', 'llama']
+BACKEND_COMMANDS = {'deepseek': ['deepseek'], 'llama': ['llama', 'llama-cpp']}
+BACKEND_CONCURRENCY = {'server': 4, 'deepseek': 1, 'llama': 1}
+
+_command_probes: Dict[str, bool] = {}
+
+def probe_command(command: str) -> bool:
+    if command not in _command_probes:
+        _command_probes[command] = shutil.which(command) is not None
+    return _command_probes[command]
+
+class BackendStats:
+    def __init__(self, name: str, max_concurrency: int = 1, alpha: float = 0.3):
+        self.name = name
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.queue_timeouts = 0
+        self.in_flight = 0
+        self.last_failure = 0.0
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+
+    def record(self, latency: float, success: bool):
+        with self.lock:
+            self.requests += 1
+            if success:
+                self.latency = latency if self.latency is None else (
+                    self.alpha * latency + (1 - self.alpha) * self.latency
+                )
+            else:
+                self.errors += 1
+                self.last_failure = time.time()
+            self.error_rate = self.alpha * (0.0 if success else 1.0) + (1 - self.alpha) * self.error_rate
+
+    def record_queue_timeout(self):
+        with self.lock:
+            self.queue_timeouts += 1
+
+    def expected_wait(self) -> float:
+        return self.in_flight * (self.latency or 0.0)
+
+    def is_healthy(self, error_rate_threshold: float, retry_after: float) -> bool:
+        if self.error_rate < error_rate_threshold:
+            return True
+        # Give a failing backend another chance once it has been left alone for a while
+        return time.time() - self.last_failure > retry_after
+
+    def as_dict(self) -> Dict:
+        return {
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'requests': self.requests,
+            'errors': self.errors,
+            'queue_timeouts': self.queue_timeouts,
+            'in_flight': self.in_flight
+        }
+
+class TTFTStats:
+    # Running aggregates only; the shared LocalLLM lives for the whole process
     def __init__(self):
-        self.model_type = self._detect_available_model()
+        self.requests = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def record(self, ttft: float):
+        with self.lock:
+            self.requests += 1
+            self.total += ttft
+            self.min = ttft if self.min is None else min(self.min, ttft)
+            self.max = ttft if self.max is None else max(self.max, ttft)
+
+    def as_dict(self) -> Dict:
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'avg_ttft': self.total / self.requests if self.requests else None,
+                'min_ttft': self.min,
+                'max_ttft': self.max
+            }
+
+class LocalLLM:
+    def __init__(self, server_url: Optional[str] = None, budget: Optional[PromptBudget] = None,
+                 queue_delay_threshold: float = 5.0, error_rate_threshold: float = 0.5,
+                 retry_after: float = 60.0):
+        self.server_url = (server_url or os.environ.get('LOCAL_LLM_SERVER_URL', '')).rstrip('/')
+        self.budget = budget or PromptBudget()
+        self.prompt_prefix = PROMPT_PREFIX.format(
+            system_prompt=SYSTEM_PROMPT.format(word_limit=self.budget.word_limit)
+        )
+        self.prefix_cached = False
+        self.ttft_stats = {'cached': TTFTStats(), 'uncached': TTFTStats()}
+        self.queue_delay_threshold = queue_delay_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.retry_after = retry_after
+        self.backends = {
+            name: BackendStats(name, BACKEND_CONCURRENCY[name])
+            for name in self._detect_available_backends()
+        }
+        self.model_type = self._select_backend() or 'fallback'
         logging.info(f"Initialized LocalLLM with model type: {self.model_type}")
 
-    def _detect_available_model(self) -> str:
+    def _detect_available_backends(self) -> List[str]:
+        available = []
+        if self.server_url and self._server_available():
+            self._warm_prefix_cache()
+            available.append('server')
         try:
-            result = subprocess.run(['which', 'deepseek'], capture_output=True, text=True)
-            if result.returncode == 0:
-                return 'deepseek'
-            result = subprocess.run(['which', 'llama'], capture_output=True, text=True)
-            if result.returncode == 0:
-                return 'llama'
-            result = subprocess.run(['which', 'llama-cpp'], capture_output=True, text=True)
-            if result.returncode == 0:
-                return 'llama'
+            for name, commands in BACKEND_COMMANDS.items():
+                if any(probe_command(command) for command in commands):
+                    available.append(name)
         except Exception as e:
             logging.warning(f"Error detecting local models: {e}")
-        return 'fallback'
+        return available
+
+    def _select_backend(self) -> Optional[str]:
+        candidates = [
+            stats for stats in self.backends.values()
+            if stats.is_healthy(self.error_rate_threshold, self.retry_after)
+            and stats.expected_wait() <= self.queue_delay_threshold
+        ]
+        if not candidates:
+            return None
+        # Unmeasured backends go first so every backend gets a latency sample
+        return min(candidates, key=lambda stats: (
+            stats.latency is not None,
+            stats.latency or 0.0,
+            BACKEND_PRIORITY.index(stats.name)
+        )).name
+
+    def _run_backend(self, backend: str, user_prompt: str) -> Optional[str]:
+        handlers = {
+            'server': self._enhance_with_server,
+            'deepseek': self._enhance_with_deepseek,
+            'llama': self._enhance_with_llama
+        }
+        stats = self.backends[backend]
+        with stats.lock:
+            stats.in_flight += 1
+        try:
+            if not stats.slots.acquire(timeout=self.queue_delay_threshold):
+                stats.record_queue_timeout()
+                logging.warning(f"Queueing delay for {backend} exceeded {self.queue_delay_threshold}s")
+                return None
+            try:
+                start_time = time.time()
+                enhanced = handlers[backend](user_prompt)
+                stats.record(time.time() - start_time, bool(enhanced))
+                return enhanced
+            finally:
+                stats.slots.release()
+        finally:
+            with stats.lock:
+                stats.in_flight -= 1
+
+    def get_backend_stats(self) -> Dict:
+        return {name: stats.as_dict() for name, stats in self.backends.items()}
+
+    def _server_available(self) -> bool:
+        try:
+            return requests.get(f"{self.server_url}/health", timeout=2).status_code == 200
+        except Exception as e:
+            logging.warning(f"LLM server not reachable at {self.server_url}: {e}")
+            return False
+
+    def _build_prompt(self, user_prompt: str) -> str:
+        return f"{self.prompt_prefix}{user_prompt}{PROMPT_SUFFIX}"
 
     def enhance_prompt(self, user_prompt: str) -> str:
-        if self.model_type == 'deepseek':
-            return self._enhance_with_deepseek(user_prompt)
-        elif self.model_type == 'llama':
-            return self._enhance_with_llama(user_prompt)
-        else:
-            return self._enhance_fallback(user_prompt)
-
-    def _enhance_with_deepseek(self, user_prompt: str) -> str:
+        return self.enhance_prompt_with_report(user_prompt)[0]
+
+    def enhance_prompt_with_report(self, user_prompt: str) -> Tuple[str, Dict]:
+        # One LocalLLM serves concurrent requests, so per-call details are returned, never kept on self
+        backend = self._select_backend()
+        enhanced = self._run_backend(backend, user_prompt) if backend else None
+        if not enhanced:
+            backend = 'fallback'
+            enhanced = self._enhance_fallback(user_prompt)
+        enhanced, budget_report = self.budget.apply(enhanced)
+        if budget_report['truncated_tokens']:
+            logging.info(f"Enhanced prompt truncated by {budget_report['truncated_tokens']} tokens "
+                         f"to fit the {self.budget.max_tokens}-token text encoder context")
+        return enhanced, dict(budget_report, backend=backend)
+
+    def get_budget_report(self) -> Dict:
+        return dict(self.budget.stats)
+
+    def _warm_prefix_cache(self) -> bool:
+        # Evaluate the fixed system prompt once so the server keeps its KV state;
+        # later requests share this prefix and only the user suffix is processed.
         try:
-            system_prompt = """You are an expert at creating detailed, artistic descriptions for image generation. 
-            Take the user's simple idea and expand it into a rich, vivid description that includes:
-            - Visual details (colors, lighting, composition)
-            - Artistic style suggestions
-            - Atmospheric elements
-            - Technical details for high-quality image generation
-            Keep the enhanced description under 200 words but make it highly detailed and artistic."""
-            full_prompt = f"{system_prompt}\\n\\nUser request: {user_prompt}\\n\\nEnhanced description:"
+            response = requests.post(f"{self.server_url}/completion", json={
+                'prompt': self.prompt_prefix,
+                'n_predict': 0,
+                'cache_prompt': True
+            }, timeout=60)
+            warmed = response.status_code == 200
+        except Exception as e:
+            logging.warning(f"Could not warm LLM prefix cache: {e}")
+            return False
+        # A failed warm-up only affects the calling request, it does not reset the shared flag
+        if warmed:
+            self.prefix_cached = True
+        return warmed
+
+    def _stream_completion(self, full_prompt: str, cache_prompt: bool = True, prefix_cached: bool = False):
+        start_time = time.time()
+        ttft = None
+        chunks = []
+        with requests.post(f"{self.server_url}/completion", json={
+            'prompt': full_prompt,
+            'n_predict': self.budget.llm_max_tokens,
+            'cache_prompt': cache_prompt,
+            'stream': True
+        }, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data: '):
+                    continue
+                data = json.loads(line[len('data: '):])
+                content = data.get('content', '')
+                if content and ttft is None:
+                    ttft = time.time() - start_time
+                chunks.append(content)
+                if data.get('stop'):
+                    break
+                if self.budget.exceeded(''.join(chunks)):
+                    # Anything past the text encoder context is discarded downstream
+                    break
+        if ttft is not None:
+            key = 'cached' if cache_prompt and prefix_cached else 'uncached'
+            self.ttft_stats[key].record(ttft)
+        return ''.join(chunks).strip(), ttft
+
+    def _enhance_with_server(self, user_prompt: str) -> Optional[str]:
+        try:
+            prefix_cached = self.prefix_cached or self._warm_prefix_cache()
+            enhanced, _ = self._stream_completion(self._build_prompt(user_prompt), prefix_cached=prefix_cached)
+            return enhanced or None
+        except Exception as e:
+            logging.error(f"Error with LLM server: {e}")
+            return None
+
+    def measure_prefix_reuse(self, user_prompt: str) -> Dict:
+        if 'server' not in self.backends:
+            return {}
+        full_prompt = self._build_prompt(user_prompt)
+        try:
+            _, uncached = self._stream_completion(full_prompt, cache_prompt=False)
+            prefix_cached = self.prefix_cached or self._warm_prefix_cache()
+            _, cached = self._stream_completion(full_prompt, cache_prompt=True, prefix_cached=prefix_cached)
+        except Exception as e:
+            logging.error(f"Error measuring prefix reuse: {e}")
+            return {}
+        return {
+            'ttft_without_prefix_reuse': uncached,
+            'ttft_with_prefix_reuse': cached,
+            'speedup': (uncached / cached) if uncached and cached else None
+        }
+
+    def get_ttft_report(self) -> Dict:
+        return {key: stats.as_dict() for key, stats in self.ttft_stats.items()}
+
+    def _enhance_with_deepseek(self, user_prompt: str) -> Optional[str]:
+        try:
+            full_prompt = self._build_prompt(user_prompt)
             result = subprocess.run([
                 'deepseek', 'generate', 
                 '--prompt', full_prompt,
-                '--max-tokens', '300'
+                '--max-tokens', str(self.budget.llm_max_tokens)
             ], capture_output=True, text=True, timeout=30)
             if result.returncode == 0:
                 enhanced = result.stdout.strip()
-                return enhanced if enhanced else self._enhance_fallback(user_prompt)
+                return enhanced or None
             else:
                 logging.warning(f"DeepSeek failed: {result.stderr}")
-                return self._enhance_fallback(user_prompt)
+                return None
         except Exception as e:
             logging.error(f"Error with DeepSeek: {e}")
-            return self._enhance_fallback(user_prompt)
+            return None
 
-    def _enhance_with_llama(self, user_prompt: str) -> str:
+    def _enhance_with_llama(self, user_prompt: str) -> Optional[str]:
         try:
-            system_prompt = """You are an expert at creating detailed, artistic descriptions for image generation. 
-            Take the user's simple idea and expand it into a rich, vivid description that includes:
-            - Visual details (colors, lighting, composition)
-            - Artistic style suggestions
-            - Atmospheric elements
-            - Technical details for high-quality image generation
-            Keep the enhanced description under 200 words but make it highly detailed and artistic."""
-            full_prompt = f"{system_prompt}\\n\\nUser request: {user_prompt}\\n\\nEnhanced description:"
+            full_prompt = self._build_prompt(user_prompt)
             result = subprocess.run([
                 'llama', 'generate', 
                 '--prompt', full_prompt,
-                '--max-tokens', '300'
+                '--max-tokens', str(self.budget.llm_max_tokens)
             ], capture_output=True, text=True, timeout=30)
             if result.returncode == 0:
                 enhanced = result.stdout.strip()
-                return enhanced if enhanced else self._enhance_fallback(user_prompt)
+                return enhanced or None
             else:
                 logging.warning(f"Llama failed: {result.stderr}")
-                return self._enhance_fallback(user_prompt)
+                return None
         except Exception as e:
             logging.error(f"Error with Llama: {e}")
-            return self._enhance_fallback(user_prompt)
+            return None
 
     def _enhance_fallback(self, user_prompt: str) -> str:
         enhancements = {
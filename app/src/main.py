@@ -3,6 +3,7 @@ import os
 import sqlite3
 import json
 import base64
+import io
 from datetime import datetime
 from typing import Dict, List, Optional
 from pathlib import Path
@@ -13,10 +14,17 @@ from openfabric_pysdk.context import AppModel, State
 from core.stub import Stub
 from local_llm import LocalLLM
 from memory_manager import MemoryManager
+from sharded_memory import ShardedMemoryManager
+from batch_generation import GenerationRequest
+from diffusion_client import DIFFUSION_SERVICE_URL, DiffusionClient
 configurations: Dict[str, ConfigClass] = dict()
-memory_manager = MemoryManager()
+# Shards are chosen per session and every request here is stored as 'super-user',
+# so sharding only spreads writes for callers that use several sessions
+MEMORY_SHARDS = int(os.environ.get('MEMORY_SHARDS', '1'))
+memory_manager = ShardedMemoryManager(shards=MEMORY_SHARDS) if MEMORY_SHARDS > 1 else MemoryManager()
 local_llm = LocalLLM()
 OUTPUT_DIR = Path("outputs")
+REUSE_SIMILARITY_THRESHOLD = float(os.environ.get('REUSE_SIMILARITY_THRESHOLD', '0.95'))
 OUTPUT_DIR.mkdir(exist_ok=True)
 (OUTPUT_DIR / "images").mkdir(exist_ok=True)
 (OUTPUT_DIR / "models").mkdir(exist_ok=True)
@@ -30,17 +38,39 @@ def execute(model: AppModel) -> None:
     user_config: ConfigClass = configurations.get('super-user', None)
     logging.info(f"User config: {user_config}")
     app_ids = user_config.app_ids if user_config else []
+    if request.reuse_similar:
+        threshold = request.similarity_threshold or REUSE_SIMILARITY_THRESHOLD
+        match = memory_manager.reuse_similar_prompt(user_prompt, threshold, 'super-user')
+        if match:
+            logging.info(f"Reusing outputs of memory entry {match['id']} (similarity {match['similarity']:.2f})")
+            response: OutputClass = model.response
+            response.message = (
+                f"♻️ Reused a previous generation for a near-identical prompt: '{match['original_prompt']}'\\n"
+                f"📁 Image: {match['image_path']}\\n"
+                f"📁 3D Model: {match['model_path']}"
+            )
+            return
     stub = Stub(app_ids)
     try:
         logging.info("Step 1: Processing user prompt with local LLM...")
-        enhanced_prompt = local_llm.enhance_prompt(user_prompt)
+        enhanced_prompt, enhance_report = local_llm.enhance_prompt_with_report(user_prompt)
         logging.info(f"Enhanced prompt: {enhanced_prompt}")
         logging.info("Step 2: Generating image from text...")
-        text_to_image_app_id = "f0997a01-d6d3-a5fe-53d8-561300318557.node3.openfabric.network"
-        image_result = stub.call(text_to_image_app_id, {
-            'prompt': enhanced_prompt
-        }, 'super-user')
-        image_data = image_result.get('result')
+        seed = None
+        if DIFFUSION_SERVICE_URL:
+            # Local stand-in for the remote text-to-image app, sharing the UIs' loaded model
+            image_request = GenerationRequest(enhanced_prompt)
+            seed = image_request.seed
+            images = DiffusionClient(DIFFUSION_SERVICE_URL).generate(image_request)
+            buffer = io.BytesIO()
+            images[0].save(buffer, format="PNG")
+            image_data = base64.b64encode(buffer.getvalue()).decode('ascii')
+        else:
+            text_to_image_app_id = "f0997a01-d6d3-a5fe-53d8-561300318557.node3.openfabric.network"
+            image_result = stub.call(text_to_image_app_id, {
+                'prompt': enhanced_prompt
+            }, 'super-user')
+            image_data = image_result.get('result')
         if image_data:
             image_filename = f"image_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
             image_path = OUTPUT_DIR / "images" / image_filename
@@ -78,7 +108,12 @@ def execute(model: AppModel) -> None:
             'enhanced_prompt': enhanced_prompt,
             'image_path': str(image_path),
             'model_path': str(model_path),
-            'session_id': 'super-user'
+            'session_id': 'super-user',
+            'metadata': {
+                'enhancer': enhance_report['backend'],
+                'truncated_tokens': enhance_report['truncated_tokens'],
+                'seed': seed
+            }
         }
         memory_manager.store_memory(memory_entry)
         response: OutputClass = model.response
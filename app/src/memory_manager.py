@@ -1,19 +1,312 @@
+import atexit
+import hashlib
 import logging
+import queue
+import re
 import sqlite3
 import json
+import threading
+import time
+import zlib
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 from pathlib import Path
 
+from memory_row import MemoryRow
+from prompt_signature import simhash, simhash_bands, similarity
+from session_memory import SessionMemory
+from sqlite_pool import SQLitePool
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import numpy as np
+    from semantic_index import SemanticIndex, TextEmbedder
+except ImportError:
+    SemanticIndex = None
+
+# Enhanced prompts are interned in prompt_texts, zlib-compressed when that is smaller;
+# rows written before the migration, or inserted by other SQLite clients, carry the text inline
+ENHANCED_BODY_SQL = '''COALESCE(
+    (SELECT body FROM prompt_texts WHERE id = {alias}enhanced_prompt_id), {alias}enhanced_prompt)'''
+
+# Only for queries on connections set up by register_memory_functions; schema
+# objects must stay free of app functions so any SQLite client can use them
+ENHANCED_PROMPT_SQL = f'inflate({ENHANCED_BODY_SQL})'
+
+INSERT_MEMORY_SQL = '''
+    INSERT INTO memory 
+    (timestamp, session_id, original_prompt, enhanced_prompt, enhanced_prompt_id, image_path, model_path,
+     metadata, prompt_simhash)
+    VALUES (?, ?, ?, '', (SELECT id FROM prompt_texts WHERE hash = ?), ?, ?, ?, ?)
+'''
+
+IMPORT_MEMORY_SQL = '''
+    INSERT INTO memory 
+    (timestamp, session_id, original_prompt, enhanced_prompt, enhanced_prompt_id, image_path, model_path,
+     metadata, prompt_simhash, created_at)
+    VALUES (?, ?, ?, '', (SELECT id FROM prompt_texts WHERE hash = ?), ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+'''
+
+INTERN_PROMPT_SQL = 'INSERT OR IGNORE INTO prompt_texts (hash, body) VALUES (?, ?)'
+
+PROMPT_COMPRESSION_MIN_BYTES = 64
+
+PROMPT_TEXT_STATEMENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS prompt_texts (
+        id INTEGER PRIMARY KEY,
+        hash BLOB NOT NULL UNIQUE,
+        body NOT NULL
+    )
+    ''',
+    # enhanced_prompt is text, or a zlib BLOB that inflate() decodes
+    f'''
+    CREATE VIEW IF NOT EXISTS memory_content AS
+    SELECT id, timestamp, session_id, original_prompt, {ENHANCED_BODY_SQL.format(alias='')} AS enhanced_prompt,
+           image_path, model_path, metadata, created_at
+    FROM memory
+    '''
+]
+
+EXPORT_COLUMNS = ('timestamp', 'session_id', 'original_prompt', 'enhanced_prompt',
+                  'image_path', 'model_path', 'metadata', 'created_at')
+
+INSERT_FTS_SQL = 'INSERT INTO memory_fts(rowid, original_prompt, enhanced_prompt) VALUES (?, ?, ?)'
+
+# memory_fts keeps its own plain-text copy, so these triggers need no app functions.
+# Interned rows are indexed by _insert_rows; inline rows come from other clients
+FTS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_fts_insert AFTER INSERT ON memory
+    WHEN new.enhanced_prompt_id IS NULL BEGIN
+        INSERT INTO memory_fts(rowid, original_prompt, enhanced_prompt)
+        VALUES (new.id, new.original_prompt, new.enhanced_prompt);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_fts_delete AFTER DELETE ON memory BEGIN
+        DELETE FROM memory_fts WHERE rowid = old.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_fts_update AFTER UPDATE OF original_prompt, enhanced_prompt ON memory BEGIN
+        UPDATE memory_fts SET
+            original_prompt = new.original_prompt,
+            enhanced_prompt = CASE WHEN new.enhanced_prompt_id IS NULL THEN new.enhanced_prompt ELSE enhanced_prompt END
+        WHERE rowid = new.id;
+    END
+    '''
+]
+
+STATS_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS memory_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS memory_session_counts (
+        session_id TEXT PRIMARY KEY,
+        entries INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS memory_hourly (
+        hour TEXT PRIMARY KEY,
+        entries INTEGER NOT NULL
+    )
+    '''
+]
+
+STATS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_stats_insert AFTER INSERT ON memory BEGIN
+        INSERT INTO memory_counters(name, value) VALUES ('total_entries', 1)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        INSERT INTO memory_counters(name, value)
+        SELECT 'unique_sessions', 1
+        WHERE NOT EXISTS (SELECT 1 FROM memory_session_counts WHERE session_id = new.session_id)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        INSERT INTO memory_session_counts(session_id, entries) VALUES (new.session_id, 1)
+        ON CONFLICT(session_id) DO UPDATE SET entries = entries + 1;
+        INSERT INTO memory_hourly(hour, entries) VALUES (strftime('%Y-%m-%d %H:00:00', new.created_at), 1)
+        ON CONFLICT(hour) DO UPDATE SET entries = entries + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_stats_delete AFTER DELETE ON memory BEGIN
+        UPDATE memory_counters SET value = value - 1 WHERE name = 'total_entries';
+        UPDATE memory_session_counts SET entries = entries - 1 WHERE session_id = old.session_id;
+        UPDATE memory_counters SET value = value - 1
+        WHERE name = 'unique_sessions'
+        AND EXISTS (SELECT 1 FROM memory_session_counts WHERE session_id = old.session_id AND entries = 0);
+        DELETE FROM memory_session_counts WHERE session_id = old.session_id AND entries = 0;
+        UPDATE memory_hourly SET entries = entries - 1
+        WHERE hour = strftime('%Y-%m-%d %H:00:00', old.created_at);
+        DELETE FROM memory_hourly
+        WHERE hour = strftime('%Y-%m-%d %H:00:00', old.created_at) AND entries = 0;
+    END
+    '''
+]
+
+EMBEDDING_STATEMENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS memory_embeddings (
+        memory_id INTEGER PRIMARY KEY,
+        model TEXT NOT NULL,
+        vector BLOB NOT NULL
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_embeddings_delete AFTER DELETE ON memory BEGIN
+        DELETE FROM memory_embeddings WHERE memory_id = old.id;
+    END
+    '''
+]
+
+SIMHASH_STATEMENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS memory_simhash_bands (
+        band INTEGER NOT NULL,
+        value INTEGER NOT NULL,
+        memory_id INTEGER NOT NULL,
+        PRIMARY KEY (band, value, memory_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_simhash_insert AFTER INSERT ON memory
+    WHEN new.prompt_simhash IS NOT NULL BEGIN
+        INSERT OR IGNORE INTO memory_simhash_bands(band, value, memory_id) VALUES
+            (0, new.prompt_simhash & 65535, new.id),
+            (1, (new.prompt_simhash >> 16) & 65535, new.id),
+            (2, (new.prompt_simhash >> 32) & 65535, new.id),
+            (3, (new.prompt_simhash >> 48) & 65535, new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_simhash_update AFTER UPDATE OF prompt_simhash ON memory BEGIN
+        DELETE FROM memory_simhash_bands WHERE memory_id = old.id;
+        INSERT OR IGNORE INTO memory_simhash_bands(band, value, memory_id)
+        SELECT 0, new.prompt_simhash & 65535, new.id WHERE new.prompt_simhash IS NOT NULL
+        UNION ALL SELECT 1, (new.prompt_simhash >> 16) & 65535, new.id WHERE new.prompt_simhash IS NOT NULL
+        UNION ALL SELECT 2, (new.prompt_simhash >> 32) & 65535, new.id WHERE new.prompt_simhash IS NOT NULL
+        UNION ALL SELECT 3, (new.prompt_simhash >> 48) & 65535, new.id WHERE new.prompt_simhash IS NOT NULL;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS memory_simhash_delete AFTER DELETE ON memory BEGIN
+        DELETE FROM memory_simhash_bands WHERE memory_id = old.id;
+    END
+    ''',
+    # Only rows still missing a hash (old databases, other SQLite clients), so finding them never scans the table
+    'CREATE INDEX IF NOT EXISTS idx_missing_simhash ON memory(id) WHERE prompt_simhash IS NULL'
+]
+
+ARCHIVE_STATEMENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS memory (
+        id INTEGER PRIMARY KEY,
+        timestamp TEXT NOT NULL,
+        session_id TEXT NOT NULL,
+        original_prompt BLOB NOT NULL,
+        enhanced_prompt BLOB NOT NULL,
+        image_path TEXT,
+        model_path TEXT,
+        metadata BLOB,
+        created_at TEXT,
+        prompt_simhash INTEGER
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_created_at_id ON memory(created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_session_created_at_id ON memory(session_id, created_at, id)'
+]
+
+ARCHIVE_COLUMNS = ('id', 'timestamp', 'session_id', 'original_prompt', 'enhanced_prompt',
+                   'image_path', 'model_path', 'metadata', 'created_at', 'prompt_simhash')
+
+ARCHIVE_COMPRESSED_COLUMNS = ('original_prompt', 'enhanced_prompt', 'metadata')
+
+MEMORY_COLUMNS = ('timestamp', 'session_id', 'original_prompt', 'enhanced_prompt',
+                  'image_path', 'model_path', 'metadata', 'created_at', 'id')
+
+DEFAULT_INDEXED_METADATA_KEYS = ('enhancer', 'reused_from')
+
+_METADATA_KEY = re.compile(r'^\w+$')
+
+_FLUSH = object()
+
+# Write-behind batches that hit a locked database are retried with exponential
+# backoff, then re-queued; only errors retrying cannot fix drop entries
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.05
+WRITE_RETRY_MAX_DELAY = 2.0
+
+def _retryable(error: Exception) -> bool:
+    # SQLITE_BUSY/SQLITE_LOCKED after the busy timeout, or no pooled connection free in time
+    if isinstance(error, queue.Empty):
+        return True
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+def compress_text(value: Optional[str]):
+    return zlib.compress(value.encode('utf-8'), 9) if value else value
+
+def inflate(value):
+    # Archived text columns are zlib BLOBs; plain text passes through unchanged
+    return zlib.decompress(value).decode('utf-8') if isinstance(value, bytes) else value
+
+def prompt_digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+def register_memory_functions(conn: sqlite3.Connection):
+    conn.create_function('inflate', 1, inflate, deterministic=True)
+
 class MemoryManager:
-    def __init__(self, db_path: str = "memory.db"):
+    def __init__(self, db_path: str = "memory.db", pool_size: int = 4, write_behind: bool = False,
+                 flush_interval: float = 1.0, flush_batch_size: int = 100,
+                 session_memory: Optional[SessionMemory] = None,
+                 indexed_metadata_keys: Sequence[str] = DEFAULT_INDEXED_METADATA_KEYS,
+                 archive_dir: Optional[str] = None, retention_days: Optional[float] = None,
+                 retention_max_rows: Optional[int] = None, compress_prompts: bool = True):
         self.db_path = db_path
-        self.short_term_memory = {}
+        self.compress_prompts = compress_prompts
+        self.archive_dir = Path(archive_dir) if archive_dir else Path(db_path).parent / "memory_archive"
+        self.retention_days = retention_days
+        self.retention_max_rows = retention_max_rows
+        self.indexed_metadata_keys = [key for key in indexed_metadata_keys if _METADATA_KEY.match(key)]
+        self.short_term_memory = session_memory or SessionMemory()
+        # Incremental auto-vacuum only applies to new databases; existing ones are
+        # converted once by compact_memory(convert=True)
+        self._pool = SQLitePool(db_path, size=pool_size, on_connect=register_memory_functions,
+                                auto_vacuum='INCREMENTAL')
+        self.fts_enabled = False
+        self._embedder = None
+        self._semantic_index = None
+        self._embedded_through = 0
+        self._embedding_lock = threading.Lock()
         self._init_database()
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self._write_queue = queue.Queue()
+        self._writer = None
+        self._writer_stop = threading.Event()
+        self.dropped_writes = 0
+        self.requeued_writes = 0
+        self._dropped_at_flush = 0
+        if write_behind:
+            self._writer = threading.Thread(target=self._writer_loop, name="memory-writer", daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
 
     def _init_database(self):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._pool.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS memory (
@@ -25,170 +318,938 @@ class MemoryManager:
                         image_path TEXT,
                         model_path TEXT,
                         metadata TEXT,
-                        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+                        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                        prompt_simhash INTEGER,
+                        enhanced_prompt_id INTEGER
                     )
                 ''')
+                self._ensure_columns(cursor, {'prompt_simhash': 'INTEGER', 'enhanced_prompt_id': 'INTEGER'})
+                self._init_metadata_columns(cursor)
                 cursor.execute('''
                     CREATE INDEX IF NOT EXISTS idx_session_id ON memory(session_id)
                 ''')
                 cursor.execute('''
                     CREATE INDEX IF NOT EXISTS idx_timestamp ON memory(timestamp)
                 ''')
-                conn.commit()
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_created_at_id ON memory(created_at, id)
+                ''')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_session_created_at_id ON memory(session_id, created_at, id)
+                ''')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_enhanced_prompt_id ON memory(enhanced_prompt_id)
+                ''')
+                # Recreated so databases whose view called inflate() work in any SQLite client
+                cursor.execute('DROP VIEW IF EXISTS memory_content')
+                for statement in PROMPT_TEXT_STATEMENTS:
+                    cursor.execute(statement)
+                self._intern_existing_prompts(cursor)
+                self.fts_enabled = self._init_fts(cursor)
+                self._init_stats(cursor)
+                for statement in EMBEDDING_STATEMENTS + SIMHASH_STATEMENTS:
+                    cursor.execute(statement)
+                self._backfill_simhashes(cursor)
                 logging.info("Memory database initialized successfully")
         except Exception as e:
             logging.error(f"Error initializing database: {e}")
 
+    def _ensure_columns(self, cursor, columns: Dict[str, str]):
+        cursor.execute('PRAGMA table_xinfo(memory)')
+        existing = {row[1] for row in cursor.fetchall()}
+        for name, definition in columns.items():
+            if name not in existing:
+                cursor.execute(f'ALTER TABLE memory ADD COLUMN {name} {definition}')
+                logging.info(f"Added column {name} to memory table")
+
+    def _init_metadata_columns(self, cursor):
+        # Virtual JSON1 columns cost no storage and let hot metadata filters use an index
+        for key in self.indexed_metadata_keys:
+            self._ensure_columns(cursor, {
+                f'meta_{key}': f"GENERATED ALWAYS AS (json_extract(metadata, '$.{key}')) VIRTUAL"
+            })
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_meta_{key} ON memory(meta_{key})')
+
+    def _backfill_simhashes(self, cursor, batch_size: int = 1000):
+        last_id = 0
+        while True:
+            cursor.execute('''
+                SELECT id, original_prompt FROM memory
+                WHERE id > ? AND prompt_simhash IS NULL
+                ORDER BY id LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            cursor.executemany('UPDATE memory SET prompt_simhash = ? WHERE id = ?',
+                               [(simhash(prompt), memory_id) for memory_id, prompt in rows])
+            last_id = rows[-1][0]
+
+    def _encode_prompt(self, text: str):
+        data = text.encode('utf-8')
+        if self.compress_prompts and len(data) >= PROMPT_COMPRESSION_MIN_BYTES:
+            compressed = zlib.compress(data, 6)
+            if len(compressed) < len(data):
+                return compressed
+        return text
+
+    def _intern_prompts(self, conn, texts: Iterable[str]) -> List[bytes]:
+        digests = []
+        bodies = {}
+        for text in texts:
+            digest = prompt_digest(text or '')
+            digests.append(digest)
+            if digest not in bodies:
+                bodies[digest] = text or ''
+        conn.executemany(INTERN_PROMPT_SQL, [(digest, self._encode_prompt(text)) for digest, text in bodies.items()])
+        return digests
+
+    def _insert_rows(self, conn, rows: List[tuple], sql: str = INSERT_MEMORY_SQL):
+        digests = self._intern_prompts(conn, [row[3] for row in rows])
+        values = [row[:3] + (digest,) + row[4:] for row, digest in zip(rows, digests)]
+        if not self.fts_enabled:
+            conn.executemany(sql, values)
+            return
+        ids = [conn.execute(sql, row_values).lastrowid for row_values in values]
+        conn.executemany(INSERT_FTS_SQL, [(memory_id, row[2], row[3] or '')
+                                          for memory_id, row in zip(ids, rows)])
+
+    def _intern_existing_prompts(self, cursor, batch_size: int = 1000):
+        # Migrates databases that stored enhanced_prompt inline in every row
+        last_id = 0
+        migrated = 0
+        while True:
+            cursor.execute('''
+                SELECT id, enhanced_prompt FROM memory
+                WHERE id > ? AND enhanced_prompt_id IS NULL
+                ORDER BY id LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            digests = self._intern_prompts(cursor, [text for _, text in rows])
+            cursor.executemany('''
+                UPDATE memory SET enhanced_prompt_id = (SELECT id FROM prompt_texts WHERE hash = ?),
+                                  enhanced_prompt = ''
+                WHERE id = ?
+            ''', [(digest, memory_id) for (memory_id, _), digest in zip(rows, digests)])
+            last_id = rows[-1][0]
+            migrated += len(rows)
+        if migrated:
+            logging.info(f"Interned enhanced prompts of {migrated} memory entries")
+
+    def _purge_prompt_texts(self, conn):
+        conn.execute('''
+            DELETE FROM prompt_texts
+            WHERE NOT EXISTS (SELECT 1 FROM memory WHERE enhanced_prompt_id = prompt_texts.id)
+        ''')
+
+    def _init_fts(self, cursor) -> bool:
+        try:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'memory_fts'")
+            existing = cursor.fetchone()
+            if existing and 'content=' in existing[0]:
+                # External-content tables need the old values, and so app functions, in their triggers
+                for trigger in ('memory_fts_insert', 'memory_fts_delete', 'memory_fts_update'):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+                cursor.execute('DROP TABLE memory_fts')
+                existing = None
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5(
+                    original_prompt,
+                    enhanced_prompt,
+                    tokenize='porter unicode61'
+                )
+            ''')
+            for trigger in FTS_TRIGGERS:
+                cursor.execute(trigger)
+            if not existing:
+                # Index rows written before the full-text table existed
+                self._populate_fts(cursor)
+            return True
+        except sqlite3.OperationalError as e:
+            logging.warning(f"FTS5 unavailable, memory search will scan the table: {e}")
+            return False
+
+    def _populate_fts(self, cursor, batch_size: int = 1000):
+        last_id = 0
+        while True:
+            cursor.execute(f'''
+                SELECT id, original_prompt, {self._column('enhanced_prompt')} FROM memory
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            cursor.executemany(INSERT_FTS_SQL, rows)
+            last_id = rows[-1][0]
+
+    def _init_stats(self, cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'memory_counters'")
+        exists = cursor.fetchone() is not None
+        for statement in STATS_TABLES + STATS_TRIGGERS:
+            cursor.execute(statement)
+        if not exists:
+            self._rebuild_stats(cursor)
+
+    def _rebuild_stats(self, cursor):
+        cursor.execute('DELETE FROM memory_counters')
+        cursor.execute('DELETE FROM memory_session_counts')
+        cursor.execute('DELETE FROM memory_hourly')
+        cursor.execute('''
+            INSERT INTO memory_session_counts(session_id, entries)
+            SELECT session_id, COUNT(*) FROM memory GROUP BY session_id
+        ''')
+        cursor.execute('''
+            INSERT INTO memory_hourly(hour, entries)
+            SELECT strftime('%Y-%m-%d %H:00:00', created_at), COUNT(*) FROM memory GROUP BY 1
+        ''')
+        cursor.execute('''
+            INSERT INTO memory_counters(name, value)
+            SELECT 'total_entries', COALESCE(SUM(entries), 0) FROM memory_session_counts
+            UNION ALL
+            SELECT 'unique_sessions', COUNT(*) FROM memory_session_counts
+        ''')
+
+    def rebuild_stats(self) -> bool:
+        try:
+            with self._pool.transaction() as conn:
+                self._rebuild_stats(conn.cursor())
+            return True
+        except Exception as e:
+            logging.error(f"Error rebuilding memory stats: {e}")
+            return False
+
     def store_memory(self, memory_entry: Dict) -> bool:
         try:
             session_id = memory_entry.get('session_id', 'default')
-            if session_id not in self.short_term_memory:
-                self.short_term_memory[session_id] = []
-            self.short_term_memory[session_id].append(memory_entry)
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO memory 
-                    (timestamp, session_id, original_prompt, enhanced_prompt, image_path, model_path, metadata)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    memory_entry.get('timestamp'),
-                    memory_entry.get('session_id'),
-                    memory_entry.get('original_prompt'),
-                    memory_entry.get('enhanced_prompt'),
-                    memory_entry.get('image_path'),
-                    memory_entry.get('model_path'),
-                    json.dumps(memory_entry.get('metadata', {}))
-                ))
-                conn.commit()
+            self.short_term_memory.append(session_id, memory_entry)
+            row = self._memory_row(memory_entry)
+            if self._writer is not None:
+                self._write_queue.put(row)
+                logging.info(f"Memory queued for session: {session_id}")
+                return True
+            with self._pool.transaction() as conn:
+                self._insert_rows(conn, [row])
             logging.info(f"Memory stored successfully for session: {session_id}")
             return True
         except Exception as e:
             logging.error(f"Error storing memory: {e}")
             return False
 
+    def _memory_row(self, memory_entry: Dict) -> tuple:
+        return (
+            memory_entry.get('timestamp'),
+            memory_entry.get('session_id'),
+            memory_entry.get('original_prompt'),
+            memory_entry.get('enhanced_prompt'),
+            memory_entry.get('image_path'),
+            memory_entry.get('model_path'),
+            json.dumps(memory_entry.get('metadata', {})),
+            simhash(memory_entry.get('original_prompt') or '')
+        )
+
+    def _writer_loop(self):
+        while not (self._writer_stop.is_set() and self._write_queue.empty()):
+            batch, markers = self._next_batch()
+            try:
+                if batch:
+                    self._write_batch(batch)
+            finally:
+                for _ in range(len(batch) + markers):
+                    self._write_queue.task_done()
+
+    def _next_batch(self):
+        batch = []
+        markers = 0
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.flush_batch_size:
+            try:
+                item = self._write_queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if item is _FLUSH:
+                markers += 1
+                break
+            batch.append(item)
+        return batch, markers
+
+    def _write_batch(self, batch: List[tuple]):
+        for attempt in range(WRITE_RETRIES):
+            try:
+                with self._pool.transaction() as conn:
+                    self._insert_rows(conn, batch)
+                logging.info(f"Flushed {len(batch)} queued memory entries")
+                return
+            except Exception as e:
+                if not _retryable(e):
+                    logging.error(f"Error flushing {len(batch)} queued memory entries: {e}")
+                    self._write_rows_individually(batch)
+                    return
+                delay = min(WRITE_RETRY_MAX_DELAY, WRITE_RETRY_DELAY * 2 ** attempt)
+                logging.warning(f"Memory database busy, retrying {len(batch)} entries in {delay:.2f}s: {e}")
+                time.sleep(delay)
+        if self._writer_stop.is_set():
+            # Shutting down: re-queueing would keep close() waiting on a database that stays locked
+            self.dropped_writes += len(batch)
+            logging.error(f"Dropped {len(batch)} queued memory entries, database still locked at shutdown")
+            return
+        for row in batch:
+            self._write_queue.put(row)
+        self.requeued_writes += len(batch)
+        logging.warning(f"Re-queued {len(batch)} memory entries after {WRITE_RETRIES} busy retries")
+
+    def _write_rows_individually(self, batch: List[tuple]):
+        # One bad entry must not take the rest of its batch down with it
+        for row in batch:
+            try:
+                with self._pool.transaction() as conn:
+                    self._insert_rows(conn, [row])
+            except Exception as e:
+                self.dropped_writes += 1
+                logging.error(f"Dropped queued memory entry for session {row[1]}: {e}")
+
+    def flush(self) -> bool:
+        # False when entries were dropped since the previous flush
+        if self._writer is not None and self._writer.is_alive():
+            self._write_queue.put(_FLUSH)
+            self._write_queue.join()
+        flushed = self.dropped_writes == self._dropped_at_flush
+        self._dropped_at_flush = self.dropped_writes
+        return flushed
+
     def get_session_memory(self, session_id: str, limit: int = 10) -> List[Dict]:
-        session_memory = self.short_term_memory.get(session_id, [])
-        return session_memory[-limit:] if limit > 0 else session_memory
+        return self.short_term_memory.get(session_id, limit)
+
+    def get_long_term_memory(self, session_id: Optional[str] = None, limit: int = 20,
+                             columns: Optional[Sequence[str]] = None,
+                             metadata_filter: Optional[Dict] = None) -> List[MemoryRow]:
+        return self.get_memory_page(session_id=session_id, limit=limit, columns=columns,
+                                    metadata_filter=metadata_filter)['entries']
+
+    def _projection(self, columns: Optional[Sequence[str]]) -> Tuple[str, ...]:
+        if not columns:
+            return MEMORY_COLUMNS
+        unknown = set(columns) - set(MEMORY_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown memory columns: {sorted(unknown)}")
+        # id and created_at are always needed for cursors and result bookkeeping
+        return tuple(columns) + tuple(column for column in ('created_at', 'id') if column not in columns)
+
+    def _column(self, column: str, alias: str = '') -> str:
+        if column == 'enhanced_prompt':
+            return ENHANCED_PROMPT_SQL.format(alias=alias)
+        return f'{alias}{column}'
+
+    def _select(self, columns: Tuple[str, ...], alias: str = '') -> str:
+        return ', '.join(self._column(column, alias) for column in columns)
 
-    def get_long_term_memory(self, session_id: Optional[str] = None, limit: int = 20) -> List[Dict]:
+    def _metadata_conditions(self, metadata_filter: Optional[Dict]) -> Tuple[List[str], List]:
+        conditions = []
+        params = []
+        for key, value in (metadata_filter or {}).items():
+            if not _METADATA_KEY.match(key):
+                raise ValueError(f"Invalid metadata key: {key}")
+            if key in self.indexed_metadata_keys:
+                conditions.append(f'meta_{key} = ?')
+            else:
+                conditions.append(f"json_extract(metadata, '$.{key}') = ?")
+            params.append(value)
+        return conditions, params
+
+    def _fetch_page(self, conn, session_id: Optional[str], limit: int,
+                    cursor: Optional[Tuple[str, int]], ascending: bool,
+                    columns: Tuple[str, ...] = MEMORY_COLUMNS,
+                    metadata_filter: Optional[Dict] = None) -> List[MemoryRow]:
+        conditions, params = self._metadata_conditions(metadata_filter)
+        if session_id:
+            conditions.append('session_id = ?')
+            params.append(session_id)
+        if cursor:
+            conditions.append(f"(created_at, id) {'>' if ascending else '<'} (?, ?)")
+            params.extend(cursor)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        direction = 'ASC' if ascending else 'DESC'
+        rows = conn.execute(f'''
+            SELECT {self._select(columns)}
+            FROM memory
+            {where}
+            ORDER BY created_at {direction}, id {direction}
+            LIMIT ?
+        ''', (*params, limit)).fetchall()
+        return [MemoryRow(columns, row) for row in rows]
+
+    def get_memory_page(self, session_id: Optional[str] = None, limit: int = 20,
+                        cursor: Optional[Tuple[str, int]] = None, ascending: bool = False,
+                        columns: Optional[Sequence[str]] = None,
+                        metadata_filter: Optional[Dict] = None) -> Dict:
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            projection = self._projection(columns)
+            with self._pool.connection() as conn:
+                entries = self._fetch_page(conn, session_id, limit, cursor, ascending,
+                                           projection, metadata_filter)
+            next_cursor = (entries[-1]['created_at'], entries[-1]['id']) if len(entries) == limit else None
+            return {'entries': entries, 'next_cursor': next_cursor}
+        except Exception as e:
+            logging.error(f"Error retrieving long-term memory: {e}")
+            return {'entries': [], 'next_cursor': None}
+
+    def iter_memory(self, session_id: Optional[str] = None, batch_size: int = 500,
+                    cursor: Optional[Tuple[str, int]] = None, ascending: bool = False,
+                    columns: Optional[Sequence[str]] = None,
+                    metadata_filter: Optional[Dict] = None) -> Iterator[MemoryRow]:
+        projection = self._projection(columns)
+        while True:
+            # Each page checks a connection out only for its own query, so a slow
+            # consumer never pins a pooled connection
+            with self._pool.connection() as conn:
+                entries = self._fetch_page(conn, session_id, batch_size, cursor, ascending,
+                                           projection, metadata_filter)
+            yield from entries
+            if len(entries) < batch_size:
+                return
+            cursor = (entries[-1]['created_at'], entries[-1]['id'])
+
+    def _fts_query(self, query: str) -> str:
+        # Quote every term so user input cannot inject FTS syntax, and prefix-match it
+        terms = re.findall(r'\w+', query)
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def search_memory(self, query: str, session_id: Optional[str] = None, limit: int = 10,
+                      mode: str = 'keyword', columns: Optional[Sequence[str]] = None) -> List[MemoryRow]:
+        projection = self._projection(columns)
+        if mode == 'semantic':
+            if SemanticIndex is not None:
+                return self._search_memory_semantic(query, session_id, limit, projection)
+            logging.warning("numpy not installed, falling back to keyword memory search")
+        fts_query = self._fts_query(query)
+        if not (self.fts_enabled and fts_query):
+            return self._search_memory_like(query, session_id, limit, projection)
+        try:
+            with self._pool.connection() as conn:
                 cursor = conn.cursor()
-                if session_id:
-                    cursor.execute('''
-                        SELECT timestamp, session_id, original_prompt, enhanced_prompt, 
-                               image_path, model_path, metadata, created_at
-                        FROM memory 
-                        WHERE session_id = ?
-                        ORDER BY created_at DESC
-                        LIMIT ?
-                    ''', (session_id, limit))
-                else:
-                    cursor.execute('''
-                        SELECT timestamp, session_id, original_prompt, enhanced_prompt, 
-                               image_path, model_path, metadata, created_at
-                        FROM memory 
-                        ORDER BY created_at DESC
-                        LIMIT ?
-                    ''', (limit,))
-                rows = cursor.fetchall()
+                session_filter = 'AND m.session_id = ?' if session_id else ''
+                params = (fts_query, session_id, limit) if session_id else (fts_query, limit)
+                cursor.execute(f'''
+                    SELECT {self._select(projection, 'm.')},
+                           snippet(memory_fts, -1, '**', '**', '...', 16), memory_fts.rank
+                    FROM memory_fts
+                    JOIN memory m ON m.id = memory_fts.rowid
+                    WHERE memory_fts MATCH ? {session_filter}
+                    ORDER BY memory_fts.rank
+                    LIMIT ?
+                ''', params)
                 memory_entries = []
-                for row in rows:
-                    memory_entries.append({
-                        'timestamp': row[0],
-                        'session_id': row[1],
-                        'original_prompt': row[2],
-                        'enhanced_prompt': row[3],
-                        'image_path': row[4],
-                        'model_path': row[5],
-                        'metadata': json.loads(row[6]) if row[6] else {},
-                        'created_at': row[7]
-                    })
+                for row in cursor.fetchall():
+                    entry = MemoryRow(projection, row[:-2])
+                    entry['snippet'] = row[-2]
+                    entry['score'] = -row[-1]
+                    memory_entries.append(entry)
                 return memory_entries
         except Exception as e:
-            logging.error(f"Error retrieving long-term memory: {e}")
+            logging.error(f"Error searching memory: {e}")
+            return []
+
+    def _fill_missing_simhashes(self):
+        with self._pool.connection() as conn:
+            missing = conn.execute('SELECT 1 FROM memory WHERE prompt_simhash IS NULL LIMIT 1').fetchone()
+        if missing:
+            with self._pool.transaction() as conn:
+                self._backfill_simhashes(conn.cursor())
+
+    def find_similar_prompt(self, prompt: str, threshold: float = 0.95,
+                            session_id: Optional[str] = None) -> Optional[Dict]:
+        try:
+            # Rows inserted by other SQLite clients have no hash yet
+            self._fill_missing_simhashes()
+            signature = simhash(prompt)
+            bands = simhash_bands(signature)
+            session_filter = 'AND session_id = ?' if session_id else ''
+            with self._pool.connection() as conn:
+                rows = conn.execute(f'''
+                    SELECT {self._select(MEMORY_COLUMNS)}, prompt_simhash FROM memory
+                    WHERE id IN (
+                        SELECT memory_id FROM memory_simhash_bands
+                        WHERE (band = 0 AND value = ?) OR (band = 1 AND value = ?)
+                           OR (band = 2 AND value = ?) OR (band = 3 AND value = ?)
+                    )
+                    AND image_path IS NOT NULL {session_filter}
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT 200
+                ''', (*bands, *([session_id] if session_id else []))).fetchall()
+            best = None
+            for row in rows:
+                score = similarity(signature, row[9])
+                if score < threshold or (best and score <= best['similarity']):
+                    continue
+                if not Path(row[4]).exists() or (row[5] and not Path(row[5]).exists()):
+                    continue
+                best = MemoryRow(MEMORY_COLUMNS, row[:-1])
+                best['similarity'] = score
+            return best
+        except Exception as e:
+            logging.error(f"Error looking up similar prompts: {e}")
+            return None
+
+    def reuse_similar_prompt(self, prompt: str, threshold: float, session_id: str) -> Optional[Dict]:
+        # Records the reuse as a new entry pointing at the matched outputs
+        match = self.find_similar_prompt(prompt, threshold, session_id)
+        if match:
+            self.store_memory({
+                'timestamp': datetime.now().isoformat(),
+                'original_prompt': prompt,
+                'enhanced_prompt': match['enhanced_prompt'],
+                'image_path': match['image_path'],
+                'model_path': match['model_path'],
+                'session_id': session_id,
+                'metadata': {'reused_from': match['id'], 'similarity': match['similarity']}
+            })
+        return match
+
+    def _load_embeddings(self):
+        self._embedder = TextEmbedder()
+        self._semantic_index = SemanticIndex(self._embedder.dim)
+        with self._pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT memory_id, vector FROM memory_embeddings WHERE model = ?
+            ''', (self._embedder.name,))
+            while True:
+                batch = rows.fetchmany(4096)
+                if not batch:
+                    break
+                vectors = np.frombuffer(b''.join(blob for _, blob in batch), dtype=np.float16)
+                self._semantic_index.add([memory_id for memory_id, _ in batch],
+                                         vectors.reshape(len(batch), self._embedder.dim))
+        logging.info(f"Loaded {len(self._semantic_index)} prompt embeddings ({self._embedder.name})")
+
+    def index_embeddings(self, batch_size: int = 256) -> int:
+        with self._embedding_lock:
+            if self._semantic_index is None:
+                self._load_embeddings()
+            indexed = 0
+            while True:
+                with self._pool.connection() as conn:
+                    rows = conn.execute('''
+                        SELECT m.id, m.original_prompt FROM memory m
+                        LEFT JOIN memory_embeddings e ON e.memory_id = m.id AND e.model = ?
+                        WHERE m.id > ? AND e.memory_id IS NULL
+                        ORDER BY m.id
+                        LIMIT ?
+                    ''', (self._embedder.name, self._embedded_through, batch_size)).fetchall()
+                if not rows:
+                    return indexed
+                ids = [memory_id for memory_id, _ in rows]
+                vectors = self._embedder.embed([prompt for _, prompt in rows])
+                with self._pool.transaction() as conn:
+                    conn.executemany('''
+                        INSERT OR REPLACE INTO memory_embeddings (memory_id, model, vector) VALUES (?, ?, ?)
+                    ''', [(memory_id, self._embedder.name, vector.astype(np.float16).tobytes())
+                          for memory_id, vector in zip(ids, vectors)])
+                self._semantic_index.add(ids, vectors)
+                self._embedded_through = ids[-1]
+                indexed += len(ids)
+
+    def _forget_embeddings(self, ids: Sequence[int]):
+        with self._embedding_lock:
+            if self._semantic_index is not None:
+                self._semantic_index.remove(ids)
+
+    def _semantic_candidates(self, query_vector: "np.ndarray", k: int) -> List[Tuple[int, float]]:
+        # index_embeddings swaps the index arrays and _forget_embeddings compacts them,
+        # both under this lock; clear_all_memory drops the index under it too
+        with self._embedding_lock:
+            if self._semantic_index is None:
+                return []
+            return self._semantic_index.search(query_vector, k)
+
+    def _search_memory_semantic(self, query: str, session_id: Optional[str] = None, limit: int = 10,
+                                columns: Tuple[str, ...] = MEMORY_COLUMNS) -> List[MemoryRow]:
+        try:
+            self.index_embeddings()
+            query_vector = self._embedder.embed([query])[0]
+            session_filter = 'AND session_id = ?' if session_id else ''
+            # Over-fetch for the session filter, and widen until enough live rows are found
+            k = limit * 5 if session_id else limit * 2
+            while True:
+                candidates = self._semantic_candidates(query_vector, k)
+                if not candidates:
+                    return []
+                scores = dict(candidates)
+                placeholders = ','.join('?' * len(scores))
+                with self._pool.connection() as conn:
+                    live = {memory_id for memory_id, in conn.execute(
+                        f'SELECT id FROM memory WHERE id IN ({placeholders})', tuple(scores))}
+                    rows = conn.execute(f'''
+                        SELECT {self._select(columns)} FROM memory
+                        WHERE id IN ({placeholders}) {session_filter}
+                    ''', (*scores, *([session_id] if session_id else []))).fetchall()
+                # Rows deleted by another connection since indexing
+                stale = [memory_id for memory_id in scores if memory_id not in live]
+                if stale:
+                    self._forget_embeddings(stale)
+                if len(rows) >= limit or len(candidates) < k:
+                    break
+                k *= 4
+            memory_entries = []
+            for row in rows:
+                entry = MemoryRow(columns, row)
+                entry['score'] = scores[entry['id']]
+                memory_entries.append(entry)
+            memory_entries.sort(key=lambda entry: entry['score'], reverse=True)
+            return memory_entries[:limit]
+        except Exception as e:
+            logging.error(f"Error in semantic memory search: {e}")
             return []
 
-    def search_memory(self, query: str, session_id: Optional[str] = None, limit: int = 10) -> List[Dict]:
+    def _search_memory_like(self, query: str, session_id: Optional[str] = None, limit: int = 10,
+                            columns: Tuple[str, ...] = MEMORY_COLUMNS) -> List[MemoryRow]:
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._pool.connection() as conn:
                 cursor = conn.cursor()
                 if session_id:
-                    cursor.execute('''
-                        SELECT timestamp, session_id, original_prompt, enhanced_prompt, 
-                               image_path, model_path, metadata, created_at
+                    cursor.execute(f'''
+                        SELECT {self._select(columns)}
                         FROM memory 
-                        WHERE session_id = ? AND (original_prompt LIKE ? OR enhanced_prompt LIKE ?)
+                        WHERE session_id = ? AND (original_prompt LIKE ? OR {self._column('enhanced_prompt')} LIKE ?)
                         ORDER BY created_at DESC
                         LIMIT ?
                     ''', (session_id, f'%{query}%', f'%{query}%', limit))
                 else:
-                    cursor.execute('''
-                        SELECT timestamp, session_id, original_prompt, enhanced_prompt, 
-                               image_path, model_path, metadata, created_at
+                    cursor.execute(f'''
+                        SELECT {self._select(columns)}
                         FROM memory 
-                        WHERE original_prompt LIKE ? OR enhanced_prompt LIKE ?
+                        WHERE original_prompt LIKE ? OR {self._column('enhanced_prompt')} LIKE ?
                         ORDER BY created_at DESC
                         LIMIT ?
                     ''', (f'%{query}%', f'%{query}%', limit))
-                rows = cursor.fetchall()
-                memory_entries = []
-                for row in rows:
-                    memory_entries.append({
-                        'timestamp': row[0],
-                        'session_id': row[1],
-                        'original_prompt': row[2],
-                        'enhanced_prompt': row[3],
-                        'image_path': row[4],
-                        'model_path': row[5],
-                        'metadata': json.loads(row[6]) if row[6] else {},
-                        'created_at': row[7]
-                    })
-                return memory_entries
+                return [MemoryRow(columns, row) for row in cursor.fetchall()]
         except Exception as e:
             logging.error(f"Error searching memory: {e}")
             return []
 
     def get_memory_stats(self) -> Dict:
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._pool.connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('SELECT COUNT(*) FROM memory')
-                total_entries = cursor.fetchone()[0]
-                cursor.execute('SELECT COUNT(DISTINCT session_id) FROM memory')
-                unique_sessions = cursor.fetchone()[0]
                 cursor.execute('''
-                    SELECT COUNT(*) FROM memory 
-                    WHERE created_at >= datetime('now', '-1 day')
+                    SELECT name, value FROM memory_counters
+                    WHERE name IN ('total_entries', 'unique_sessions')
+                ''')
+                counters = dict(cursor.fetchall())
+                total_entries = counters.get('total_entries', 0)
+                unique_sessions = counters.get('unique_sessions', 0)
+                cursor.execute('''
+                    SELECT COALESCE(SUM(entries), 0) FROM memory_hourly
+                    WHERE hour >= strftime('%Y-%m-%d %H:00:00', 'now', '-1 day')
                 ''')
                 recent_entries = cursor.fetchone()[0]
                 return {
                     'total_entries': total_entries,
                     'unique_sessions': unique_sessions,
                     'recent_entries_24h': recent_entries,
-                    'active_sessions': len(self.short_term_memory)
+                    'pending_writes': self._write_queue.qsize(),
+                    'dropped_writes': self.dropped_writes,
+                    **self.short_term_memory.stats()
                 }
         except Exception as e:
             logging.error(f"Error getting memory stats: {e}")
             return {}
 
+    def get_activity_timeline(self, hours: int = 24) -> List[Dict]:
+        try:
+            with self._pool.connection() as conn:
+                rows = conn.execute('''
+                    SELECT hour, entries FROM memory_hourly
+                    WHERE hour >= strftime('%Y-%m-%d %H:00:00', 'now', ?)
+                    ORDER BY hour
+                ''', (f'-{int(hours)} hours',)).fetchall()
+                return [{'hour': hour, 'entries': entries} for hour, entries in rows]
+        except Exception as e:
+            logging.error(f"Error getting activity timeline: {e}")
+            return []
+
+    def _transfer_format(self, path: str, format: Optional[str]) -> str:
+        format = (format or ('parquet' if str(path).endswith('.parquet') else 'jsonl')).lower()
+        if format not in ('jsonl', 'parquet'):
+            raise ValueError(f"Unsupported memory export format: {format}")
+        if format == 'parquet' and pa is None:
+            raise ImportError("pyarrow is required for Parquet export/import")
+        return format
+
+    def _snapshot_batches(self, since: Optional[str], batch_size: int) -> Iterator[List[Dict]]:
+        # A read-only connection holding one read transaction sees a consistent WAL
+        # snapshot for the whole export while writers keep committing
+        conn = sqlite3.connect(f"file:{Path(self.db_path).resolve()}?mode=ro", uri=True)
+        register_memory_functions(conn)
+        try:
+            conn.execute('BEGIN')
+            rows = conn.execute(f'''
+                SELECT {self._select(EXPORT_COLUMNS)} FROM memory
+                {'WHERE created_at >= ?' if since else ''}
+                ORDER BY id
+            ''', (since,) if since else ())
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    return
+                yield [dict(zip(EXPORT_COLUMNS, row)) for row in batch]
+        finally:
+            conn.close()
+
+    def export_memory(self, path: str, format: Optional[str] = None, since: Optional[str] = None,
+                      batch_size: int = 1000) -> int:
+        format = self._transfer_format(path, format)
+        exported = 0
+        if format == 'jsonl':
+            with open(path, 'w', encoding='utf-8') as f:
+                for batch in self._snapshot_batches(since, batch_size):
+                    for entry in batch:
+                        entry['metadata'] = json.loads(entry['metadata']) if entry['metadata'] else {}
+                        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                    exported += len(batch)
+        else:
+            schema = pa.schema([(column, pa.string()) for column in EXPORT_COLUMNS])
+            with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+                for batch in self._snapshot_batches(since, batch_size):
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                    exported += len(batch)
+        logging.info(f"Exported {exported} memory entries to {path}")
+        return exported
+
+    def _read_batches(self, path: str, format: str, batch_size: int) -> Iterator[List[Dict]]:
+        if format == 'parquet':
+            for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+                yield record_batch.to_pylist()
+            return
+        batch = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def _import_rows(self, entries: Iterable[Dict]) -> List[tuple]:
+        rows = []
+        for entry in entries:
+            metadata = entry.get('metadata')
+            if isinstance(metadata, str):
+                entry = dict(entry, metadata=json.loads(metadata) if metadata else {})
+            rows.append(self._memory_row(entry) + (entry.get('created_at'),))
+        return rows
+
+    def import_memory(self, path: str, format: Optional[str] = None, batch_size: int = 1000,
+                      defer_indexes: bool = True) -> int:
+        format = self._transfer_format(path, format)
+        imported = 0
+        with self._pool.transaction() as conn:
+            indexes = []
+            if defer_indexes:
+                # Rebuilding each index once after the load is cheaper than updating it per row
+                indexes = conn.execute('''
+                    SELECT name, sql FROM sqlite_master
+                    WHERE type = 'index' AND tbl_name = 'memory' AND sql IS NOT NULL
+                ''').fetchall()
+                for name, _ in indexes:
+                    conn.execute(f'DROP INDEX {name}')
+            for batch in self._read_batches(path, format, batch_size):
+                self._insert_rows(conn, self._import_rows(batch), IMPORT_MEMORY_SQL)
+                imported += len(batch)
+            for _, sql in indexes:
+                conn.execute(sql)
+        logging.info(f"Imported {imported} memory entries from {path}")
+        return imported
+
+    def _archive_path(self, month: str) -> Path:
+        return self.archive_dir / f"memory_{month}.db"
+
+    def _retention_conditions(self, conn, max_age_days: Optional[float],
+                              max_rows: Optional[int]) -> Tuple[List[str], List]:
+        conditions, params = [], []
+        if max_age_days is not None:
+            conditions.append("created_at < datetime('now', ?)")
+            params.append(f'-{float(max_age_days)} days')
+        if max_rows is not None:
+            boundary = conn.execute('''
+                SELECT created_at, id FROM memory ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?
+            ''', (int(max_rows),)).fetchone()
+            if boundary is not None:
+                conditions.append('(created_at, id) <= (?, ?)')
+                params.extend(boundary)
+        return conditions, params
+
+    def _write_archive(self, month: str, rows: List[tuple]):
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        compressed = [ARCHIVE_COLUMNS.index(column) for column in ARCHIVE_COMPRESSED_COLUMNS]
+        archive = sqlite3.connect(str(self._archive_path(month)))
+        try:
+            for statement in ARCHIVE_STATEMENTS:
+                archive.execute(statement)
+            archive.executemany(f'''
+                INSERT OR IGNORE INTO memory ({', '.join(ARCHIVE_COLUMNS)})
+                VALUES ({', '.join('?' * len(ARCHIVE_COLUMNS))})
+            ''', [tuple(compress_text(value) if i in compressed else value for i, value in enumerate(row))
+                  for row in rows])
+            archive.commit()
+        finally:
+            archive.close()
+
+    def archive_memory(self, max_age_days: Optional[float] = None, max_rows: Optional[int] = None,
+                       batch_size: int = 1000, compact: bool = True) -> int:
+        max_age_days = self.retention_days if max_age_days is None else max_age_days
+        max_rows = self.retention_max_rows if max_rows is None else max_rows
+        if max_age_days is None and max_rows is None:
+            return 0
+        if self.write_behind:
+            self.flush()
+        archived = 0
+        try:
+            with self._pool.connection() as conn:
+                conditions, params = self._retention_conditions(conn, max_age_days, max_rows)
+            if not conditions:
+                return 0
+            last_id = 0
+            while True:
+                with self._pool.connection() as conn:
+                    rows = conn.execute(f'''
+                        SELECT {self._select(ARCHIVE_COLUMNS)}, strftime('%Y_%m', created_at) FROM memory
+                        WHERE id > ? AND ({' OR '.join(conditions)})
+                        ORDER BY id LIMIT ?
+                    ''', (last_id, *params, batch_size)).fetchall()
+                if not rows:
+                    break
+                months: Dict[str, List[tuple]] = {}
+                for row in rows:
+                    months.setdefault(row[-1], []).append(row[:-1])
+                # Archive writes are committed before the hot rows are deleted, and
+                # re-archiving is idempotent, so an interrupted run loses nothing
+                for month, month_rows in months.items():
+                    self._write_archive(month, month_rows)
+                ids = [row[0] for row in rows]
+                # One short write transaction per batch keeps writers unblocked
+                with self._pool.transaction() as conn:
+                    conn.executemany('DELETE FROM memory WHERE id = ?', [(memory_id,) for memory_id in ids])
+                self._forget_embeddings(ids)
+                last_id = ids[-1]
+                archived += len(ids)
+            if archived:
+                with self._pool.transaction() as conn:
+                    self._purge_prompt_texts(conn)
+            logging.info(f"Archived {archived} memory entries to {self.archive_dir}")
+        except Exception as e:
+            logging.error(f"Error archiving memory: {e}")
+        if archived and compact:
+            self.compact_memory()
+        return archived
+
+    def compact_memory(self, pages_per_step: int = 256, convert: bool = False) -> int:
+        try:
+            with self._pool.connection() as conn:
+                mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if mode != 2:
+                if not convert:
+                    logging.info("Memory database is not in incremental auto-vacuum mode; "
+                                 "call compact_memory(convert=True) once to convert it")
+                    return 0
+                # One-time full VACUUM to switch an existing database to incremental mode
+                with self._pool.transaction() as conn:
+                    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                    conn.execute('VACUUM')
+                return 0
+            freed = 0
+            while True:
+                with self._pool.transaction() as conn:
+                    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                    if not free_pages:
+                        break
+                    step = min(pages_per_step, free_pages)
+                    conn.execute(f'PRAGMA incremental_vacuum({int(step)})').fetchall()
+                freed += step
+            with self._pool.connection() as conn:
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            logging.info(f"Reclaimed {freed} free pages from the memory database")
+            return freed
+        except Exception as e:
+            logging.error(f"Error compacting memory database: {e}")
+            return 0
+
+    def list_archives(self) -> List[Path]:
+        return sorted(self.archive_dir.glob("memory_*.db"), reverse=True)
+
+    def get_archived_memory(self, session_id: Optional[str] = None, limit: int = 20,
+                            since: Optional[str] = None, until: Optional[str] = None) -> List[MemoryRow]:
+        select = ', '.join(f'inflate({column})' if column in ARCHIVE_COMPRESSED_COLUMNS else column
+                           for column in MEMORY_COLUMNS)
+        conditions, params = [], []
+        if session_id:
+            conditions.append('session_id = ?')
+            params.append(session_id)
+        if since:
+            conditions.append('created_at >= ?')
+            params.append(since)
+        if until:
+            conditions.append('created_at < ?')
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        memory_entries: List[MemoryRow] = []
+        try:
+            with self._pool.connection() as conn:
+                # Monthly files are newest first, so stop as soon as the limit is reached
+                for path in self.list_archives():
+                    month = path.stem[len('memory_'):].replace('_', '-')
+                    if since and month < since[:7] or until and month > until[:7]:
+                        continue
+                    conn.execute('ATTACH DATABASE ? AS archive', (str(path),))
+                    try:
+                        rows = conn.execute(f'''
+                            SELECT {select} FROM archive.memory {where}
+                            ORDER BY created_at DESC, id DESC LIMIT ?
+                        ''', (*params, limit - len(memory_entries))).fetchall()
+                    finally:
+                        conn.execute('DETACH DATABASE archive')
+                    memory_entries.extend(MemoryRow(MEMORY_COLUMNS, row) for row in rows)
+                    if len(memory_entries) >= limit:
+                        break
+            return memory_entries
+        except Exception as e:
+            logging.error(f"Error retrieving archived memory: {e}")
+            return memory_entries
+
     def clear_session_memory(self, session_id: str) -> bool:
-        if session_id in self.short_term_memory:
-            del self.short_term_memory[session_id]
+        if self.short_term_memory.pop(session_id):
             logging.info(f"Cleared short-term memory for session: {session_id}")
             return True
         return False
 
     def clear_all_memory(self) -> bool:
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._pool.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM memory')
-                conn.commit()
+                self._purge_prompt_texts(conn)
+            with self._embedding_lock:
+                self._semantic_index = None
+                self._embedded_through = 0
             self.short_term_memory.clear()
             logging.info("Cleared all long-term and short-term memory")
             return True
         except Exception as e:
             logging.error(f"Error clearing all memory: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer_stop.set()
+            self.flush()
+            self._writer.join()
+            self._writer = None
+            atexit.unregister(self.close)
+            try:
+                with self._pool.connection() as conn:
+                    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except Exception as e:
+                logging.warning(f"Error checkpointing memory database: {e}")
+        self._pool.close()
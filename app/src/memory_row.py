@@ -0,0 +1,48 @@
+import json
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Sequence, Tuple
+
+_UNDECODED = object()
+
+class MemoryRow(Mapping):
+    __slots__ = ('_columns', '_values', '_metadata', '_extra')
+
+    def __init__(self, columns: Tuple[str, ...], values: Sequence[Any]):
+        # columns is shared by every row of a query, values is the sqlite row tuple
+        self._columns = columns
+        self._values = values
+        self._metadata = _UNDECODED
+        self._extra = None
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'metadata' and 'metadata' in self._columns:
+            if self._metadata is _UNDECODED:
+                raw = self._values[self._columns.index('metadata')]
+                self._metadata = json.loads(raw) if raw else {}
+            return self._metadata
+        if key in self._columns:
+            return self._values[self._columns.index(key)]
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any):
+        if key in self._columns:
+            raise KeyError(f"Column {key} is read-only")
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._columns
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return len(self._columns) + (len(self._extra) if self._extra else 0)
+
+    def __repr__(self) -> str:
+        return f"MemoryRow({self.to_dict()!r})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: self[key] for key in self}
@@ -0,0 +1,96 @@
+import logging
+import math
+import re
+from typing import Dict, Tuple
+
+try:
+    from transformers import CLIPTokenizer
+except ImportError:
+    CLIPTokenizer = None
+
+# Stable Diffusion v1.x text encoder context, including BOS/EOS
+CLIP_MAX_TOKENS = 77
+CLIP_TOKENIZER_ID = "openai/clip-vit-large-patch14"
+# LLM tokenizers split text a little finer than CLIP BPE, leave some headroom
+LLM_TOKENS_PER_CLIP_TOKEN = 1.2
+WORDS_PER_CLIP_TOKEN = 0.75
+
+_TOKEN_PATTERN = re.compile(r"'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|[^\s\w]+", re.IGNORECASE)
+
+class PromptBudget:
+    def __init__(self, max_tokens: int = CLIP_MAX_TOKENS, tokenizer_id: str = CLIP_TOKENIZER_ID):
+        self.max_tokens = max_tokens
+        self.content_tokens = max_tokens - 2
+        self.tokenizer = self._load_tokenizer(tokenizer_id)
+        self.stats = {'prompts': 0, 'truncated_prompts': 0, 'truncated_tokens': 0}
+
+    def _load_tokenizer(self, tokenizer_id: str):
+        if CLIPTokenizer is None:
+            logging.info("transformers not installed, using approximate CLIP token counts")
+            return None
+        try:
+            return CLIPTokenizer.from_pretrained(tokenizer_id, cache_dir="model_cache")
+        except Exception as e:
+            logging.warning(f"Could not load CLIP tokenizer, using approximate token counts: {e}")
+            return None
+
+    @property
+    def llm_max_tokens(self) -> int:
+        return math.ceil(self.content_tokens * LLM_TOKENS_PER_CLIP_TOKEN)
+
+    @property
+    def word_limit(self) -> int:
+        return int(self.content_tokens * WORDS_PER_CLIP_TOKEN)
+
+    def _tokenize(self, text: str):
+        if self.tokenizer is not None:
+            return self.tokenizer.tokenize(text)
+        tokens = []
+        for match in _TOKEN_PATTERN.finditer(text):
+            piece = match.group(0)
+            # Long words are split into several BPE pieces
+            tokens.extend([piece] * max(1, math.ceil(len(piece) / 8)))
+        return tokens
+
+    def count(self, text: str) -> int:
+        return len(self._tokenize(text))
+
+    def exceeded(self, text: str) -> bool:
+        return self.count(text) >= self.content_tokens
+
+    def truncate(self, text: str) -> Tuple[str, int]:
+        total = self.count(text)
+        if total <= self.content_tokens:
+            return text, 0
+        if self.tokenizer is not None:
+            # Cut the original text at a word boundary; decoding CLIP ids would lowercase and respace it
+            ends = [match.end() for match in re.finditer(r'\S+', text)]
+            low, high = 0, len(ends)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if self.count(text[:ends[middle - 1]]) <= self.content_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            truncated = text[:ends[low - 1]].rstrip(' ,') if low else ''
+        else:
+            truncated = text
+            used = 0
+            for match in _TOKEN_PATTERN.finditer(text):
+                used += max(1, math.ceil(len(match.group(0)) / 8))
+                if used > self.content_tokens:
+                    truncated = text[:match.start()].rstrip(' ,')
+                    break
+        return truncated, total - self.content_tokens
+
+    def apply(self, text: str) -> Tuple[str, Dict]:
+        truncated, dropped = self.truncate(text)
+        self.stats['prompts'] += 1
+        if dropped:
+            self.stats['truncated_prompts'] += 1
+            self.stats['truncated_tokens'] += dropped
+        return truncated, {
+            'budget_tokens': self.content_tokens,
+            'generated_tokens': self.count(text),
+            'truncated_tokens': dropped
+        }
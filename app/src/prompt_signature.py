@@ -0,0 +1,45 @@
+import hashlib
+import re
+from typing import List
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+_FILLER_WORDS = {'a', 'an', 'the', 'please', 'make', 'me', 'create', 'generate', 'show', 'of'}
+
+def normalize_prompt(prompt: str) -> str:
+    text = _PUNCTUATION.sub(' ', (prompt or '').lower())
+    words = [word for word in _WHITESPACE.split(text) if word and word not in _FILLER_WORDS]
+    return ' '.join(words)
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def simhash(prompt: str) -> int:
+    words = normalize_prompt(prompt).split()
+    features = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    weights = [0] * SIMHASH_BITS
+    for feature in features:
+        digest = _feature_hash(feature)
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if digest >> bit & 1 else -1
+    value = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            value |= 1 << bit
+    return to_signed(value)
+
+def to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << SIMHASH_BITS) if value >= 1 << (SIMHASH_BITS - 1) else value
+
+def simhash_bands(value: int) -> List[int]:
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (band * BAND_BITS)) & mask for band in range(SIMHASH_BANDS)]
+
+def similarity(first: int, second: int) -> float:
+    distance = bin((first ^ second) & ((1 << SIMHASH_BITS) - 1)).count('1')
+    return 1.0 - distance / SIMHASH_BITS
@@ -7,30 +7,40 @@ import io
 import base64
 from datetime import datetime
 import os
+import threading
 from pathlib import Path
 import torch
 from diffusers import StableDiffusionPipeline
 import time
+from cpu_inference import load_cpu_pipeline
+from batch_generation import GenerationRequest, generate_batch
+from latent_preview import StepProgress
+from schedulers import DEFAULT_PRESET, available_presets, preset_settings
+from diffusion_client import DIFFUSION_SERVICE_URL, DiffusionClient
+
+# Use a smaller, faster model
+MODEL_ID = "CompVis/stable-diffusion-v1-4"
 
 # Initialize Stable Diffusion with a smaller model
 @st.cache_resource
 def load_pipeline():
-    # Use a smaller, faster model
-    model_id = "CompVis/stable-diffusion-v1-4"
+    model_id = MODEL_ID
+    if not torch.cuda.is_available():
+        # Sequential offload only helps GPUs; on CPU use the tuned CPU profile
+        return load_cpu_pipeline(model_id)
     pipe = StableDiffusionPipeline.from_pretrained(
         model_id,
         torch_dtype=torch.float32,
         safety_checker=None  # Disable safety checker for speed
     )
-    if torch.cuda.is_available():
-        pipe = pipe.to("cuda")
-    else:
-        # Enable CPU optimization
-        pipe = pipe.to("cpu")
-        pipe.enable_attention_slicing()
-        pipe.enable_sequential_cpu_offload()
+    pipe = pipe.to("cuda")
     return pipe
 
+@st.cache_resource
+def get_pipeline_lock():
+    # Sessions run concurrently and generate_batch swaps the shared pipeline's scheduler
+    return threading.Lock()
+
 # Page configuration
 st.set_page_config(
     page_title="Prompt to 3D Generator",
@@ -68,33 +78,65 @@ st.markdown("""
 
 def create_image(prompt, size=(512, 512)):
     """Generate an image using Stable Diffusion"""
+    return create_images(prompt, size)[0]
+
+def create_images(prompt, size=(512, 512), num_images=1, preset=DEFAULT_PRESET, seed=None):
+    """Generate one or more images for a prompt in a single batch"""
     try:
         # Show loading message
         with st.spinner(f"🎨 Generating image for: {prompt}"):
-            # Load the pipeline
-            pipe = load_pipeline()
-            
             # Start timer
             start_time = time.time()
             
             # Generate the image with a timeout
             width, height = size
-            image = pipe(
+            request = GenerationRequest(
                 prompt,
                 width=width,
                 height=height,
-                num_inference_steps=20  # Reduce steps for faster generation
-            ).images[0]
+                num_images_per_prompt=num_images,
+                seed=seed,  # Random when not given; identical requests come back from the result cache
+                **preset_settings(preset)  # Scheduler and step count for the chosen speed/quality trade-off
+            )
+            
+            # Report every step and show a cheap latent preview while the image forms
+            progress_bar = st.progress(0.0, text="Starting diffusion...")
+            preview_slot = st.empty()
+            def on_step(step, total_steps, previews):
+                progress_bar.progress(step / total_steps, text=f"Step {step}/{total_steps}")
+                if previews:
+                    preview_slot.image(previews[0], caption="Preview", width=256)
+            
+            if DIFFUSION_SERVICE_URL:
+                # The shared diffusion service already holds the model, so skip loading it here
+                def on_progress(job):
+                    on_step(job.step, job.total_steps, [job.preview] if job.preview else None)
+                images = DiffusionClient(DIFFUSION_SERVICE_URL, MODEL_ID).generate(request, on_progress=on_progress)
+                progress_bar.empty()
+                preview_slot.empty()
+                st.info(f"✨ {len(images)} image(s) generated in {time.time() - start_time:.2f} seconds "
+                        f"by the diffusion service (seed {request.seed})")
+                return images
+            
+            # Load the pipeline
+            pipe = load_pipeline()
+            progress = StepProgress(request.steps, on_step)
+            with get_pipeline_lock():
+                images = generate_batch(pipe, [request], callback_on_step_end=progress)[0]
+            progress_bar.empty()
+            preview_slot.empty()
             
             # Show generation time
             generation_time = time.time() - start_time
-            st.info(f"✨ Image generated in {generation_time:.2f} seconds")
+            stats = progress.stats()
+            st.info(f"✨ {len(images)} image(s) generated in {generation_time:.2f} seconds, seed {request.seed} "
+                    f"({stats['seconds_per_step']:.2f}s/step, previews {stats['preview_overhead']:.1%} of step time)")
             
-            return image
+            return images
     except Exception as e:
         st.error(f"Error generating image: {str(e)}")
         # Fallback to demo image if there's an error
-        return create_demo_image(prompt, size)
+        return [create_demo_image(prompt, size)]
 
 def create_demo_image(prompt, size=(512, 512)):
     """Create a demo image based on the prompt"""
@@ -264,6 +306,12 @@ def main():
     with st.sidebar.expander("Advanced Options"):
         color_scheme = st.selectbox("Color Scheme", ["Viridis", "Plasma", "Inferno", "Blues"])
         detail_level = st.slider("Detail Level", 1, 10, 5)
+        num_images = st.slider("Images per prompt", 1, 4, 1)
+        presets = available_presets(MODEL_ID)
+        preset = st.selectbox("Speed preset", presets, index=presets.index(DEFAULT_PRESET),
+                              help="Fewer steps with a faster scheduler trade detail for speed")
+        seed = st.number_input("Seed (0 = random)", min_value=0, max_value=2 ** 32 - 1, value=0, step=1,
+                               help="Reuse a seed to reproduce an image")
     
     # Generate button with loading state
     if st.button("🚀 Generate", type="primary", help="Click to generate image and 3D visualization"):
@@ -279,10 +327,11 @@ def main():
                 with image_tab:
                     # Generate image
                     size_map = {"512x512": (512, 512), "768x768": (768, 768), "1024x1024": (1024, 1024)}
-                    img = create_image(prompt, size_map[image_size])
+                    images = create_images(prompt, size_map[image_size], num_images, preset, seed or None)
+                    img = images[0]
                     
-                    # Display the image
-                    st.image(img, caption=f"Generated image for: {prompt[:100]}...")
+                    # Display the images
+                    st.image(images, caption=[f"Generated image for: {prompt[:100]}..."] * len(images))
                     
                     # Add download button
                     img_buffer = io.BytesIO()
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import diffusers
+import numpy as np
+import torch
+import transformers
+from diffusers import UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel
+
+from batch_generation import GenerationRequest, generate_batch
+
+QUANTIZED_CACHE_DIR = os.environ.get('SD_QUANTIZED_CACHE_DIR', 'model_cache/int8')
+# The VAE is mostly convolutions, so only these two carry enough Linear weight to matter
+QUANTIZED_COMPONENTS = ('text_encoder', 'unet')
+
+REPORT_PROMPTS = (
+    "A lighthouse on a cliff at sunset",
+    "A red fox sitting in fresh snow, detailed fur",
+    "A futuristic robot in a cyberpunk city at night",
+)
+REPORT_SEEDS = (0, 1, 2, 3)
+
+def cache_path(model_id: str, component: str, cache_dir: str = QUANTIZED_CACHE_DIR) -> Path:
+    # Packed int8 layouts follow torch, and the module layout the state_dict maps onto follows diffusers/transformers
+    versions = f"{torch.__version__}:{diffusers.__version__}:{transformers.__version__}"
+    key = hashlib.blake2b(f"{model_id}:{versions}".encode('utf-8'), digest_size=8).hexdigest()
+    return Path(cache_dir) / key / f"{component}.pt"
+
+def is_quantized(module: torch.nn.Module) -> bool:
+    return any(isinstance(child, torch.ao.nn.quantized.dynamic.Linear) for child in module.modules())
+
+def quantize_linear(module: torch.nn.Module) -> torch.nn.Module:
+    # Weights become int8 once; activations are quantized per batch at run time
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def component_skeleton(model_id: str, component: str, model_cache_dir: Optional[str] = None) -> torch.nn.Module:
+    # Built from the config alone, so no fp32 checkpoint is read
+    if component == 'unet':
+        config = UNet2DConditionModel.load_config(model_id, subfolder='unet', cache_dir=model_cache_dir)
+        return UNet2DConditionModel.from_config(config)
+    config = CLIPTextConfig.from_pretrained(model_id, subfolder='text_encoder', cache_dir=model_cache_dir)
+    return CLIPTextModel(config)
+
+def load_quantized_components(model_id: str, cache_dir: str = QUANTIZED_CACHE_DIR,
+                              model_cache_dir: Optional[str] = None) -> Dict[str, torch.nn.Module]:
+    # Passed to from_pretrained so the fp32 weights of cached components are never loaded
+    components = {}
+    for component in QUANTIZED_COMPONENTS:
+        path = cache_path(model_id, component, cache_dir)
+        if not path.exists():
+            continue
+        try:
+            # Only tensors are unpickled; the quantized module is rebuilt around them
+            state_dict = torch.load(path, map_location='cpu', weights_only=True)
+            module = quantize_linear(component_skeleton(model_id, component, model_cache_dir).float().eval())
+            module.load_state_dict(state_dict)
+            components[component] = module
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable quantized {component} at {path}: {e}")
+    return components
+
+def quantize_pipeline(pipe, model_id: str, cache_dir: str = QUANTIZED_CACHE_DIR):
+    for component in QUANTIZED_COMPONENTS:
+        module = getattr(pipe, component)
+        if is_quantized(module):
+            continue
+        start_time = time.time()
+        module = quantize_linear(module.float().eval())
+        logging.info(f"Quantized {component} to int8 in {time.time() - start_time:.1f}s")
+        path = cache_path(model_id, component, cache_dir)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            torch.save(module.state_dict(), tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.warning(f"Could not cache quantized {component}: {e}")
+        setattr(pipe, component, module)
+    # Part of the embedding and result cache keys; also blocks LoRA adapters
+    pipe.quantized = True
+    return pipe
+
+def component_bytes(pipe, components: Sequence[str] = QUANTIZED_COMPONENTS) -> int:
+    def tensor_bytes(value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(item) for item in value)
+        return 0
+    # state_dict, not parameters: packed int8 weights are not nn.Parameters
+    return sum(tensor_bytes(value) for component in components
+               for value in getattr(pipe, component).state_dict().values())
+
+def image_difference(reference, candidate) -> Dict:
+    a = np.asarray(reference, dtype=np.float64)
+    b = np.asarray(candidate, dtype=np.float64)
+    mse = float(np.mean((a - b) ** 2))
+    return {
+        'psnr': 10 * np.log10(255.0 ** 2 / mse) if mse else float('inf'),
+        'mean_abs_diff': float(np.mean(np.abs(a - b))) / 255.0
+    }
+
+def _timed_generation(pipe, requests) -> Dict:
+    with torch.inference_mode():
+        pipe(requests[0].prompt, num_inference_steps=2, height=requests[0].height, width=requests[0].width)
+        start_time = time.time()
+        # One request per call and no result cache, so every image is really generated
+        images = [images[0] for images in generate_batch(pipe, requests, max_batch_images=1, result_cache=None)]
+        elapsed = time.time() - start_time
+    return {
+        'images': images,
+        'seconds_per_step': elapsed / sum(request.steps for request in requests),
+        'weight_bytes': component_bytes(pipe)
+    }
+
+def quality_report(model_id: str, prompts: Sequence[str] = REPORT_PROMPTS, seeds: Sequence[int] = REPORT_SEEDS,
+                   steps: int = 20, size: int = 512, **kwargs) -> Dict:
+    from cpu_inference import load_cpu_pipeline
+    requests = [GenerationRequest(prompt, steps=steps, width=size, height=size, seed=seed)
+                for prompt in prompts for seed in seeds]
+    runs = {}
+    # One pipeline at a time, so the report fits in the same memory as normal use
+    for profile in ('cpu-fp32', 'cpu-int8'):
+        pipe = load_cpu_pipeline(model_id, profile, **kwargs)
+        runs[profile] = _timed_generation(pipe, requests)
+        del pipe
+    reference, candidate = runs['cpu-fp32'], runs['cpu-int8']
+    pairs: List[Dict] = []
+    for request, fp32_image, int8_image in zip(requests, reference['images'], candidate['images']):
+        pairs.append({'prompt': request.prompt, 'seed': request.seed, **image_difference(fp32_image, int8_image)})
+    return {
+        'model': model_id,
+        'steps': steps,
+        'fp32_seconds_per_step': reference['seconds_per_step'],
+        'int8_seconds_per_step': candidate['seconds_per_step'],
+        'speedup': reference['seconds_per_step'] / candidate['seconds_per_step'],
+        'fp32_weight_mb': reference['weight_bytes'] / 1024 ** 2,
+        'int8_weight_mb': candidate['weight_bytes'] / 1024 ** 2,
+        'mean_psnr': float(np.mean([pair['psnr'] for pair in pairs])),
+        'min_psnr': float(np.min([pair['psnr'] for pair in pairs])),
+        'mean_abs_diff': float(np.mean([pair['mean_abs_diff'] for pair in pairs])),
+        'pairs': pairs
+    }
+
+def main():
+    model_id = sys.argv[1] if len(sys.argv) > 1 else "runwayml/stable-diffusion-v1-5"
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print(f"🔬 Comparing int8 against fp32 for {model_id} ({steps} steps, seeds {list(REPORT_SEEDS)})")
+    report = quality_report(model_id, steps=steps, cache_dir="model_cache")
+    for pair in report['pairs']:
+        print(f"  seed {pair['seed']:<3} PSNR {pair['psnr']:5.1f} dB  diff {pair['mean_abs_diff']:.3f}  "
+              f"{pair['prompt'][:50]}")
+    print(f"  speed  {report['fp32_seconds_per_step']:.2f} -> {report['int8_seconds_per_step']:.2f} s/step "
+          f"({report['speedup']:.2f}x)")
+    print(f"  text encoder + UNet weights  {report['fp32_weight_mb']:.0f}MB -> {report['int8_weight_mb']:.0f}MB")
+    print(f"  quality  mean PSNR {report['mean_psnr']:.1f} dB, worst {report['min_psnr']:.1f} dB")
+
+if __name__ == "__main__":
+    main()
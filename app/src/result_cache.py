@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+RESULT_CACHE_DIR = os.environ.get('SD_RESULT_CACHE_DIR', 'outputs/result_cache')
+# Set to 0 to disable the cache
+RESULT_CACHE_MB = float(os.environ.get('SD_RESULT_CACHE_MB', '1024'))
+RESULT_CACHE_ENTRIES = int(os.environ.get('SD_RESULT_CACHE_ENTRIES', '5000'))
+
+def result_key(model: str, scheduler: Optional[str], prompt: str, negative_prompt: Optional[str], seed: int,
+               steps: int, guidance_scale: float, width: int, height: int) -> str:
+    fields = [model, scheduler, prompt, negative_prompt or '', seed, steps, float(guidance_scale), width, height]
+    return hashlib.blake2b(json.dumps(fields).encode('utf-8'), digest_size=16).hexdigest()
+
+class ResultCache:
+    def __init__(self, cache_dir: str = RESULT_CACHE_DIR, max_bytes: int = int(RESULT_CACHE_MB * 1024 ** 2),
+                 max_entries: int = RESULT_CACHE_ENTRIES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._index: Optional["OrderedDict[str, int]"] = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None and self.max_bytes > 0 and self.max_entries > 0
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.png"
+
+    def _load_index(self) -> "OrderedDict[str, int]":
+        # Built lazily from the files on disk, least recently used first (by mtime)
+        if self._index is None:
+            files = []
+            if self.cache_dir.exists():
+                for path in self.cache_dir.glob('*/*.png'):
+                    stat = path.stat()
+                    files.append((stat.st_mtime, path.stem, stat.st_size))
+            self._index = OrderedDict((key, size) for _, key, size in sorted(files))
+        return self._index
+
+    def _evict(self, index: "OrderedDict[str, int]"):
+        total = sum(index.values())
+        while index and (total > self.max_bytes or len(index) > self.max_entries):
+            key, size = index.popitem(last=False)
+            total -= size
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional["Image.Image"]:
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        with self._lock:
+            index = self._load_index()
+            if key not in index:
+                self.misses += 1
+                return None
+            index.move_to_end(key)
+            self.hits += 1
+        try:
+            image = Image.open(path)
+            image.load()
+            os.utime(path)
+            return image
+        except (OSError, ValueError) as e:
+            logging.warning(f"Dropping unreadable cached result {path}: {e}")
+            with self._lock:
+                self._index.pop(key, None)
+            return None
+
+    def put(self, key: str, image: "Image.Image"):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            image.save(tmp_path, format="PNG")
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not cache generated image: {e}")
+            return
+        with self._lock:
+            index = self._load_index()
+            index[key] = path.stat().st_size
+            index.move_to_end(key)
+            self._evict(index)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._load_index()):
+                self._path(key).unlink(missing_ok=True)
+            self._index = OrderedDict()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            index = self._load_index()
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(index),
+                'bytes': sum(index.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+RESULT_CACHE = ResultCache()
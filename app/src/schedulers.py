@@ -0,0 +1,122 @@
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+try:
+    import diffusers
+except ImportError:
+    diffusers = None
+
+# name -> (diffusers scheduler class, config overrides)
+SCHEDULERS = {
+    'dpmpp-2m': ('DPMSolverMultistepScheduler', {'algorithm_type': 'dpmsolver++', 'use_karras_sigmas': True}),
+    'euler-a': ('EulerAncestralDiscreteScheduler', {}),
+    'unipc': ('UniPCMultistepScheduler', {}),
+    'lcm': ('LCMScheduler', {}),
+}
+
+# LCM needs a distilled adapter; these LoRAs fit every SD 1.x checkpoint
+LCM_ADAPTERS = {
+    'runwayml/stable-diffusion-v1-5': 'latent-consistency/lcm-lora-sdv1-5',
+    'CompVis/stable-diffusion-v1-4': 'latent-consistency/lcm-lora-sdv1-5',
+}
+
+PRESETS = {
+    'quality': {'scheduler': 'dpmpp-2m', 'steps': 25, 'guidance_scale': 7.5},
+    'balanced': {'scheduler': 'dpmpp-2m', 'steps': 15, 'guidance_scale': 7.5},
+    'fast': {'scheduler': 'unipc', 'steps': 10, 'guidance_scale': 7.0},
+    'turbo': {'scheduler': 'lcm', 'steps': 4, 'guidance_scale': 1.0},
+}
+
+DEFAULT_PRESET = os.environ.get('SD_PRESET', 'balanced')
+
+def supports_lcm(model_id: Optional[str]) -> bool:
+    return model_id in LCM_ADAPTERS
+
+def available_presets(model_id: Optional[str] = None) -> List[str]:
+    return [name for name, preset in PRESETS.items() if preset['scheduler'] != 'lcm' or supports_lcm(model_id)]
+
+def preset_settings(name: str = DEFAULT_PRESET) -> Dict:
+    if name not in PRESETS:
+        raise ValueError(f"Unknown preset '{name}', expected one of {sorted(PRESETS)}")
+    return dict(PRESETS[name])
+
+def _model_id(pipe) -> Optional[str]:
+    return getattr(pipe, 'name_or_path', None) or pipe.config.get('_name_or_path')
+
+def _set_lcm_adapter(pipe, enabled: bool):
+    loaded = getattr(pipe, 'lcm_adapter_loaded', False)
+    if enabled and not loaded:
+        model_id = _model_id(pipe)
+        if not supports_lcm(model_id):
+            raise ValueError(f"No LCM adapter known for {model_id}")
+        if getattr(pipe, 'quantized', False):
+            raise ValueError("LoRA adapters cannot be applied to int8 quantized Linear layers")
+        pipe.load_lora_weights(LCM_ADAPTERS[model_id], adapter_name='lcm')
+        pipe.lcm_adapter_loaded = True
+    elif enabled:
+        pipe.enable_lora()
+    elif loaded:
+        pipe.disable_lora()
+
+def apply_scheduler(pipe, name: Optional[str]):
+    # Swapping is cheap (a config copy), but it mutates the shared pipeline, so
+    # callers must hold the pipeline for the whole generation. None restores the
+    # scheduler the pipeline was loaded with
+    name = name or None
+    if getattr(pipe, 'scheduler_name', None) == name:
+        return pipe
+    if not hasattr(pipe, 'default_scheduler_config'):
+        pipe.default_scheduler_class = type(pipe.scheduler)
+        pipe.default_scheduler_config = pipe.scheduler.config
+    if name is None:
+        scheduler_class, overrides = pipe.default_scheduler_class, {}
+    else:
+        if diffusers is None:
+            raise ImportError("diffusers is required to switch schedulers")
+        class_name, overrides = SCHEDULERS[name]
+        scheduler_class = getattr(diffusers, class_name)
+    scheduler = scheduler_class.from_config(pipe.default_scheduler_config, **overrides)
+    # The adapter can fail to load (e.g. offline); the pipeline then keeps its previous scheduler
+    _set_lcm_adapter(pipe, name == 'lcm')
+    pipe.scheduler = scheduler
+    pipe.scheduler_name = name
+    logging.info(f"Using {scheduler_class.__name__} scheduler ({name or 'default'})")
+    return pipe
+
+def benchmark_presets(pipe, presets: Optional[Sequence[str]] = None,
+                      prompt: str = "A lighthouse on a cliff at sunset", size: int = 512) -> List[Dict]:
+    presets = presets or available_presets(_model_id(pipe))
+    # One throwaway run so the first preset does not pay for warm-up
+    pipe(prompt, num_inference_steps=2, height=size, width=size)
+    results = []
+    for name in presets:
+        settings = preset_settings(name)
+        apply_scheduler(pipe, settings['scheduler'])
+        start_time = time.time()
+        pipe(prompt, num_inference_steps=settings['steps'], guidance_scale=settings['guidance_scale'],
+             height=size, width=size)
+        elapsed = time.time() - start_time
+        results.append({
+            'preset': name,
+            'scheduler': settings['scheduler'],
+            'steps': settings['steps'],
+            'seconds': elapsed,
+            'seconds_per_step': elapsed / settings['steps']
+        })
+    return results
+
+def main():
+    from cpu_inference import load_cpu_pipeline
+    model_id = sys.argv[1] if len(sys.argv) > 1 else "runwayml/stable-diffusion-v1-5"
+    presets = sys.argv[2].split(',') if len(sys.argv) > 2 else None
+    pipe = load_cpu_pipeline(model_id, cache_dir="model_cache")
+    print(f"⏱️ Benchmarking presets for {model_id}")
+    for result in benchmark_presets(pipe, presets):
+        print(f"  {result['preset']:<9} {result['scheduler']:<9} {result['steps']:>3} steps  "
+              f"{result['seconds']:.1f}s ({result['seconds_per_step']:.2f} s/step)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import logging
+import math
+import re
+import zlib
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+SENTENCE_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+HASHING_DIM = 256
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+class TextEmbedder:
+    def __init__(self, model_id: str = SENTENCE_MODEL_ID, hashing_dim: int = HASHING_DIM):
+        self.model = self._load_model(model_id)
+        if self.model is not None:
+            self.name = model_id
+            self.dim = self.model.get_sentence_embedding_dimension()
+        else:
+            self.name = f"hashing-{hashing_dim}"
+            self.dim = hashing_dim
+
+    def _load_model(self, model_id: str):
+        if SentenceTransformer is None:
+            logging.info("sentence-transformers not installed, using hashed n-gram embeddings")
+            return None
+        try:
+            return SentenceTransformer(model_id, device="cpu", cache_folder="model_cache")
+        except Exception as e:
+            logging.warning(f"Could not load embedding model, using hashed n-gram embeddings: {e}")
+            return None
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        if self.model is not None:
+            vectors = self.model.encode(list(texts), batch_size=64, convert_to_numpy=True)
+            return normalize(vectors.astype(np.float32))
+        return normalize(np.stack([self._hash_embed(text) for text in texts]))
+
+    def _hash_embed(self, text: str) -> np.ndarray:
+        # Feature hashing over words and character trigrams: no model download,
+        # robust to inflections and typos, but not to synonyms
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in _WORD_PATTERN.findall(text.lower()):
+            features = [(word, 1.0)]
+            padded = f"<{word}>"
+            features.extend((padded[i:i + 3], 0.5) for i in range(len(padded) - 2))
+            for feature, weight in features:
+                digest = zlib.crc32(feature.encode('utf-8'))
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                vector[digest % self.dim] += sign * weight
+        return vector
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class SemanticIndex:
+    def __init__(self, dim: int, cluster_threshold: int = 200000, n_probe: int = 8):
+        self.dim = dim
+        self.cluster_threshold = cluster_threshold
+        self.n_probe = n_probe
+        self._vectors = np.zeros((1024, dim), dtype=np.float32)
+        self._ids = np.zeros(1024, dtype=np.int64)
+        self._size = 0
+        self.centroids: Optional[np.ndarray] = None
+        self._assignments = np.zeros(1024, dtype=np.int32)
+        self._clustered_size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _reserve(self, needed: int):
+        capacity = len(self._ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:self._size] = self._vectors[:self._size]
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[:self._size] = self._ids[:self._size]
+        assignments = np.zeros(capacity, dtype=np.int32)
+        assignments[:self._size] = self._assignments[:self._size]
+        self._vectors, self._ids, self._assignments = vectors, ids, assignments
+
+    def add(self, ids: Sequence[int], vectors: np.ndarray):
+        count = len(ids)
+        if not count:
+            return
+        self._reserve(self._size + count)
+        end = self._size + count
+        self._vectors[self._size:end] = normalize(np.asarray(vectors, dtype=np.float32))
+        self._ids[self._size:end] = ids
+        if self.centroids is not None:
+            self._assignments[self._size:end] = self._nearest_centroids(self._vectors[self._size:end], 1)[:, 0]
+        self._size = end
+        if self._size >= self.cluster_threshold and self._size >= 2 * self._clustered_size:
+            self.build_clusters()
+
+    def remove(self, ids: Sequence[int]) -> int:
+        # Compacts in place; deleted rows are removed in batches, so one O(n) pass per call is fine
+        if not self._size or not len(ids):
+            return 0
+        keep = ~np.isin(self._ids[:self._size], np.asarray(list(ids), dtype=np.int64))
+        kept = int(keep.sum())
+        removed = self._size - kept
+        if removed:
+            self._vectors[:kept] = self._vectors[:self._size][keep]
+            self._ids[:kept] = self._ids[:self._size][keep]
+            self._assignments[:kept] = self._assignments[:self._size][keep]
+            self._size = kept
+        return removed
+
+    def _nearest_centroids(self, vectors: np.ndarray, count: int) -> np.ndarray:
+        similarities = vectors @ self.centroids.T
+        count = min(count, len(self.centroids))
+        return np.argpartition(-similarities, count - 1, axis=1)[:, :count]
+
+    def build_clusters(self, n_clusters: Optional[int] = None, iterations: int = 8, sample_size: int = 100000):
+        vectors = self._vectors[:self._size]
+        n_clusters = n_clusters or max(1, int(math.sqrt(self._size)))
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(self._size, min(sample_size, self._size), replace=False)]
+        centroids = sample[rng.choice(len(sample), min(n_clusters, len(sample)), replace=False)].copy()
+        # Spherical k-means on a sample; every vector is assigned afterwards
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(len(centroids)):
+                members = sample[labels == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            centroids = normalize(centroids)
+        self.centroids = centroids
+        for start in range(0, self._size, 65536):
+            end = min(start + 65536, self._size)
+            self._assignments[start:end] = np.argmax(vectors[start:end] @ centroids.T, axis=1)
+        self._clustered_size = self._size
+        logging.info(f"Built semantic index with {len(centroids)} clusters over {self._size} vectors")
+
+    def search(self, query: np.ndarray, k: int = 10) -> List[Tuple[int, float]]:
+        if not self._size:
+            return []
+        query = normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))
+        vectors = self._vectors[:self._size]
+        ids = self._ids[:self._size]
+        if self.centroids is not None:
+            probes = self._nearest_centroids(query, self.n_probe)[0]
+            mask = np.isin(self._assignments[:self._size], probes)
+            vectors, ids = vectors[mask], ids[mask]
+            if not len(ids):
+                return []
+        scores = vectors @ query[0]
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top]
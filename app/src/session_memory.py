@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List
+
+ENTRY_OVERHEAD_BYTES = 64
+
+class SessionMemory:
+    def __init__(self, max_entries_per_session: int = 50, max_sessions: int = 1000,
+                 ttl_seconds: float = 3600.0, max_total_bytes: int = 16 * 1024 * 1024):
+        self.max_entries_per_session = max_entries_per_session
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_total_bytes = max_total_bytes
+        # session_id -> deque of (entry, size), ordered from least to most recently used
+        self._sessions: "OrderedDict[str, deque]" = OrderedDict()
+        self._last_access: Dict[str, float] = {}
+        self._total_entries = 0
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        self.evictions = {'overflow': 0, 'lru': 0, 'ttl': 0, 'budget': 0}
+
+    def _entry_size(self, entry: Dict) -> int:
+        return ENTRY_OVERHEAD_BYTES + sum(len(str(key)) + len(str(value)) for key, value in entry.items())
+
+    def _drop_session(self, session_id: str, reason: str):
+        entries = self._sessions.pop(session_id)
+        self._last_access.pop(session_id, None)
+        self._total_entries -= len(entries)
+        self._total_bytes -= sum(size for _, size in entries)
+        self.evictions[reason] += len(entries)
+
+    def _drop_oldest_entry(self, session_id: str, reason: str):
+        entries = self._sessions[session_id]
+        _, size = entries.popleft()
+        self._total_entries -= 1
+        self._total_bytes -= size
+        self.evictions[reason] += 1
+        if not entries:
+            del self._sessions[session_id]
+            self._last_access.pop(session_id, None)
+
+    def _expire(self, now: float):
+        while self._sessions:
+            session_id = next(iter(self._sessions))
+            if now - self._last_access[session_id] <= self.ttl_seconds:
+                break
+            self._drop_session(session_id, 'ttl')
+
+    def append(self, session_id: str, entry: Dict):
+        now = time.time()
+        size = self._entry_size(entry)
+        with self._lock:
+            self._expire(now)
+            if session_id not in self._sessions:
+                while len(self._sessions) >= self.max_sessions:
+                    self._drop_session(next(iter(self._sessions)), 'lru')
+                self._sessions[session_id] = deque()
+            self._sessions.move_to_end(session_id)
+            self._last_access[session_id] = now
+            entries = self._sessions[session_id]
+            if len(entries) >= self.max_entries_per_session:
+                _, dropped_size = entries.popleft()
+                self._total_entries -= 1
+                self._total_bytes -= dropped_size
+                self.evictions['overflow'] += 1
+            entries.append((entry, size))
+            self._total_entries += 1
+            self._total_bytes += size
+            # Trim idle sessions first; the current session is the most recently used
+            while self._total_bytes > self.max_total_bytes and self._total_entries > 1:
+                self._drop_oldest_entry(next(iter(self._sessions)), 'budget')
+
+    def get(self, session_id: str, limit: int = 10) -> List[Dict]:
+        with self._lock:
+            self._expire(time.time())
+            if session_id not in self._sessions:
+                return []
+            self._sessions.move_to_end(session_id)
+            self._last_access[session_id] = time.time()
+            entries = [entry for entry, _ in self._sessions[session_id]]
+        return entries[-limit:] if limit > 0 else entries
+
+    def pop(self, session_id: str) -> bool:
+        with self._lock:
+            if session_id not in self._sessions:
+                return False
+            entries = self._sessions.pop(session_id)
+            self._last_access.pop(session_id, None)
+            self._total_entries -= len(entries)
+            self._total_bytes -= sum(size for _, size in entries)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._last_access.clear()
+            self._total_entries = 0
+            self._total_bytes = 0
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire(time.time())
+            return len(self._sessions)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._expire(time.time())
+            return {
+                'active_sessions': len(self._sessions),
+                'short_term_entries': self._total_entries,
+                'short_term_bytes': self._total_bytes,
+                'short_term_evictions': dict(self.evictions)
+            }
@@ -0,0 +1,172 @@
+import heapq
+import logging
+import zlib
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from memory_manager import MemoryManager
+from memory_row import MemoryRow
+from session_memory import SessionMemory
+
+def shard_path(db_path: str, shard: int) -> str:
+    path = Path(db_path)
+    return str(path.with_name(f"{path.stem}_shard{shard}{path.suffix}"))
+
+def _newest_first(entry: MemoryRow) -> Tuple[str, int]:
+    return entry['created_at'] or '', entry['id']
+
+class ShardedMemoryManager:
+    def __init__(self, db_path: str = "memory.db", shards: int = 4,
+                 session_memory: Optional[SessionMemory] = None, **kwargs):
+        self.db_path = db_path
+        self.short_term_memory = session_memory or SessionMemory()
+        archive_dir = Path(kwargs.pop('archive_dir', None) or Path(db_path).parent / "memory_archive")
+        # Each shard is its own SQLite file with its own pool and write lock, so
+        # workers writing different sessions never wait on each other. A session
+        # always maps to one shard, so a single-session caller gets no write scaling
+        self.shards = [
+            MemoryManager(shard_path(db_path, shard), session_memory=self.short_term_memory,
+                          archive_dir=str(archive_dir / f"shard{shard}"), **kwargs)
+            for shard in range(shards)
+        ]
+
+    def shard_for(self, session_id: str) -> MemoryManager:
+        # crc32 rather than hash(), which is salted per process
+        return self.shards[zlib.crc32(session_id.encode('utf-8')) % len(self.shards)]
+
+    def _merge(self, streams: Iterable[Iterable[MemoryRow]], ascending: bool = False,
+               key=_newest_first) -> Iterator[MemoryRow]:
+        return heapq.merge(*streams, key=key, reverse=not ascending)
+
+    def store_memory(self, memory_entry: Dict) -> bool:
+        return self.shard_for(memory_entry.get('session_id', 'default')).store_memory(memory_entry)
+
+    def flush(self) -> bool:
+        return all([shard.flush() for shard in self.shards])
+
+    def get_session_memory(self, session_id: str, limit: int = 10) -> List[Dict]:
+        return self.short_term_memory.get(session_id, limit)
+
+    def get_long_term_memory(self, session_id: Optional[str] = None, limit: int = 20,
+                             columns: Optional[Sequence[str]] = None,
+                             metadata_filter: Optional[Dict] = None) -> List[MemoryRow]:
+        return self.get_memory_page(session_id=session_id, limit=limit, columns=columns,
+                                    metadata_filter=metadata_filter)['entries']
+
+    def get_memory_page(self, session_id: Optional[str] = None, limit: int = 20,
+                        cursor: Optional[Tuple] = None, ascending: bool = False,
+                        columns: Optional[Sequence[str]] = None,
+                        metadata_filter: Optional[Dict] = None) -> Dict:
+        if session_id:
+            shard = self.shard_for(session_id)
+            index = self.shards.index(shard)
+            page = shard.get_memory_page(session_id, limit, cursor[index] if cursor else None,
+                                         ascending, columns, metadata_filter)
+            next_cursor = None
+            if page['next_cursor']:
+                next_cursor = tuple(page['next_cursor'] if i == index else None for i in range(len(self.shards)))
+            return {'entries': page['entries'], 'next_cursor': next_cursor}
+        # The cursor holds one (created_at, id) position per shard
+        cursors = list(cursor) if cursor else [None] * len(self.shards)
+        pages = []
+        for index, shard in enumerate(self.shards):
+            entries = shard.get_memory_page(None, limit, cursors[index], ascending,
+                                            columns, metadata_filter)['entries']
+            for entry in entries:
+                entry['shard'] = index
+            pages.append(entries)
+        entries = list(islice(self._merge(pages, ascending), limit))
+        for entry in entries:
+            cursors[entry['shard']] = (entry['created_at'], entry['id'])
+        return {'entries': entries, 'next_cursor': tuple(cursors) if len(entries) == limit else None}
+
+    def iter_memory(self, session_id: Optional[str] = None, batch_size: int = 500,
+                    ascending: bool = False, columns: Optional[Sequence[str]] = None,
+                    metadata_filter: Optional[Dict] = None) -> Iterator[MemoryRow]:
+        if session_id:
+            return self.shard_for(session_id).iter_memory(session_id, batch_size, None, ascending,
+                                                          columns, metadata_filter)
+        return self._merge([shard.iter_memory(None, batch_size, None, ascending, columns, metadata_filter)
+                            for shard in self.shards], ascending)
+
+    def search_memory(self, query: str, session_id: Optional[str] = None, limit: int = 10,
+                      mode: str = 'keyword', columns: Optional[Sequence[str]] = None) -> List[MemoryRow]:
+        if session_id:
+            return self.shard_for(session_id).search_memory(query, session_id, limit, mode, columns)
+        results = [shard.search_memory(query, None, limit, mode, columns) for shard in self.shards]
+        # Ranked modes merge on score, the substring fallback is already newest first
+        if any('score' in entry for entries in results for entry in entries):
+            return list(islice(self._merge(results, key=lambda entry: entry.get('score', 0.0)), limit))
+        return list(islice(self._merge(results), limit))
+
+    def find_similar_prompt(self, prompt: str, threshold: float = 0.95,
+                            session_id: Optional[str] = None) -> Optional[Dict]:
+        shards = [self.shard_for(session_id)] if session_id else self.shards
+        matches = [match for match in (shard.find_similar_prompt(prompt, threshold, session_id) for shard in shards)
+                   if match]
+        return max(matches, key=lambda match: match['similarity'], default=None)
+
+    def reuse_similar_prompt(self, prompt: str, threshold: float, session_id: str) -> Optional[Dict]:
+        return self.shard_for(session_id).reuse_similar_prompt(prompt, threshold, session_id)
+
+    def get_memory_stats(self) -> Dict:
+        stats = {'total_entries': 0, 'unique_sessions': 0, 'recent_entries_24h': 0, 'pending_writes': 0,
+                 'dropped_writes': 0}
+        for shard in self.shards:
+            shard_stats = shard.get_memory_stats()
+            # Sessions never span shards, so per-shard counts add up exactly
+            for key in stats:
+                stats[key] += shard_stats.get(key, 0)
+        stats['shards'] = len(self.shards)
+        stats.update(self.short_term_memory.stats())
+        return stats
+
+    def get_activity_timeline(self, hours: int = 24) -> List[Dict]:
+        buckets: Dict[str, int] = {}
+        for shard in self.shards:
+            for bucket in shard.get_activity_timeline(hours):
+                buckets[bucket['hour']] = buckets.get(bucket['hour'], 0) + bucket['entries']
+        return [{'hour': hour, 'entries': entries} for hour, entries in sorted(buckets.items())]
+
+    def _kept_rows_per_shard(self, max_rows: int) -> List[int]:
+        def tagged(index: int, shard: MemoryManager) -> Iterator[MemoryRow]:
+            for entry in shard.iter_memory(columns=('created_at', 'id')):
+                entry['shard'] = index
+                yield entry
+        # The newest max_rows rows of the whole store, and how many of them each shard holds
+        kept = [0] * len(self.shards)
+        for entry in islice(self._merge([tagged(index, shard) for index, shard in enumerate(self.shards)]), max_rows):
+            kept[entry['shard']] += 1
+        return kept
+
+    def archive_memory(self, max_age_days: Optional[float] = None, max_rows: Optional[int] = None,
+                       batch_size: int = 1000, compact: bool = True) -> int:
+        max_rows = self.shards[0].retention_max_rows if max_rows is None else max_rows
+        if max_rows is None:
+            return sum(shard.archive_memory(max_age_days, None, batch_size, compact) for shard in self.shards)
+        # Row-count retention applies to the store as a whole, so skewed shards are cut at one global boundary
+        self.flush()
+        kept = self._kept_rows_per_shard(max_rows)
+        return sum(shard.archive_memory(max_age_days, shard_rows, batch_size, compact)
+                   for shard, shard_rows in zip(self.shards, kept))
+
+    def get_archived_memory(self, session_id: Optional[str] = None, limit: int = 20,
+                            since: Optional[str] = None, until: Optional[str] = None) -> List[MemoryRow]:
+        shards = [self.shard_for(session_id)] if session_id else self.shards
+        return list(islice(self._merge([shard.get_archived_memory(session_id, limit, since, until)
+                                        for shard in shards]), limit))
+
+    def compact_memory(self, pages_per_step: int = 256, convert: bool = False) -> int:
+        return sum(shard.compact_memory(pages_per_step, convert) for shard in self.shards)
+
+    def clear_session_memory(self, session_id: str) -> bool:
+        return self.shard_for(session_id).clear_session_memory(session_id)
+
+    def clear_all_memory(self) -> bool:
+        return all([shard.clear_all_memory() for shard in self.shards])
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        logging.info(f"Closed {len(self.shards)} memory shards")
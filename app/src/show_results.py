@@ -7,6 +7,7 @@ import sqlite3
 import os
 from pathlib import Path
 from datetime import datetime
+from memory_manager import MemoryManager, register_memory_functions
 
 def show_memory_results():
     """Show all results stored in memory"""
@@ -14,14 +15,16 @@ def show_memory_results():
     print("=" * 80)
     
     try:
-        # Connect to the demo memory database
+        # Connect to the demo memory database (opening it once applies any pending migrations)
+        MemoryManager('demo_memory.db').close()
         conn = sqlite3.connect('demo_memory.db')
+        register_memory_functions(conn)
         cursor = conn.cursor()
         
         # Get all memory entries
         cursor.execute('''
-            SELECT original_prompt, enhanced_prompt, image_path, model_path, created_at, session_id
-            FROM memory 
+            SELECT original_prompt, inflate(enhanced_prompt), image_path, model_path, created_at, session_id
+            FROM memory_content 
             ORDER BY created_at DESC
         ''')
         
@@ -0,0 +1,96 @@
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+class SQLitePool:
+    def __init__(self, db_path: str, size: int = 4, busy_timeout_ms: int = 5000,
+                 cache_size_kb: int = 20000, statement_cache_size: int = 128,
+                 on_connect: Optional[Callable[[sqlite3.Connection], None]] = None,
+                 auto_vacuum: Optional[str] = None):
+        self.db_path = db_path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.statement_cache_size = statement_cache_size
+        self.on_connect = on_connect
+        self.auto_vacuum = auto_vacuum
+        self._idle = queue.LifoQueue()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        # WAL allows one writer at a time; serialize writers in-process instead of
+        # letting them spin on SQLITE_BUSY, readers are never blocked by this lock
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size
+        )
+        if self.auto_vacuum:
+            # Must precede the switch to WAL, which writes the header of a new database
+            conn.execute(f'PRAGMA auto_vacuum={self.auto_vacuum}')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        if self.on_connect:
+            self.on_connect(conn)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        if self._closed:
+            raise sqlite3.ProgrammingError(f"Connection pool for {self.db_path} is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self.size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+        return self._idle.get(timeout=self.busy_timeout_ms / 1000)
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        with self._write_lock, self.connection() as conn:
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._connections.clear()
+        logging.info(f"Closed SQLite connection pool for {self.db_path}")
@@ -12,60 +12,141 @@ from diffusers import StableDiffusionPipeline
 import time
 from local_llm import LocalLLM
 from memory_manager import MemoryManager
+from cpu_inference import DEFAULT_PROFILE, load_cpu_pipeline
+from batch_generation import GenerationRequest, generate_batch
+from schedulers import DEFAULT_PRESET, available_presets, preset_settings
+from generation_queue import DONE, FAILED, QUEUED, GenerationQueue
+from diffusion_client import DIFFUSION_SERVICE_URL, DiffusionClient
 logging.basicConfig(level=logging.INFO)
+MODEL_ID = "runwayml/stable-diffusion-v1-5"
 @st.cache_resource
 def init_components():
     llm = LocalLLM()
     memory = MemoryManager()
+    if DIFFUSION_SERVICE_URL:
+        # The shared diffusion service owns the model; this process stays light
+        st.info(f"Using the shared diffusion service at {DIFFUSION_SERVICE_URL}")
+        return llm, memory, None
     with st.spinner("Loading AI Image Generation Model..."):
         try:
-            model_id = "runwayml/stable-diffusion-v1-5"
+            model_id = MODEL_ID
             if torch.backends.mps.is_available():
                 device = "mps"
             elif torch.cuda.is_available():
                 device = "cuda"
             else:
                 device = "cpu"
-            torch_dtype = torch.float16 if device != "cpu" else torch.float32
             if device == "cpu":
-                st.warning("Running on CPU. Image generation will be very slow.")
+                st.warning(f"Running on CPU with the '{DEFAULT_PROFILE}' profile. Image generation will be slow.")
+                pipe = load_cpu_pipeline(model_id, cache_dir="model_cache")
             else:
+                torch_dtype = torch.float16
                 st.info(f"Using {device.upper()} device with {torch_dtype} for accelerated performance.")
-            pipe = StableDiffusionPipeline.from_pretrained(
-                model_id,
-                torch_dtype=torch_dtype,
-                safety_checker=None,
-                cache_dir="model_cache",
-            )
-            pipe = pipe.to(device)
-            pipe.enable_attention_slicing()
+                pipe = StableDiffusionPipeline.from_pretrained(
+                    model_id,
+                    torch_dtype=torch_dtype,
+                    safety_checker=None,
+                    cache_dir="model_cache",
+                )
+                pipe = pipe.to(device)
+                pipe.enable_attention_slicing()
             st.success("✅ AI Image Generation Model Loaded!")
             return llm, memory, pipe
         except Exception as e:
             st.error(f"Error loading AI model: {str(e)}")
             st.info("Falling back to demo mode - images will be placeholders")
             return llm, memory, None
+@st.cache_resource
+def get_generation_queue(_pipe):
+    # One queue per process: every session submits here, and its worker is the
+    # only thread that ever drives the shared pipeline
+    return GenerationQueue(_pipe)
 def generate_image(pipe, prompt, filename):
+    return generate_images(pipe, prompt, filename)[0]
+def generate_images(pipe, prompt, filename, num_images=1, preset=DEFAULT_PRESET, seed=None):
     try:
         if pipe is None:
-            return create_demo_image(prompt, filename)
+            return [create_demo_image(prompt, filename)]
         with st.spinner("Generating image... This may take a moment."):
             start_time = time.time()
-            image = pipe(
-                prompt,
-                num_inference_steps=20,
-                guidance_scale=7.5
-            ).images[0]
+            request = GenerationRequest(prompt, num_images_per_prompt=num_images, seed=seed, **preset_settings(preset))
+            images = generate_batch(pipe, [request])[0]
             end_time = time.time()
             generation_time = end_time - start_time
-            st.info(f"Image generated in {generation_time:.2f} seconds.")
-        img_path = Path("outputs/images") / filename
-        img_path.parent.mkdir(parents=True, exist_ok=True)
-        image.save(img_path)
-        return img_path
+            st.info(f"{len(images)} image(s) generated in {generation_time:.2f} seconds (seed {request.seed}).")
+        return save_images(images, filename)
     except Exception as e:
         st.error(f"Error generating image: {e}")
-        return create_demo_image(prompt, filename)
+        return [create_demo_image(prompt, filename)]
+def save_images(images, filename):
+    img_paths = []
+    for index, image in enumerate(images):
+        img_path = Path("outputs/images") / (filename if index == 0 else f"{Path(filename).stem}_{index}.png")
+        img_path.parent.mkdir(parents=True, exist_ok=True)
+        image.save(img_path)
+        img_paths.append(img_path)
+    return img_paths
+def finish_generation(memory, job, image_paths):
+    image_path = image_paths[0] if image_paths else None
+    if image_path:
+        st.success(f"✅ Image generated: {image_path}")
+        st.subheader("🖼️ Generated Image")
+        for path in image_paths:
+            display_image_if_exists(str(path))
+    st.info("Converting to 3D model...")
+    model_filename = f"demo_model_{datetime.now().strftime('%Y%m%d_%H%M%S')}.glb"
+    model_path = Path("outputs/models") / model_filename
+    model_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(model_path, 'wb') as f:
+        f.write(b'# Demo GLB file - In real deployment, this would be a 3D model')
+    st.success(f"✅ 3D Model generated: {model_path}")
+    st.subheader("🔮 Generated 3D Model")
+    display_3d_model_if_exists(str(model_path))
+    st.info("Storing in memory...")
+    memory_entry = {
+        'timestamp': datetime.now().isoformat(),
+        'original_prompt': job['user_prompt'],
+        'enhanced_prompt': job['enhanced_prompt'],
+        'image_path': str(image_path) if image_path else f"outputs/images/{job['image_filename']}",
+        'model_path': str(model_path),
+        'session_id': 'streamlit-user',
+        'metadata': {'enhancer': job['enhancer'], 'seed': job.get('seed')}
+    }
+    if memory.store_memory(memory_entry):
+        st.success("✅ Stored in memory successfully!")
+    else:
+        st.error("❌ Failed to store in memory")
+    st.balloons()
+def render_generation_jobs(generation_queue, memory):
+    jobs = st.session_state.get('generation_jobs', [])
+    pending = False
+    for job in list(jobs):
+        queued_job = generation_queue.get(job['id'])
+        if queued_job is None:
+            st.warning(f"Generation for '{job['user_prompt'][:50]}' is no longer available")
+            jobs.remove(job)
+            continue
+        st.write(f"**{job['enhanced_prompt'][:80]}**")
+        if queued_job.status == QUEUED:
+            st.info(f"⏳ Waiting in queue (position {generation_queue.position(job['id'])})")
+            pending = True
+        elif queued_job.status == DONE:
+            finish_generation(memory, job, save_images(queued_job.images, job['image_filename']))
+            jobs.remove(job)
+            generation_queue.release(job['id'])
+        elif queued_job.status == FAILED:
+            st.error(f"Error generating image: {queued_job.error}")
+            jobs.remove(job)
+            generation_queue.release(job['id'])
+        else:
+            st.progress(queued_job.progress, text=f"Step {queued_job.step}/{queued_job.total_steps}")
+            if queued_job.preview is not None:
+                st.image(queued_job.preview, caption="Preview", width=256)
+            pending = True
+    if pending:
+        # Poll across reruns instead of blocking this session on the pipeline
+        time.sleep(1)
+        st.rerun()
 def create_demo_image(prompt, filename):
     try:
         from PIL import Image, ImageDraw, ImageFont
@@ -134,7 +215,15 @@ def main():
     st.title("🚀 AI Creative Pipeline")
     st.markdown("Transform your ideas into stunning 3D models with AI")
     llm, memory, pipe = init_components()
+    if DIFFUSION_SERVICE_URL:
+        generation_queue = DiffusionClient(DIFFUSION_SERVICE_URL, MODEL_ID)
+    else:
+        generation_queue = get_generation_queue(pipe) if pipe is not None else None
     st.sidebar.title("🎛️ Controls")
+    num_images = st.sidebar.slider("Images per prompt", 1, 4, 1)
+    presets = available_presets(MODEL_ID)
+    preset = st.sidebar.selectbox("Speed preset", presets, index=presets.index(DEFAULT_PRESET))
+    seed = st.sidebar.number_input("Seed (0 = random)", min_value=0, max_value=2 ** 32 - 1, value=0, step=1)
     tab1, tab2, tab3, tab4 = st.tabs(["🎨 Generate", "🖼️ Gallery", "🧠 Memory", "📊 Analytics"])
     with tab1:
         st.header("🎨 Generate 3D Model")
@@ -150,43 +239,29 @@ def main():
                     with st.spinner("Processing your request..."):
                         try:
                             st.info("Step 1: Enhancing prompt with AI...")
-                            enhanced_prompt = llm.enhance_prompt(user_prompt)
+                            enhanced_prompt, enhance_report = llm.enhance_prompt_with_report(user_prompt)
                             st.success(f"Enhanced: {enhanced_prompt}")
                             st.info("Step 2: Generating image...")
                             image_filename = f"generated_image_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-                            image_path = generate_image(pipe, enhanced_prompt, image_filename)
-                            if image_path:
-                                st.success(f"✅ Image generated: {image_path}")
-                                st.subheader("🖼️ Generated Image")
-                                display_image_if_exists(str(image_path))
-                            st.info("Step 3: Converting to 3D model...")
-                            model_filename = f"demo_model_{datetime.now().strftime('%Y%m%d_%H%M%S')}.glb"
-                            model_path = Path("outputs/models") / model_filename
-                            model_path.parent.mkdir(parents=True, exist_ok=True)
-                            with open(model_path, 'wb') as f:
-                                f.write(b'# Demo GLB file - In real deployment, this would be a 3D model')
-                            st.success(f"✅ 3D Model generated: {model_path}")
-                            st.subheader("🔮 Generated 3D Model")
-                            display_3d_model_if_exists(str(model_path))
-                            st.info("Step 4: Storing in memory...")
-                            memory_entry = {
-                                'timestamp': datetime.now().isoformat(),
-                                'original_prompt': user_prompt,
+                            job = {
+                                'user_prompt': user_prompt,
                                 'enhanced_prompt': enhanced_prompt,
-                                'image_path': str(image_path) if image_path else f"outputs/images/{image_filename}",
-                                'model_path': str(model_path),
-                                'session_id': 'streamlit-user'
+                                'image_filename': image_filename,
+                                'enhancer': enhance_report['backend']
                             }
-                            success = memory.store_memory(memory_entry)
-                            if success:
-                                st.success("✅ Stored in memory successfully!")
+                            if generation_queue is not None:
+                                request = GenerationRequest(enhanced_prompt, num_images_per_prompt=num_images,
+                                                            seed=seed or None, **preset_settings(preset))
+                                job['id'] = generation_queue.submit(request)
+                                job['seed'] = request.seed
+                                st.session_state.setdefault('generation_jobs', []).append(job)
                             else:
-                                st.error("❌ Failed to store in memory")
-                            st.balloons()
+                                finish_generation(memory, job, generate_images(pipe, enhanced_prompt, image_filename, num_images, preset))
                         except Exception as e:
                             st.error(f"Error: {str(e)}")
                 else:
                     st.warning("Please enter a prompt first!")
+            jobs_container = st.container()
         with col2:
             st.subheader("💡 Prompt Examples")
             examples = [
@@ -248,15 +323,18 @@ def main():
     with tab3:
         st.header("🧠 Memory Browser")
         search_query = st.text_input("Search memory:", placeholder="e.g., dragon, robot, city")
+        search_mode = st.radio("Search mode:", ["Keyword", "Semantic"], horizontal=True)
         col1, col2 = st.columns(2)
         with col1:
             if st.button("🔍 Search"):
                 if search_query:
-                    results = memory.search_memory(search_query)
+                    results = memory.search_memory(search_query, mode=search_mode.lower())
                     st.subheader(f"Search Results for '{search_query}'")
                     if results:
                         for i, entry in enumerate(results):
                             with st.expander(f"Entry {i+1}: {entry['original_prompt'][:50]}..."):
+                                if entry.get('snippet'):
+                                    st.markdown(f"**Match:** {entry['snippet']}")
                                 st.write(f"**Original:** {entry['original_prompt']}")
                                 st.write(f"**Enhanced:** {entry['enhanced_prompt']}")
                                 st.write(f"**Created:** {entry['created_at']}")
@@ -329,12 +407,21 @@ def main():
                 else:
                     st.metric("Generated 3D Models", 0)
         st.subheader("📈 Memory Trends")
-        recent_memory = memory.get_long_term_memory(limit=50)
+        timeline = memory.get_activity_timeline(hours=24 * 7)
+        if timeline:
+            st.write("**Generations per hour (last 7 days):**")
+            st.bar_chart(timeline, x='hour', y='entries')
+        recent_memory = memory.get_long_term_memory(limit=10, columns=['created_at', 'original_prompt'])
         if recent_memory:
             st.write("**Recent Activity Timeline:**")
             for entry in recent_memory[:10]:
                 st.write(f"🕐 {entry['created_at']} - {entry['original_prompt'][:60]}...")
         else:
             st.info("No memory data available for visualization")
+    if generation_queue is not None:
+        queue_stats = generation_queue.stats()
+        st.sidebar.caption(f"🧵 Generation queue: {queue_stats['queued']} waiting, {queue_stats['running']} running")
+        with jobs_container:
+            render_generation_jobs(generation_queue, memory)
 if __name__ == "__main__":
     main() 
\ No newline at end of file
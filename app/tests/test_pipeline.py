@@ -6,9 +6,37 @@ Demonstrates the complete workflow from prompt to 3D model generation
 
 import logging
 import json
+import sqlite3
+import tempfile
+import threading
+import time
 from pathlib import Path
+import requests
 from local_llm import LocalLLM
 from memory_manager import MemoryManager
+from sharded_memory import ShardedMemoryManager
+from prompt_budget import PromptBudget
+from batch_generation import GenerationRequest, generate_batch, plan_batches
+from generation_queue import DONE, GenerationQueue
+from result_cache import ResultCache
+from schedulers import apply_scheduler
+from session_memory import SessionMemory
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import diffusers
+except ImportError:
+    diffusers = None
+
+try:
+    import torch
+    from diffusion_service import DiffusionService, ModelRegistry
+except ImportError:
+    ModelRegistry = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,6 +59,117 @@ def test_local_llm():
         print(f"\nOriginal: {prompt}")
         print(f"Enhanced: {enhanced}")
         print("-" * 80)
+    
+    # Per-request details come back with the prompt; a shared instance keeps no "last" state
+    enhanced, report = llm.enhance_prompt_with_report(test_prompts[0])
+    assert report['backend'] in (*llm.backends, 'fallback')
+    assert report['truncated_tokens'] >= 0
+    assert not hasattr(llm, 'last_backend')
+
+def test_local_llm_streaming():
+    """Test SSE parsing, the token budget early stop and TTFT bucketing against a stubbed server"""
+    print("\n📡 Testing Local LLM Streaming...")
+    
+    class StubResponse:
+        def __init__(self, status_code=200, lines=()):
+            self.status_code = status_code
+            self.lines = lines
+            self.read = 0
+        
+        def __enter__(self):
+            return self
+        
+        def __exit__(self, *exc_info):
+            return False
+        
+        def raise_for_status(self):
+            pass
+        
+        def iter_lines(self, decode_unicode=False):
+            for line in self.lines:
+                self.read += 1
+                yield line
+    
+    state = {'warm_status': 503, 'lines': [], 'payloads': [], 'streams': []}
+    
+    def stub_get(url, **kwargs):
+        return StubResponse()
+    
+    def stub_post(url, json=None, **kwargs):
+        state['payloads'].append(json)
+        if not json.get('stream'):
+            return StubResponse(state['warm_status'])
+        response = StubResponse(lines=state['lines'])
+        state['streams'].append(response)
+        return response
+    
+    original_get, original_post = requests.get, requests.post
+    requests.get, requests.post = stub_get, stub_post
+    try:
+        llm = LocalLLM(server_url="http://llm.test")
+        assert 'server' in llm.backends
+        assert not llm.prefix_cached
+        
+        # Keep-alive comments and blank lines are skipped, and reading ends at the stop event
+        state['lines'] = [
+            'data: {"content": "A shiny"}',
+            '',
+            ': keep-alive',
+            'data: {"content": " robot", "stop": true}',
+            'data: {"content": " ignored"}'
+        ]
+        assert llm._enhance_with_server("A robot") == "A shiny robot"
+        assert state['streams'][-1].read == 4
+        # The prefix could not be warmed, so this request counts as uncached
+        assert llm.get_ttft_report()['uncached']['requests'] == 1
+        assert llm.get_ttft_report()['cached']['requests'] == 0
+        
+        # Streaming stops once the text encoder budget is used up
+        state['warm_status'] = 200
+        state['lines'] = ['data: {"content": "dragon scales, "}'] * 200
+        enhanced = llm._enhance_with_server("A dragon")
+        assert llm.prefix_cached
+        assert llm.budget.exceeded(enhanced)
+        assert state['streams'][-1].read < 200
+        assert llm.get_ttft_report()['cached']['requests'] == 1
+        
+        state['lines'] = ['data: {"content": "A robot", "stop": true}']
+        reuse = llm.measure_prefix_reuse("A robot")
+        assert reuse['ttft_with_prefix_reuse'] is not None
+        assert not state['payloads'][-2]['cache_prompt']
+        assert state['payloads'][-1]['cache_prompt']
+        
+        report = llm.get_ttft_report()
+        print(f"TTFT report: {report}")
+        assert report['uncached']['requests'] == 2
+        assert report['cached']['requests'] == 2
+        assert report['cached']['min_ttft'] <= report['cached']['avg_ttft'] <= report['cached']['max_ttft']
+    finally:
+        requests.get, requests.post = original_get, original_post
+
+def test_prompt_budget():
+    """Test that enhanced prompts are sized to the CLIP text encoder context"""
+    print("\n📏 Testing Prompt Token Budget...")
+    
+    budget = PromptBudget()
+    long_prompt = ", ".join(["a majestic dragon with detailed scales"] * 30)
+    truncated, report = budget.apply(long_prompt)
+    
+    print(f"Budget tokens: {report['budget_tokens']}")
+    print(f"Generated tokens: {report['generated_tokens']}")
+    print(f"Truncated tokens: {report['truncated_tokens']}")
+    assert report['truncated_tokens'] > 0
+    assert budget.count(truncated) <= budget.content_tokens
+    
+    # Truncation keeps the original wording and casing rather than re-decoded tokens
+    styled_prompt = " ".join(["A Majestic Dragon, 8K, ultra-detailed scales;"] * 30)
+    truncated, _ = budget.apply(styled_prompt)
+    assert styled_prompt.startswith(truncated)
+    assert budget.count(truncated) <= budget.content_tokens
+    
+    short_prompt, report = budget.apply("A robot")
+    assert short_prompt == "A robot"
+    assert report['truncated_tokens'] == 0
 
 def test_memory_manager():
     """Test the memory management functionality"""
@@ -81,6 +220,626 @@ def test_memory_manager():
     print(f"  Recent entries (24h): {stats.get('recent_entries_24h', 0)}")
     print(f"  Active sessions: {stats.get('active_sessions', 0)}")
 
+def test_memory_search():
+    """Test full-text memory search ranking, prefixes, session scope and unsafe input"""
+    print("\n🔎 Testing Memory Full-Text Search...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        memory = MemoryManager(str(Path(tmp_dir) / "search.db"))
+        prompts = [
+            ('search-a', 'A dragon', 'A majestic red dragon breathing fire over a castle'),
+            ('search-a', 'A robot', 'A futuristic robot with metallic surfaces'),
+            ('search-b', 'Two dragons', 'Two dragons circling a mountain at dawn'),
+            ('search-b', 'A lighthouse', 'A lonely lighthouse on a cliff at sunset'),
+        ]
+        for session_id, original, enhanced in prompts:
+            memory.store_memory({'session_id': session_id, 'timestamp': '2023-12-01T14:30:22',
+                                 'original_prompt': original, 'enhanced_prompt': enhanced})
+        
+        results = memory.search_memory('dragon')
+        print(f"Matches for 'dragon': {[entry['original_prompt'] for entry in results]}")
+        assert memory.fts_enabled
+        assert {entry['original_prompt'] for entry in results} == {'A dragon', 'Two dragons'}
+        assert all('snippet' in entry and 'score' in entry for entry in results)
+        assert results[0]['score'] >= results[-1]['score']
+        
+        # Words in the enhanced prompt are indexed too, and terms are prefix-matched
+        assert [entry['original_prompt'] for entry in memory.search_memory('metal')] == ['A robot']
+        assert [entry['original_prompt'] for entry in memory.search_memory('dragon', session_id='search-b')] \
+            == ['Two dragons']
+        
+        # FTS syntax in user input is quoted rather than parsed
+        assert memory.search_memory('dragon" OR robot*') == []
+        assert memory.search_memory('NEAR(') == []
+        
+        # Archived rows leave the index with them
+        assert memory.archive_memory(max_rows=2, compact=False) == 2
+        assert [entry['original_prompt'] for entry in memory.search_memory('dragon')] == ['Two dragons']
+        assert memory.search_memory('robot') == []
+        memory.close()
+
+def test_memory_schema_without_app_functions():
+    """Test that plain SQLite clients can write memory rows and keep full-text search in sync"""
+    print("\n🗄️ Testing Memory Schema Without App Functions...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = str(Path(tmp_dir) / "plain.db")
+        memory = MemoryManager(db_path)
+        long_prompt = 'A majestic red dragon breathing fire over a castle, ' * 4
+        memory.store_memory({'session_id': 'plain', 'timestamp': '2023-12-01T14:30:22',
+                             'original_prompt': 'A dragon', 'enhanced_prompt': long_prompt})
+        memory.store_memory({'session_id': 'plain', 'timestamp': '2023-12-01T14:31:22',
+                             'original_prompt': 'A robot', 'enhanced_prompt': 'A shiny metallic robot'})
+        
+        # A connection without inflate(), like the sqlite3 CLI or a backup script
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("INSERT INTO memory (timestamp, session_id, original_prompt, enhanced_prompt) "
+                         "VALUES ('2023-12-01T14:32:22', 'plain', 'A lighthouse', 'A lonely lighthouse at sunset')")
+            conn.execute("UPDATE memory SET original_prompt = 'A sleepy dragon' WHERE original_prompt = 'A dragon'")
+            conn.execute("DELETE FROM memory WHERE original_prompt = 'A robot'")
+            bodies = dict(conn.execute('SELECT original_prompt, enhanced_prompt FROM memory_content').fetchall())
+        assert bodies['A lighthouse'] == 'A lonely lighthouse at sunset'
+        assert isinstance(bodies['A sleepy dragon'], bytes)
+        
+        assert [entry['original_prompt'] for entry in memory.search_memory('lighthouse')] == ['A lighthouse']
+        assert [entry['original_prompt'] for entry in memory.search_memory('sleepy')] == ['A sleepy dragon']
+        assert [entry['enhanced_prompt'] for entry in memory.search_memory('castle')] == [long_prompt]
+        assert memory.search_memory('metallic') == []
+        assert memory.get_memory_stats()['total_entries'] == 2
+        memory.close()
+
+def test_memory_semantic_search_after_delete():
+    """Test that semantic search skips rows deleted after they were indexed"""
+    print("\n🧭 Testing Semantic Search After Deletes...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = str(Path(tmp_dir) / "semantic.db")
+        memory = MemoryManager(db_path)
+        # The oldest rows are the closest matches, so they fill the first candidates
+        for i in range(60):
+            prompt = f'A red dragon over a castle {i}' if i < 40 else f'A dragon asleep in a cave {i}'
+            memory.store_memory({'session_id': f'semantic-{i % 2}', 'timestamp': f'2023-12-01T10:{i:02d}:00',
+                                 'original_prompt': prompt, 'enhanced_prompt': prompt})
+        assert len(memory.search_memory('A red dragon over a castle', mode='semantic', limit=5)) == 5
+        
+        assert memory.archive_memory(max_rows=20, compact=False) == 40
+        results = memory.search_memory('A red dragon over a castle', mode='semantic', limit=10)
+        print(f"Semantic matches after archiving: {len(results)}")
+        assert len(results) == 10
+        assert all(entry['original_prompt'].startswith('A dragon asleep') for entry in results)
+        results = memory.search_memory('A red dragon over a castle', session_id='semantic-1', mode='semantic', limit=5)
+        assert len(results) == 5 and {entry['session_id'] for entry in results} == {'semantic-1'}
+        
+        # Rows deleted by another connection are dropped from the index on the next search
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("DELETE FROM memory WHERE session_id = 'semantic-0'")
+        results = memory.search_memory('A red dragon over a castle', mode='semantic', limit=10)
+        assert len(results) == 10 and {entry['session_id'] for entry in results} == {'semantic-1'}
+        assert len(memory._semantic_index) == 10
+        memory.close()
+
+def test_similar_prompt_reuse():
+    """Test SimHash near-duplicate lookup and the reuse entry recorded for it"""
+    print("\n♻️ Testing Similar Prompt Reuse...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = Path(tmp_dir) / "dragon.png"
+        image_path.write_bytes(b'png')
+        db_path = str(Path(tmp_dir) / "reuse.db")
+        memory = MemoryManager(db_path)
+        memory.store_memory({'session_id': 'reuse-a', 'timestamp': '2023-12-01T14:30:22',
+                             'original_prompt': 'A majestic red dragon breathing fire over a castle',
+                             'enhanced_prompt': 'A majestic red dragon, cinematic lighting',
+                             'image_path': str(image_path)})
+        # Outputs that no longer exist on disk are never reused
+        memory.store_memory({'session_id': 'reuse-a', 'timestamp': '2023-12-01T14:31:22',
+                             'original_prompt': 'A lonely lighthouse on a cliff at sunset',
+                             'image_path': str(Path(tmp_dir) / "missing.png")})
+        
+        match = memory.find_similar_prompt('Please generate a majestic red dragon, breathing fire over the castle!')
+        print(f"Near-duplicate match: {match and match['original_prompt']}")
+        assert match and match['image_path'] == str(image_path) and match['similarity'] == 1.0
+        assert memory.find_similar_prompt('A majestic red dragon breathing fire over a tall castle') is None
+        assert memory.find_similar_prompt('A futuristic robot in a cyberpunk city', threshold=0.5) is None
+        assert memory.find_similar_prompt('A lonely lighthouse on a cliff at sunset') is None
+        
+        # Lookups and the recorded reuse stay within the caller's session
+        assert memory.reuse_similar_prompt('A majestic red dragon breathing fire over the castle', 0.95, 'reuse-b') is None
+        match = memory.reuse_similar_prompt('A majestic red dragon breathing fire over the castle', 0.95, 'reuse-a')
+        assert match and match['session_id'] == 'reuse-a'
+        reused = memory.get_long_term_memory(session_id='reuse-a', limit=1)[0]
+        assert reused['original_prompt'] == 'A majestic red dragon breathing fire over the castle'
+        assert reused['image_path'] == str(image_path)
+        assert reused['metadata']['reused_from'] == match['id']
+        assert memory.get_long_term_memory(session_id='reuse-b') == []
+        
+        # Rows from plain SQLite clients carry no hash until the next lookup fills it in
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("INSERT INTO memory (timestamp, session_id, original_prompt, enhanced_prompt, image_path) "
+                         "VALUES ('2023-12-01T14:40:22', 'reuse-c', 'A castle in the clouds', '', ?)", (str(image_path),))
+        match = memory.find_similar_prompt('The castle in the clouds', session_id='reuse-c')
+        assert match and match['original_prompt'] == 'A castle in the clouds'
+        memory.close()
+
+def test_memory_stats_consistency():
+    """Test that trigger-maintained stats match the table after inserts, deletes and archiving"""
+    print("\n📊 Testing Memory Stats Consistency...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        memory = MemoryManager(str(Path(tmp_dir) / "stats.db"))
+        def assert_consistent():
+            stats = memory.get_memory_stats()
+            with memory._pool.connection() as conn:
+                total, sessions = conn.execute('SELECT COUNT(*), COUNT(DISTINCT session_id) FROM memory').fetchone()
+                hourly = dict(conn.execute('''
+                    SELECT strftime('%Y-%m-%d %H:00:00', created_at), COUNT(*) FROM memory GROUP BY 1
+                ''').fetchall())
+            timeline = {bucket['hour']: bucket['entries'] for bucket in memory.get_activity_timeline()}
+            print(f"Stats: {stats['total_entries']} entries, {stats['unique_sessions']} sessions")
+            assert (stats['total_entries'], stats['unique_sessions']) == (total, sessions)
+            assert stats['recent_entries_24h'] == total
+            assert timeline == hourly
+        
+        for index in range(9):
+            memory.store_memory({'session_id': f'stats-{index % 3}', 'timestamp': '2023-12-01T14:30:22',
+                                 'original_prompt': f'Prompt {index}', 'enhanced_prompt': f'Enhanced {index}'})
+        assert_consistent()
+        
+        # Removing a session's last row must drop it from the session count
+        with memory._pool.transaction() as conn:
+            conn.execute("DELETE FROM memory WHERE session_id = 'stats-0'")
+        assert_consistent()
+        assert memory.get_memory_stats()['unique_sessions'] == 2
+        
+        memory.archive_memory(max_rows=2, compact=False)
+        assert_consistent()
+        
+        # Rebuilding from scratch must agree with the incrementally maintained counters
+        before = memory.get_memory_stats()
+        assert memory.rebuild_stats()
+        after = memory.get_memory_stats()
+        assert (before['total_entries'], before['unique_sessions']) == (after['total_entries'], after['unique_sessions'])
+        
+        memory.clear_all_memory()
+        assert_consistent()
+        assert memory.get_memory_stats()['total_entries'] == 0
+        memory.close()
+
+def test_memory_write_behind():
+    """Test that queued memory entries are persisted by flush() and close()"""
+    print("\n📝 Testing Write-Behind Memory Persistence...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = str(Path(tmp_dir) / "write_behind.db")
+        memory = MemoryManager(db_path, write_behind=True, flush_interval=60)
+        entry = {
+            'timestamp': '2023-12-01T14:30:22',
+            'session_id': 'test-user-2',
+            'original_prompt': 'A castle',
+            'enhanced_prompt': 'A towering castle at dusk',
+            'image_path': 'outputs/images/test_image_3.png',
+            'model_path': 'outputs/models/test_model_3.glb'
+        }
+        for _ in range(3):
+            memory.store_memory(entry)
+        memory.flush()
+        flushed = memory.get_memory_stats().get('total_entries', 0)
+        print(f"Entries after flush: {flushed}")
+        assert flushed == 3
+        
+        memory.store_memory(entry)
+        memory.close()
+        reopened = MemoryManager(db_path)
+        with reopened._pool.connection() as conn:
+            interned = conn.execute('SELECT COUNT(*) FROM prompt_texts').fetchone()[0]
+        print(f"Interned enhanced prompts: {interned}")
+        assert interned == 1
+        assert reopened.get_long_term_memory(limit=1)[0]['enhanced_prompt'] == entry['enhanced_prompt']
+        persisted = reopened.get_memory_stats().get('total_entries', 0)
+        reopened.close()
+        print(f"Entries after close: {persisted}")
+        assert persisted == 4
+
+def test_memory_write_retry():
+    """Test that busy write-behind batches are retried and only bad entries are dropped"""
+    print("\n🔁 Testing Write-Behind Retries...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        memory = MemoryManager(str(Path(tmp_dir) / "retry.db"), write_behind=True, flush_interval=60)
+        insert_rows = memory._insert_rows
+        failures = {'busy': 2}
+        def flaky_insert(conn, rows, *args):
+            if failures['busy']:
+                failures['busy'] -= 1
+                raise sqlite3.OperationalError('database is locked')
+            if any(row[2] == 'broken' for row in rows):
+                raise sqlite3.IntegrityError('constraint failed')
+            return insert_rows(conn, rows, *args)
+        memory._insert_rows = flaky_insert
+        
+        for prompt in ('A castle', 'broken', 'A tower'):
+            assert memory.store_memory({'session_id': 'retry-user', 'timestamp': '2023-12-01T14:30:22',
+                                        'original_prompt': prompt, 'enhanced_prompt': prompt})
+        flushed = memory.flush()
+        stats = memory.get_memory_stats()
+        print(f"Flush clean: {flushed}, stats: {stats}")
+        assert not flushed
+        assert stats['total_entries'] == 2
+        assert stats['dropped_writes'] == 1
+        assert memory.flush()
+        memory.close()
+
+def test_memory_export_import():
+    """Test that exported memory round-trips through import"""
+    print("\n📦 Testing Memory Export/Import...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = MemoryManager(str(Path(tmp_dir) / "source.db"))
+        for i in range(5):
+            source.store_memory({
+                'timestamp': '2023-12-01T14:30:22',
+                'session_id': 'test-user-3',
+                'original_prompt': f'A lighthouse {i}',
+                'enhanced_prompt': f'A lighthouse on a cliff {i}',
+                'metadata': {'enhancer': 'fallback'}
+            })
+        export_path = str(Path(tmp_dir) / "memory.jsonl")
+        exported = source.export_memory(export_path, batch_size=2)
+        source.close()
+        
+        target = MemoryManager(str(Path(tmp_dir) / "target.db"))
+        imported = target.import_memory(export_path, batch_size=2)
+        entries = target.get_long_term_memory(metadata_filter={'enhancer': 'fallback'})
+        target.close()
+        print(f"Exported: {exported}, imported: {imported}")
+        assert exported == imported == 5
+        assert len(entries) == 5
+        assert entries[0]['original_prompt'] == 'A lighthouse 4'
+
+def test_memory_archive():
+    """Test that retention moves old entries into queryable monthly archives"""
+    print("\n🗄️ Testing Memory Retention and Archiving...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        memory = MemoryManager(str(Path(tmp_dir) / "retention.db"), retention_max_rows=2)
+        for i in range(5):
+            memory.store_memory({
+                'timestamp': '2023-12-01T14:30:22',
+                'session_id': 'test-user-4',
+                'original_prompt': f'A windmill {i}',
+                'enhanced_prompt': f'A windmill in a tulip field {i}'
+            })
+        archived = memory.archive_memory(batch_size=2)
+        remaining = memory.get_memory_stats().get('total_entries', 0)
+        archived_entries = memory.get_archived_memory(session_id='test-user-4')
+        memory.close()
+        print(f"Archived: {archived}, remaining: {remaining}")
+        assert archived == 3
+        assert remaining == 2
+        assert sorted(entry['original_prompt'] for entry in archived_entries) == [
+            'A windmill 0', 'A windmill 1', 'A windmill 2'
+        ]
+
+def test_sharded_memory():
+    """Test that sharded memory partitions writes and merges reads by time"""
+    print("\n🧩 Testing Sharded Memory...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        memory = ShardedMemoryManager(str(Path(tmp_dir) / "sharded.db"), shards=3)
+        for i in range(12):
+            memory.store_memory({
+                'timestamp': '2023-12-01T14:30:22',
+                'session_id': f'test-user-{i % 4}',
+                'original_prompt': f'A balloon {i}',
+                'enhanced_prompt': f'A hot air balloon over hills {i}'
+            })
+        stats = memory.get_memory_stats()
+        first_page = memory.get_memory_page(limit=5)
+        second_page = memory.get_memory_page(limit=10, cursor=first_page['next_cursor'])
+        session_entries = memory.get_long_term_memory(session_id='test-user-1')
+        memory.close()
+        
+        entries = first_page['entries'] + second_page['entries']
+        print(f"Entries per shard: {[sum(1 for e in entries if e['shard'] == s) for s in range(3)]}")
+        assert stats['total_entries'] == 12
+        assert stats['unique_sessions'] == 4
+        assert len({(entry['shard'], entry['id']) for entry in entries}) == 12
+        assert [entry['created_at'] for entry in entries] == sorted((entry['created_at'] for entry in entries), reverse=True)
+        assert len(session_entries) == 3
+
+def test_sharded_archive_skew():
+    """Test that row-count retention keeps the newest rows across all shards"""
+    print("\n🧩 Testing Sharded Archive Under Skew...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        memory = ShardedMemoryManager(str(Path(tmp_dir) / "skewed.db"), shards=3)
+        # Like the API, almost every row lands in the one shard of a single session
+        for i in range(20):
+            memory.store_memory({'timestamp': f'2023-12-01T14:{i:02d}:00', 'session_id': 'super-user',
+                                 'original_prompt': f'A balloon {i}'})
+        memory.store_memory({'timestamp': '2023-12-01T13:00:00', 'session_id': 'other-user',
+                             'original_prompt': 'An old balloon'})
+        newest = [entry['original_prompt'] for entry in memory.get_long_term_memory(limit=8)]
+        
+        archived = memory.archive_memory(max_rows=8, compact=False)
+        remaining = [entry['original_prompt'] for entry in memory.get_long_term_memory(limit=50)]
+        print(f"Archived {archived}, kept {len(remaining)}")
+        assert archived == 13
+        assert remaining == newest
+        assert memory.get_memory_stats()['total_entries'] == 8
+        memory.close()
+
+def test_session_memory_bounds():
+    """Test that short-term memory stays within its session and size limits"""
+    print("\n🧹 Testing Bounded Session Memory...")
+    
+    session_memory = SessionMemory(max_entries_per_session=5, max_sessions=2)
+    for i in range(10):
+        session_memory.append('user-a', {'original_prompt': f'prompt {i}'})
+    session_memory.append('user-b', {'original_prompt': 'prompt b'})
+    session_memory.append('user-c', {'original_prompt': 'prompt c'})
+    
+    stats = session_memory.stats()
+    print(f"Active sessions: {stats['active_sessions']}")
+    print(f"Evictions: {stats['short_term_evictions']}")
+    assert 'user-a' not in session_memory
+    assert stats['active_sessions'] == 2
+    assert stats['short_term_evictions']['overflow'] == 5
+    assert stats['short_term_evictions']['lru'] == 5
+
+def test_batch_planning():
+    """Test that compatible generation requests share a batch"""
+    print("\n🧮 Testing Batched Generation Planning...")
+    
+    requests = [
+        GenerationRequest('A red fox'),
+        GenerationRequest('A lighthouse', num_images_per_prompt=2),
+        GenerationRequest('A castle', width=768, height=768),
+        GenerationRequest('A windmill', num_images_per_prompt=2),
+    ]
+    batches = plan_batches(requests, max_batch_images=4)
+    print(f"Batches: {batches}")
+    assert batches == [[0, 1], [3], [2]]
+    
+    # Requests cross the diffusion service boundary as JSON
+    restored = GenerationRequest.from_dict(json.loads(json.dumps(requests[1].to_dict())))
+    assert restored.to_dict() == requests[1].to_dict()
+
+def test_generation_queue():
+    """Test that queued jobs are batched by one worker, mapped back to their owners and released"""
+    print("\n🧵 Testing Generation Queue...")
+    
+    batch_sizes = []
+    def run_batch(requests, jobs):
+        batch_sizes.append(len(requests))
+        return [[f"image of {request.prompt}"] for request in requests]
+    
+    generation_queue = GenerationQueue(None, run_batch=run_batch)
+    job_ids = [generation_queue.submit(GenerationRequest(f'prompt {i}')) for i in range(3)]
+    deadline = time.time() + 5
+    while not all(generation_queue.get(job_id).finished for job_id in job_ids) and time.time() < deadline:
+        time.sleep(0.01)
+    generation_queue.close()
+    
+    print(f"Batch sizes: {batch_sizes}")
+    assert sum(batch_sizes) == 3
+    for i, job_id in enumerate(job_ids):
+        job = generation_queue.get(job_id)
+        assert job.status == DONE
+        assert job.images == [f"image of prompt {i}"]
+    
+    # Collected jobs are released; uncollected ones are pruned by age
+    assert generation_queue.release(job_ids[0])
+    assert generation_queue.get(job_ids[0]) is None
+    assert not generation_queue.release(job_ids[0])
+    generation_queue.max_finished_age = 0
+    generation_queue.submit(GenerationRequest('late prompt'))
+    assert all(generation_queue.get(job_id) is None for job_id in job_ids)
+
+def test_scheduler_adapter_failure():
+    """Test that a failed LCM adapter load leaves the previous scheduler in place"""
+    print("\n⏱️ Testing Scheduler Adapter Failure...")
+    
+    if diffusers is None:
+        print("diffusers not installed, skipping scheduler adapter test")
+        return
+    
+    class OfflinePipe:
+        name_or_path = 'runwayml/stable-diffusion-v1-5'
+        def __init__(self):
+            self.scheduler = diffusers.PNDMScheduler()
+        def load_lora_weights(self, *args, **kwargs):
+            raise OSError("offline")
+    
+    pipe = OfflinePipe()
+    apply_scheduler(pipe, 'dpmpp-2m')
+    try:
+        apply_scheduler(pipe, 'lcm')
+        assert False, "adapter load should fail"
+    except OSError:
+        pass
+    print(f"Scheduler after failed switch: {type(pipe.scheduler).__name__} ({pipe.scheduler_name})")
+    assert isinstance(pipe.scheduler, diffusers.DPMSolverMultistepScheduler)
+    assert pipe.scheduler_name == 'dpmpp-2m'
+    assert not getattr(pipe, 'lcm_adapter_loaded', False)
+    assert isinstance(apply_scheduler(pipe, 'dpmpp-2m').scheduler, diffusers.DPMSolverMultistepScheduler)
+
+def test_model_registry():
+    """Test LRU eviction, busy models and per-model loading in the diffusion service registry"""
+    print("\n🗃️ Testing Model Registry...")
+    
+    if ModelRegistry is None:
+        print("torch/diffusers not installed, skipping model registry test")
+        return
+    
+    release = threading.Event()
+    loads = []
+    class StubPipe:
+        name_or_path = 'stub'
+        scheduler = object()
+        def __init__(self, model_id):
+            if model_id == 'slow':
+                release.wait(5)
+            loads.append(model_id)
+            self.text_encoder = torch.nn.Linear(64, 64)
+            self.components = {'text_encoder': self.text_encoder}
+        def __call__(self, prompts, **kwargs):
+            release.wait(5)
+            raise RuntimeError("stub pipeline")
+    
+    model_bytes = 65 * 64 * 4
+    registry = ModelRegistry(memory_budget_bytes=2 * model_bytes, loader=StubPipe, default_model_bytes=model_bytes)
+    def loaded():
+        return [model['model'] for model in registry.status()['models']]
+    
+    # Least recently used goes first
+    registry.get('a')
+    registry.get('b')
+    registry.get('a')
+    registry.get('c')
+    assert loaded() == ['a', 'c']
+    
+    # A model with a running job is never evicted, even when it is the least recently used
+    service = DiffusionService(registry)
+    job_id = service.submit('a', GenerationRequest('A red fox', steps=1))
+    registry.get('c')
+    deadline = time.time() + 5
+    while service.job(job_id)['status'] != 'running' and time.time() < deadline:
+        time.sleep(0.01)
+    registry.get('b')
+    print(f"Loaded after eviction: {loaded()}, loads: {loads}")
+    assert loaded() == ['a', 'b']
+    
+    # A slow load does not block the registry, and concurrent requests share one load
+    threads = [threading.Thread(target=registry.get, args=('slow',)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    start_time = time.time()
+    registry.status()
+    assert time.time() - start_time < 1
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert loads.count('slow') == 1
+    assert service.wait(job_id, timeout=5)['status'] == 'failed'
+
+def test_scheduler_restore():
+    """Test that a request without a scheduler restores the default and disables the LCM LoRA"""
+    print("\n⏱️ Testing Scheduler Restore...")
+    
+    class StubScheduler:
+        def __init__(self, config):
+            self.config = config
+        @classmethod
+        def from_config(cls, config, **overrides):
+            return cls(dict(config, **overrides))
+    
+    class StubPipe:
+        name_or_path = 'runwayml/stable-diffusion-v1-5'
+        def __init__(self):
+            self.scheduler = StubScheduler({'beta_schedule': 'scaled_linear'})
+            self.lora_calls = []
+        def enable_lora(self):
+            self.lora_calls.append('enable')
+        def disable_lora(self):
+            self.lora_calls.append('disable')
+    
+    # A pipeline loaded as usual has nothing to restore
+    pipe = StubPipe()
+    default_scheduler = pipe.scheduler
+    assert apply_scheduler(pipe, None).scheduler is default_scheduler
+    
+    # State left behind by an earlier LCM request
+    pipe.default_scheduler_class = StubScheduler
+    pipe.default_scheduler_config = default_scheduler.config
+    pipe.scheduler = object()
+    pipe.scheduler_name = 'lcm'
+    pipe.lcm_adapter_loaded = True
+    
+    apply_scheduler(pipe, None)
+    print(f"Scheduler after restore: {type(pipe.scheduler).__name__}, LoRA calls: {pipe.lora_calls}")
+    assert isinstance(pipe.scheduler, StubScheduler)
+    assert pipe.scheduler.config == {'beta_schedule': 'scaled_linear'}
+    assert pipe.scheduler_name is None
+    assert pipe.lora_calls == ['disable']
+    apply_scheduler(pipe, '')
+    assert pipe.lora_calls == ['disable']
+
+def test_result_cache():
+    """Test that a repeated seeded request is served from the result cache"""
+    print("\n🗄️ Testing Result Cache...")
+    
+    assert 0 <= GenerationRequest('A red fox').seed < 2 ** 32
+    assert GenerationRequest('A red fox', num_images_per_prompt=3, seed=5).image_seeds() == [5, 6, 7]
+    if Image is None:
+        print("Pillow not installed, skipping cached image round trip")
+        return
+    
+    class CountingPipe:
+        name_or_path = 'test-model'
+        scheduler = object()
+        calls = 0
+        def __call__(self, prompts, num_images_per_prompt=1, **kwargs):
+            self.calls += 1
+            count = len(prompts) * num_images_per_prompt
+            return type('Output', (), {'images': [Image.new('RGB', (8, 8), (self.calls, i, 0)) for i in range(count)]})
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = ResultCache(tmp_dir, max_entries=3)
+        pipe = CountingPipe()
+        request = GenerationRequest('A red fox', num_images_per_prompt=2, seed=42)
+        first = generate_batch(pipe, [request], result_cache=cache)[0]
+        again = generate_batch(pipe, [GenerationRequest('A red fox', num_images_per_prompt=2, seed=42)],
+                               result_cache=cache)[0]
+        print(f"Pipeline calls: {pipe.calls}, cache: {cache.stats()}")
+        assert pipe.calls == 1
+        assert [image.getpixel((0, 0)) for image in again] == [image.getpixel((0, 0)) for image in first]
+        
+        # A different seed misses, and the oldest entries are evicted past the limit
+        generate_batch(pipe, [GenerationRequest('A red fox', num_images_per_prompt=2, seed=7)], result_cache=cache)
+        assert pipe.calls == 2
+        assert cache.stats()['entries'] == 3
+        assert len(list(Path(tmp_dir).glob('*/*.png'))) == 3
+
+def test_result_cache_scheduler_key():
+    """Test that requests without a scheduler are cached apart from explicit schedulers"""
+    print("\n🗄️ Testing Result Cache Scheduler Keys...")
+    
+    if diffusers is None:
+        print("diffusers not installed, skipping scheduler cache key test")
+        return
+    
+    class DictCache:
+        enabled = True
+        def __init__(self):
+            self.entries = {}
+        def get(self, key):
+            return self.entries.get(key)
+        def put(self, key, image):
+            self.entries[key] = image
+    
+    class SchedulerPipe:
+        name_or_path = 'test-model'
+        def __init__(self):
+            self.scheduler = diffusers.PNDMScheduler()
+            self.calls = 0
+        def __call__(self, prompts, num_images_per_prompt=1, **kwargs):
+            self.calls += 1
+            return type('Output', (), {'images': [type(self.scheduler).__name__] * len(prompts) * num_images_per_prompt})
+    
+    pipe = SchedulerPipe()
+    cache = DictCache()
+    def generate(scheduler=None):
+        request = GenerationRequest('A red fox', seed=42, scheduler=scheduler)
+        return generate_batch(pipe, [request], result_cache=cache)[0]
+    
+    assert generate() == ['PNDMScheduler']
+    assert generate('dpmpp-2m') == ['DPMSolverMultistepScheduler']
+    assert generate() == ['PNDMScheduler']
+    assert generate('dpmpp-2m') == ['DPMSolverMultistepScheduler']
+    print(f"Pipeline calls: {pipe.calls}, cached: {len(cache.entries)}")
+    assert pipe.calls == 2
+
 def test_output_directory_creation():
     """Test output directory creation"""
     print("\n📁 Testing Output Directory Creation...")
@@ -120,7 +879,28 @@ def main():
     
     try:
         test_local_llm()
+        test_local_llm_streaming()
+        test_prompt_budget()
         test_memory_manager()
+        test_memory_search()
+        test_memory_schema_without_app_functions()
+        test_memory_semantic_search_after_delete()
+        test_similar_prompt_reuse()
+        test_memory_stats_consistency()
+        test_memory_write_behind()
+        test_memory_write_retry()
+        test_memory_export_import()
+        test_memory_archive()
+        test_sharded_memory()
+        test_sharded_archive_skew()
+        test_session_memory_bounds()
+        test_batch_planning()
+        test_generation_queue()
+        test_scheduler_restore()
+        test_scheduler_adapter_failure()
+        test_model_registry()
+        test_result_cache()
+        test_result_cache_scheduler_key()
         test_output_directory_creation()
         test_configuration()
         